@@ -1,19 +1,299 @@
 # -*- coding: utf-8 -*-
-""" This script is used to download a csv file, 
+""" This script is used to download a csv file,
 default behavior is to download the whole MOSES dataset,
-and save it as a csv file 
+and save it as a csv file.
+The file is streamed to disk by chunks, so it is never held in memory,
+and an interrupted download is resumed with HTTP Range requests.
+Ranges can be fetched in parallel connections, the md5 checksum of the file is verified
+and the file can be gzip compressed on the fly
 """
 import logging
 import argparse
 import os
+import gzip
+import base64
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
 from pathlib import Path
 from urllib import request
 from urllib.error import URLError, HTTPError
 
+# size of the chunks read from the connection and from the part files
+CHUNK_SIZE = 1 << 20
+# md5 checksum of the MOSES dataset, encoded in base 64
+MOSES_MD5 = "a9sNlSbd9f3rh9aqVB3yEw=="
+# suffix of the partially downloaded files, kept to resume the download
+PART_SUFFIX = ".part"
+# suffix of the file recording the byte range of every part file
+RANGES_SUFFIX = ".parts.json"
 
-def main(input_url: str, output_filepath: str, output_log: str) -> None:
-    """ Download a csv file containing the SMILES, 
+
+def get_remote_size(input_url: str, timeout: float) -> tuple:
+    """
+    This function ask the size of a file to the server, without downloading it
+
+    Args:
+        input_url (str): the url of the file
+        timeout (float): timeout of the request in seconds
+
+    return:
+        (size, accept_ranges) (tuple): the size in bytes, None if unknown,
+        and whether the server accepts Range requests
+    """
+    head_request = request.Request(input_url, method="HEAD")
+    with request.urlopen(head_request, timeout=timeout) as response:
+        size = response.headers.get("Content-Length")
+        accept_ranges = response.headers.get("Accept-Ranges", "") == "bytes"
+
+    return (int(size) if size is not None else None), accept_ranges
+
+
+def sync_hash(hash_dict: dict, part_filepath: str, nb_written: int) -> None:
+    """
+    This function bring a running checksum up to the bytes already in a part file,
+    only the bytes written by a previous run of the script are read
+
+    Args:
+        hash_dict (dict): md5_hash, the md5 checksum of the first nb_hashed bytes of the file
+        part_filepath (str): the part file
+        nb_written (int): number of bytes of the part file which are kept
+    """
+    # the part file is written again from its start
+    if hash_dict["nb_hashed"] > nb_written:
+        hash_dict.update(md5_hash=hashlib.md5(), nb_hashed=0)
+    if hash_dict["nb_hashed"] == nb_written:
+        return
+
+    with open(part_filepath, "rb") as part_file:
+        part_file.seek(hash_dict["nb_hashed"])
+        while hash_dict["nb_hashed"] < nb_written:
+            chunk = part_file.read(min(CHUNK_SIZE, nb_written - hash_dict["nb_hashed"]))
+            hash_dict["md5_hash"].update(chunk)
+            hash_dict["nb_hashed"] += len(chunk)
+
+
+def stream_range(input_url: str, part_filepath: str, first_byte: int, last_byte: int,
+                 timeout: float, hash_dict: dict = None) -> None:
+    """
+    This function stream a range of a file to a part file, by chunks.
+    If the part file already exists, only its missing bytes are requested
+
+    Args:
+        input_url (str): the url of the file
+        part_filepath (str): the file receiving the range
+        first_byte (int): first byte of the range
+        last_byte (int): last byte of the range, included, None for the end of the file
+        timeout (float): timeout of the connection in seconds
+        hash_dict (dict): optional, the running md5 checksum of the part file, see sync_hash,
+        updated with the chunks as they are written
+    """
+    # declare local variables
+    nb_written = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+    if hash_dict is not None:
+        sync_hash(hash_dict, part_filepath, nb_written)
+    range_size = None if last_byte is None else last_byte - first_byte + 1
+    if nb_written == range_size:
+        return
+    start_byte = first_byte + nb_written
+    range_request = request.Request(input_url)
+    if start_byte or last_byte is not None:
+        range_request.add_header(
+            "Range", f"bytes={start_byte}-{'' if last_byte is None else last_byte}")
+
+    try:
+        response = request.urlopen(range_request, timeout=timeout)
+    except HTTPError as error:
+        # the part file already holds the whole file
+        if error.code == 416 and last_byte is None:
+            return
+        raise
+    with response:
+        # a server ignoring the Range header sends the whole file again
+        if response.status == 200 and start_byte:
+            if first_byte:
+                raise HTTPException(f"{input_url} does not support Range requests")
+            nb_written = 0
+            if hash_dict is not None:
+                sync_hash(hash_dict, part_filepath, nb_written)
+        content_length = response.headers.get("Content-Length")
+        expected_nb_written = None if content_length is None else \
+            nb_written + int(content_length)
+        with open(part_filepath, "ab" if nb_written else "wb") as part_file:
+            while chunk := response.read(CHUNK_SIZE):
+                part_file.write(chunk)
+                nb_written += len(chunk)
+                if hash_dict is not None:
+                    hash_dict["md5_hash"].update(chunk)
+                    hash_dict["nb_hashed"] = nb_written
+
+    # a dropped connection may end the response early without error
+    if expected_nb_written is not None and nb_written != expected_nb_written:
+        raise HTTPException(f"incomplete range {first_byte}-{last_byte}: "
+                            f"{nb_written}/{expected_nb_written} bytes")
+
+
+def retry_stream_range(input_url: str, part_filepath: str, first_byte: int, last_byte: int,
+                       timeout: float, max_retries: int, logger: logging.Logger,
+                       hash_dict: dict = None) -> None:
+    """
+    This function call stream_range until the range is complete, every retry resumes
+    from the bytes already written. Client errors are not retried
+
+    Args:
+        input_url (str): the url of the file
+        part_filepath (str): the file receiving the range
+        first_byte (int): first byte of the range
+        last_byte (int): last byte of the range, included, None for the end of the file
+        timeout (float): timeout of the connection in seconds
+        max_retries (int): number of retries before giving up
+        logger (logging.Logger): the logger of the download
+        hash_dict (dict): optional, the running md5 checksum of the part file
+    """
+    for retry_idx in range(max_retries + 1):
+        try:
+            stream_range(input_url, part_filepath, first_byte, last_byte, timeout, hash_dict)
+            return
+        except HTTPError as error:
+            if error.code < 500 or retry_idx == max_retries:
+                raise
+            logger.warning("HTTP Error (%s): %s, retrying", error.code, error.reason)
+        except (URLError, HTTPException, OSError) as error:
+            if retry_idx == max_retries:
+                raise
+            logger.warning("connection error on range %s-%s: %s, resuming", first_byte,
+                           last_byte, error)
+        # exponential backoff
+        time.sleep(min(2 ** retry_idx, 60) * 0.1)
+
+
+def get_ranges(size: int, nb_connections: int) -> list:
+    """
+    This function split a file in contiguous byte ranges of roughly the same size
+
+    Args:
+        size (int): the size of the file in bytes
+        nb_connections (int): number of ranges
+
+    return:
+        ranges_list (list of tuple): first and last byte, included, of every range
+    """
+    # declare local variables
+    boundaries_list = [size * range_idx // nb_connections for range_idx in
+                       range(nb_connections + 1)]
+
+    return [(first_byte, last_byte - 1) for first_byte, last_byte in
+            zip(boundaries_list[:-1], boundaries_list[1:]) if last_byte > first_byte]
+
+
+def discard_stale_parts(part_filepath_list: list, ranges_list: list, ranges_filepath: str,
+                        logger: logging.Logger) -> None:
+    """
+    This function remove the part files of a previous run which hold another byte range,
+    e.g. when the number of connections changed, and record the ranges of this run.
+    A part file without recorded range is only kept for a single connection,
+    its bytes always start the file
+
+    Args:
+        part_filepath_list (list of str): the part files, in the order of the ranges
+        ranges_list (list of tuple): first and last byte, included, of every range
+        ranges_filepath (str): the json file recording the range of every part file
+        logger (logging.Logger): the logger of the download
+    """
+    # declare local variables
+    recorded_ranges_dict = {}
+    if os.path.exists(ranges_filepath):
+        with open(ranges_filepath, encoding="utf-8") as json_file:
+            recorded_ranges_dict = json.load(json_file)
+
+    for part_filepath, (first_byte, last_byte) in zip(part_filepath_list, ranges_list):
+        part_name = os.path.basename(part_filepath)
+        recorded_range = recorded_ranges_dict.get(part_name, [0, None])
+        if os.path.exists(part_filepath) and recorded_range != [first_byte, last_byte]:
+            logger.warning("%s holds the range %s instead of %s-%s, downloading it again",
+                           part_filepath, recorded_range, first_byte, last_byte)
+            os.remove(part_filepath)
+
+    with open(ranges_filepath, "w", encoding="utf-8") as json_file:
+        json.dump({os.path.basename(part_filepath): [first_byte, last_byte]
+                   for part_filepath, (first_byte, last_byte) in
+                   zip(part_filepath_list, ranges_list)}, json_file)
+
+
+def assemble_parts(part_filepath_list: list, output_filepath: str, compress: bool,
+                   md5_hash: object = None) -> object:
+    """
+    This function concatenate the part files into the output file by chunks,
+    computing the md5 checksum of the downloaded bytes on the way,
+    unless it was computed while streaming
+
+    Args:
+        part_filepath_list (list of str): the part files, in the order of the ranges
+        output_filepath (str): the output file
+        compress (bool): gzip compress the output file
+        md5_hash (hashlib object): optional, the md5 checksum computed while streaming
+
+    return:
+        md5_hash (hashlib object): the md5 checksum of the uncompressed file
+    """
+    # declare local variables
+    is_hashed = md5_hash is not None
+    md5_hash = md5_hash if is_hashed else hashlib.md5()
+    tmp_filepath = output_filepath + ".tmp"
+
+    # a single uncompressed part is renamed, it is only read if its checksum is missing
+    if len(part_filepath_list) == 1 and not compress:
+        if not is_hashed:
+            with open(part_filepath_list[0], "rb") as part_file:
+                while chunk := part_file.read(CHUNK_SIZE):
+                    md5_hash.update(chunk)
+        return md5_hash
+
+    opener = gzip.open if compress else open
+    with opener(tmp_filepath, "wb") as output_file:
+        for part_filepath in part_filepath_list:
+            with open(part_filepath, "rb") as part_file:
+                while chunk := part_file.read(CHUNK_SIZE):
+                    if not is_hashed:
+                        md5_hash.update(chunk)
+                    output_file.write(chunk)
+
+    return md5_hash
+
+
+def is_digest_matching(md5_hash: object, expected_md5: str) -> bool:
+    """ compare a md5 checksum to an expected digest, in hexadecimal or base 64 """
+    return expected_md5 in (md5_hash.hexdigest(),
+                            base64.b64encode(md5_hash.digest()).decode("ascii"))
+
+
+def main(input_url: str,
+         output_filepath: str,
+         output_log: str,
+         expected_md5: str = None,
+         nb_connections: int = 1,
+         compress: bool = False,
+         timeout: float = 60.0,
+         max_retries: int = 5) -> str:
+    """ Download a csv file containing the SMILES,
     typical use case is to donwload MOSES from github repo
+
+    Args:
+        input_url (str): the url of the file
+        output_filepath (str): the output file
+        output_log (str): the log file, no log file if None
+        expected_md5 (str): the md5 checksum of the file, in hexadecimal or base 64,
+        not verified if None
+        nb_connections (int): number of ranges fetched in parallel, if the server accepts
+        Range requests
+        compress (bool): gzip compress the output file
+        timeout (float): timeout of the connections in seconds
+        max_retries (int): number of retries of every range before giving up
+
+    return:
+        md5_digest (str): the md5 checksum of the downloaded file, in hexadecimal
     """
     # set logger
     logger = logging.getLogger(__name__)
@@ -29,25 +309,72 @@ def main(input_url: str, output_filepath: str, output_log: str) -> None:
 
     logger.info('Downloading csv file')
     try:
-        # Open the URL and retrieve the data
-        with request.urlopen(input_url) as response:
-            csv_data = response.read()
+        # ranges are only used if the server accepts them
+        ranges_list = [(0, None)]
+        if nb_connections > 1:
+            size, accept_ranges = get_remote_size(input_url, timeout)
+            if size and accept_ranges:
+                ranges_list = get_ranges(size, nb_connections)
+            else:
+                logger.warning("%s does not accept Range requests, using a single connection",
+                               input_url)
 
-        # Save the data to a local CSV file
+        # every range is streamed to its own part file, kept until the checksum is verified
+        part_filepath_list = [output_filepath + PART_SUFFIX] if len(ranges_list) == 1 else \
+            [f"{output_filepath}{PART_SUFFIX}{range_idx}" for range_idx in
+             range(len(ranges_list))]
+        ranges_filepath = output_filepath + RANGES_SUFFIX
+        discard_stale_parts(part_filepath_list, ranges_list, ranges_filepath, logger)
+        # a single connection receives the bytes in order, the checksum is computed on the fly,
+        # the parallel ranges are hashed in order while being assembled
+        hash_dict = {"md5_hash": hashlib.md5(), "nb_hashed": 0} if len(ranges_list) == 1 \
+            else None
+        with ThreadPoolExecutor(len(ranges_list)) as executor:
+            for future in [executor.submit(retry_stream_range, input_url, part_filepath,
+                                           first_byte, last_byte, timeout, max_retries, logger,
+                                           hash_dict)
+                           for part_filepath, (first_byte, last_byte) in
+                           zip(part_filepath_list, ranges_list)]:
+                future.result()
+
+        # Save the data to the output file
         logger.info('writing to file')
-        with open(output_filepath, 'wb') as csv_file:
-            csv_file.write(csv_data)
+        md5_hash = assemble_parts(part_filepath_list, output_filepath, compress,
+                                  None if hash_dict is None else hash_dict["md5_hash"])
+        if expected_md5 and not is_digest_matching(md5_hash, expected_md5):
+            for part_filepath in part_filepath_list:
+                os.remove(part_filepath)
+            os.remove(ranges_filepath)
+            if os.path.exists(output_filepath + ".tmp"):
+                os.remove(output_filepath + ".tmp")
+            raise ValueError(f"md5 checksum {md5_hash.hexdigest()} of {input_url} "
+                             f"does not match {expected_md5}")
+        if len(part_filepath_list) == 1 and not compress:
+            os.replace(part_filepath_list[0], output_filepath)
+        else:
+            os.replace(output_filepath + ".tmp", output_filepath)
+            for part_filepath in part_filepath_list:
+                os.remove(part_filepath)
+        os.remove(ranges_filepath)
 
         logger.info("CSV file downloaded successfully to %s", output_filepath)
 
     except HTTPError as error:
-        logger.debug("HTTP Error (%s): %s", error.code, error.reason)
+        logger.error("HTTP Error (%s): %s", error.code, error.reason)
+        raise
 
     except URLError as error:
-        logger.debug("URL Error: %s", error.reason)
+        logger.error("URL Error: %s", error.reason)
+        raise
+
+    except (HTTPException, OSError, ValueError) as error:
+        logger.error("Download Error: %s", error)
+        raise
 
     logger.info('finished')
 
+    return md5_hash.hexdigest()
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -57,15 +384,35 @@ if __name__ == '__main__':
 
     # files & directory arguments
     parser.add_argument('--input_url', help="the url of the MOSES dataset",
-                        default="https://media.githubusercontent.com/media/\
-                            molecularsets/moses/master/data/dataset_v1.csv", type=str)
-    parser.add_argument('--output_filepath', help="the output file should be a csv",
+                        default="https://media.githubusercontent.com/media/"
+                        "molecularsets/moses/master/data/dataset_v1.csv", type=str)
+    parser.add_argument('--output_filepath', help="the output file should be a csv, \
+                        or a csv.gz with --compress",
                         default="data/raw/whole_original_MOSES.csv",
                         type=str)
     parser.add_argument('--output_log', help="the output log path",
                         default="logs/downloading_moses.log",
                         type=str)
 
+    # download arguments
+    parser.add_argument('--expected_md5', help="md5 checksum of the file, in hexadecimal \
+                        or base 64, use an empty string to skip the verification",
+                        default=MOSES_MD5,
+                        type=str)
+    parser.add_argument('--nb_connections', help="number of ranges downloaded in parallel",
+                        default=1,
+                        type=int)
+    parser.add_argument('--compress', help="gzip compress the output file",
+                        default=False,
+                        action="store_true")
+    parser.add_argument('--timeout', help="timeout of the connections in seconds",
+                        default=60.0,
+                        type=float)
+    parser.add_argument('--max_retries', help="number of retries before giving up, \
+                        every retry resumes the download",
+                        default=5,
+                        type=int)
+
     # parse and converto dict
     args, _ = parser.parse_known_args()
     args_dict = vars(args)
@@ -82,5 +429,10 @@ if __name__ == '__main__':
     # execute main
     main(input_url=args_dict["input_url"],
          output_filepath=args_dict["output_filepath"],
-         output_log=args_dict["output_log"]
+         output_log=args_dict["output_log"],
+         expected_md5=args_dict["expected_md5"],
+         nb_connections=args_dict["nb_connections"],
+         compress=args_dict["compress"],
+         timeout=args_dict["timeout"],
+         max_retries=args_dict["max_retries"]
          )
@@ -0,0 +1,170 @@
+"""This module contains a batched scoring engine for randomized SMILES,
+all the candidates of a molecule are packed in a single uint8 buffer
+and the max digit and semantic memory score are computed in vectorized passes.
+The results are identical to find_biggest_digits and get_semantic_mem_map
+from clearsmiles_search.py
+"""
+import numpy as np
+
+# ascii codes used by the vectorized tokenizer
+SEPARATOR = 0
+OPEN_BRANCH = ord("(")
+CLOSE_BRANCH = ord(")")
+OPEN_BRACKET = ord("[")
+CLOSE_BRACKET = ord("]")
+PERCENT = ord("%")
+BACKSLASH = ord("\\")
+ZERO = ord("0")
+NINE = ord("9")
+
+# every character that can start a token in the SMILES regex, except the
+# multi-character tokens ( bracket atom, %nn and double backslash)  which are handled apart
+SINGLE_TOKEN_STARTS = "BCNOSPFIbcnosp().=#-+/_:~@?>*$0123456789"
+TOKEN_START_LOOKUP = np.zeros(256, dtype=bool)
+TOKEN_START_LOOKUP[np.frombuffer(SINGLE_TOKEN_STARTS.encode("ascii"), dtype=np.uint8)] = True
+
+
+def pack_smiles(smiles_list: list) -> tuple:
+    """
+    This function pack a list of SMILES in a single uint8 buffer,
+    each SMILES is followed by a null byte so that look ahead and look behind
+    operations never cross the boundary between two SMILES
+
+    Args:
+        smiles_list (list of string): the SMILES to pack
+
+    return:
+        buffer (numpy array): uint8 array containing all the SMILES
+        offsets (numpy array): int64 array with the start index of every SMILES in buffer,
+        the last value is the size of the buffer
+    """
+    # declare local variables
+    lengths = np.fromiter((len(smiles) + 1 for smiles in smiles_list),
+                          dtype=np.int64, count=len(smiles_list))
+    offsets = np.zeros(len(smiles_list) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # join with separator, the trailing separator close the last SMILES
+    joined = "\0".join(smiles_list) + "\0"
+    buffer = np.frombuffer(joined.encode("ascii"), dtype=np.uint8)
+
+    return buffer, offsets
+
+
+def batch_find_biggest_digits(buffer: np.array, offsets: np.array) -> np.array:
+    """
+    This function compute the biggest digit of every packed SMILES,
+    like find_biggest_digits any digit character is considered,
+    %nn ring closures can only be written once the digits 1 to 9 are all open,
+    hence they are covered by the digit 9
+
+    Args:
+        buffer (numpy array): uint8 array produced by pack_smiles
+        offsets (numpy array): offsets produced by pack_smiles
+
+    return:
+        max_digit_array (numpy array): the biggest digit for every SMILES
+    """
+    # zero is not considered as a digit by find_biggest_digits
+    digit_values = buffer.astype(np.int8) - ZERO
+    digit_values[(buffer <= ZERO) | (buffer > NINE)] = 0
+
+    return np.maximum.reduceat(digit_values, offsets[:-1]).astype(int)
+
+
+def get_token_start_mask(buffer: np.array) -> tuple:
+    """
+    This function flag every byte of the buffer that start a token,
+    following the same rules than the SMILES regex used in clearsmiles_search.py
+
+    Args:
+        buffer (numpy array): uint8 array produced by pack_smiles
+
+    return:
+        token_start (numpy array): boolean array, True when a byte start a token
+        is_digit_token (numpy array): boolean array, True when a byte is a single digit token
+    """
+    # declare local variables
+    is_digit = (buffer >= ZERO) & (buffer <= NINE)
+    next_byte = np.append(buffer[1:], SEPARATOR)
+    previous_byte = np.insert(buffer[:-1], 0, SEPARATOR)
+
+    # bracket atoms, every byte after "[" up to the closing "]" belong to the same token
+    nb_open = np.cumsum(buffer == OPEN_BRACKET)
+    nb_closed = np.cumsum(buffer == CLOSE_BRACKET) - (buffer == CLOSE_BRACKET)
+    in_bracket = (nb_open > nb_closed) & (buffer != OPEN_BRACKET)
+
+    # %nn ring closures, the two digits belong to the percent token
+    is_percent_token = (buffer == PERCENT) & np.append(is_digit[1:], False)
+    is_percent_token[:-2] &= is_digit[2:]
+    in_percent_token = np.zeros(len(buffer), dtype=bool)
+    in_percent_token[1:] |= is_percent_token[:-1]
+    in_percent_token[2:] |= is_percent_token[:-2]
+
+    # double backslash tokens, a lone backslash is not matched by the regex
+    is_backslash = buffer == BACKSLASH
+    byte_idx = np.arange(len(buffer))
+    is_run_start = is_backslash & (previous_byte != BACKSLASH)
+    run_offset = byte_idx - np.maximum.accumulate(np.where(is_run_start, byte_idx, 0))
+    is_backslash_token = is_backslash & (run_offset % 2 == 0) & (next_byte == BACKSLASH)
+
+    # combine all the rules
+    token_start = TOKEN_START_LOOKUP[buffer] & ~in_percent_token
+    token_start |= is_percent_token | is_backslash_token
+    token_start &= ~in_bracket
+    token_start |= buffer == OPEN_BRACKET
+    is_digit_token = is_digit & token_start
+
+    return token_start, is_digit_token
+
+
+def batch_semantic_mem_score(buffer: np.array, offsets: np.array) -> np.array:
+    """
+    This function compute the semantic memory score, i.e the mean of
+    the semantic memory map, of every packed SMILES.
+    The mean of a cumulative sum is obtained without building the maps:
+    a variation at token k of a SMILES with T tokens contributes (T-k)/T
+
+    Args:
+        buffer (numpy array): uint8 array produced by pack_smiles
+        offsets (numpy array): offsets produced by pack_smiles
+
+    return:
+        mem_score_array (numpy array): float array with the semantic memory score of every SMILES
+    """
+    # declare local variables
+    nb_smiles = len(offsets) - 1
+    token_start, is_digit_token = get_token_start_mask(buffer)
+    smiles_idx = np.repeat(np.arange(nb_smiles), np.diff(offsets))
+
+    # token index of every byte within its SMILES
+    token_cumsum = np.append(0, np.cumsum(token_start))
+    nb_tokens = token_cumsum[offsets[1:]] - token_cumsum[offsets[:-1]]
+    token_idx = token_cumsum[1:] - 1 - token_cumsum[offsets[:-1]][smiles_idx]
+
+    # branches open and close the semantic memory
+    variation = np.zeros(len(buffer), dtype=np.int64)
+    variation[(buffer == OPEN_BRANCH) & token_start] = 1
+    variation[(buffer == CLOSE_BRANCH) & token_start] = -1
+
+    # ring closure digits alternate between opening and closing for a given SMILES
+    digit_pos = np.where(is_digit_token)[0]
+    order = np.lexsort((digit_pos, buffer[digit_pos], smiles_idx[digit_pos]))
+    sorted_pos = digit_pos[order]
+    group_key = smiles_idx[sorted_pos] * 10 + (buffer[sorted_pos] - ZERO)
+    is_new_group = np.append(True, group_key[1:] != group_key[:-1])
+    group_start = np.maximum.accumulate(np.where(is_new_group, np.arange(len(sorted_pos)), 0))
+    rank_in_group = np.arange(len(sorted_pos)) - group_start
+    variation[sorted_pos] = np.where(rank_in_group % 2 == 0, 1, -1)
+
+    # sum of the memory map is the sum of variations weighted by the remaining tokens
+    event_pos = np.nonzero(variation)[0]
+    event_smiles = smiles_idx[event_pos]
+    weights = variation[event_pos] * (nb_tokens[event_smiles] - token_idx[event_pos])
+    mem_sum = np.bincount(event_smiles, weights=weights, minlength=nb_smiles)
+
+    # np.mean of an empty memory map is nan
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mem_score_array = mem_sum / nb_tokens
+
+    return mem_score_array
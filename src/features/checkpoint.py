@@ -0,0 +1,178 @@
+"""
+This module checkpoint the results of a generation task, every row group is written
+as a part file in a checkpoint directory next to the output parquet file.
+Part files are renamed once complete, thus a task killed at its time limit leaves
+only complete parts behind, and the relaunched task skips the rows already computed.
+Once all the rows are computed, the parts are merged into the output parquet file,
+in the order of the rows of the database.
+The search parameters are recorded in the checkpoint directory, a task relaunched
+with other parameters does not mix their results.
+The workers of a work queue name their parts with their worker id, so that a worker
+still writing a range claimed again by another worker never replaces the parts of the other
+"""
+from __future__ import annotations
+import os
+import sys
+import glob
+import json
+import shutil
+from pathlib import Path
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+
+# heavy dependencies are imported on first use
+np = LazyModule("numpy")
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
+
+# column with the index of the row in the csv database
+ROW_IDX_KEY = "row_idx"
+CHECKPOINT_SUFFIX = ".checkpoint"
+TMP_SUFFIX = ".tmp"
+PARAMS_FILENAME = "params.json"
+
+
+def get_checkpoint_dir(output_filepath: str) -> str:
+    """ default checkpoint directory of an output parquet file """
+    return f"{output_filepath}{CHECKPOINT_SUFFIX}"
+
+
+def get_part_paths(checkpoint_dir: str) -> list:
+    """ complete part files of a checkpoint directory, in writing order """
+    return sorted(glob.glob(os.path.join(checkpoint_dir, "part_*.parquet")))
+
+
+def get_part_idx(part_path: str) -> int:
+    """ index of a part file, whether it is named with a writer id or not """
+    return int(os.path.basename(part_path)[len("part_"):].split("_")[0].split(".")[0])
+
+
+def check_checkpoint_params(checkpoint_dir: str, params_dict: dict) -> None:
+    """
+    This function record the search parameters of a task in its checkpoint directory,
+    or check that they are the ones of the task which wrote the checkpoint,
+    a ValueError is raised otherwise
+
+    Args:
+        checkpoint_dir (str): the checkpoint directory
+        params_dict (dict): the parameters the results depend on, json serializable
+    """
+    # declare local variables
+    params_path = os.path.join(checkpoint_dir, PARAMS_FILENAME)
+
+    # parameters of the task which wrote the checkpoint
+    if os.path.exists(params_path):
+        with open(params_path, encoding="utf-8") as json_file:
+            checkpoint_params_dict = json.load(json_file)
+        if checkpoint_params_dict != params_dict:
+            raise ValueError(f"the checkpoint {checkpoint_dir} was written with the parameters "
+                             f"{checkpoint_params_dict} and not {params_dict}, relaunch the "
+                             "task with the same parameters or remove the checkpoint")
+        return
+
+    # write then rename, the workers of a range write the same file
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(f"{params_path}.{os.getpid()}{TMP_SUFFIX}", "w", encoding="utf-8") as json_file:
+        json.dump(params_dict, json_file)
+    os.replace(f"{params_path}.{os.getpid()}{TMP_SUFFIX}", params_path)
+
+
+def load_finished_rows(checkpoint_dir: str, writer_id: str = None) -> set:
+    """
+    This function find the rows already computed by a previous run of the task,
+    unfinished and unreadable part files are removed
+
+    Args:
+        checkpoint_dir (str): the checkpoint directory
+        writer_id (str): optional, only the unfinished parts of this writer are removed,
+        the other writers of the range may still be writing theirs
+
+    return:
+        finished_rows_set (set of int): the index of the rows found in the part files
+    """
+    # declare local variables
+    finished_rows_set = set()
+
+    # parts which were being written when the task was killed
+    tmp_pattern = f"*{TMP_SUFFIX}" if writer_id is None else f"*_{writer_id}.parquet{TMP_SUFFIX}"
+    for tmp_path in glob.glob(os.path.join(checkpoint_dir, tmp_pattern)):
+        os.remove(tmp_path)
+
+    # only the row index column is read
+    for part_path in get_part_paths(checkpoint_dir):
+        try:
+            row_idx_list = pq.read_table(part_path, columns=[ROW_IDX_KEY]) \
+                .column(ROW_IDX_KEY).to_pylist()
+        except (OSError, pa.ArrowException):
+            os.remove(part_path)
+            continue
+        finished_rows_set.update(row_idx_list)
+
+    return finished_rows_set
+
+
+def write_checkpoint_part(table: pa.Table, checkpoint_dir: str, writer_id: str = None) -> str:
+    """
+    This function write a table as a new part file, the file is first written
+    under a temporary name then renamed, the rename being atomic
+
+    Args:
+        table (pa.Table): the results to write
+        checkpoint_dir (str): the checkpoint directory
+        writer_id (str): optional, appended to the name of the part, two writers
+        of the same checkpoint thus never write the same part file
+
+    return:
+        part_path (str): the path of the part file
+    """
+    # declare local variables
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    part_paths_list = get_part_paths(checkpoint_dir)
+    part_idx = max(get_part_idx(part_path) for part_path in part_paths_list) + 1 \
+        if part_paths_list else 0
+    part_name = f"part_{part_idx:05d}" if writer_id is None else f"part_{part_idx:05d}_{writer_id}"
+    part_path = os.path.join(checkpoint_dir, f"{part_name}.parquet")
+
+    # write then rename
+    pq.write_table(table, f"{part_path}{TMP_SUFFIX}")
+    os.replace(f"{part_path}{TMP_SUFFIX}", part_path)
+
+    return part_path
+
+
+def merge_checkpoint(checkpoint_dir: str, output_filepath: str, schema: pa.Schema,
+                     row_group_size: int = None) -> int:
+    """
+    This function merge the part files into the output parquet file sorted by row index,
+    whatever the order in which the rows were computed, the checkpoint directory
+    is then removed. A row computed by two workers of a range is written once.
+    The parts of a task are loaded together, the memory used is bounded by the task size
+
+    Args:
+        checkpoint_dir (str): the checkpoint directory
+        output_filepath (str): the output parquet file
+        schema (pa.Schema): the schema of the output parquet file
+        row_group_size (int): optional, number of rows per row group of the output
+
+    return:
+        nb_rows (int): number of rows written
+    """
+    # declare local variables
+    tmp_filepath = f"{output_filepath}{TMP_SUFFIX}"
+    table = pa.concat_tables([pq.read_table(part_path, schema=schema)
+                              for part_path in get_part_paths(checkpoint_dir)]
+                             or [schema.empty_table()])
+
+    # the first occurrence of every row, in the order of the row indices
+    _, first_idx_array = np.unique(table.column(ROW_IDX_KEY).to_numpy(), return_index=True)
+    table = table.take(first_idx_array)
+
+    # the output file only appears once complete
+    with pq.ParquetWriter(tmp_filepath, schema) as writer:
+        writer.write_table(table, row_group_size=row_group_size)
+    os.replace(tmp_filepath, output_filepath)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    return table.num_rows
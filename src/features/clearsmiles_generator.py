@@ -0,0 +1,243 @@
+"""
+This module is the library interface of the generation of ClearSMILES, to be called
+from data pipelines instead of the job array scripts.
+A ClearSmilesGenerator holds the compiled tokenizer and the search parameters,
+and returns lightweight ClearSmilesResult records instead of the results dictionaries,
+one molecule at a time, by batch, or as a stream computed by a pool of processes.
+pyarrow is only imported when the records are converted to a table
+"""
+from __future__ import annotations
+import os
+import sys
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from pathlib import Path
+from typing import NamedTuple
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+from features.clearsmiles_search import SMILES_TOKENS_REGEX, get_clearsmiles
+
+# heavy dependencies are imported on first use
+pa = LazyModule("pyarrow")
+Chem = LazyModule("rdkit.Chem")
+
+# generator of a pool worker, set once by init_stream_worker
+STREAM_WORKER_STATE_DICT = {}
+
+
+class ClearSmilesResult(NamedTuple):
+    """ the ClearSMILES of a molecule and the main statistics of their search """
+    smiles: str
+    clearsmiles: tuple
+    max_digit: int
+    lowest_mem_score: float
+    nb_equivalent_solution: int
+    search_path: str
+    nb_drawn: int
+    lower_bound_reached: bool
+    timed_out: bool
+    total_time: float
+    mem_maps: tuple = None
+
+
+class ClearSmilesError(NamedTuple):
+    """ a molecule whose search failed, with the text of the error """
+    smiles: str
+    error: str
+
+
+def to_result(results_dict: dict) -> ClearSmilesResult:
+    """ convert the results dictionary of get_clearsmiles to a record """
+    return ClearSmilesResult(
+        smiles=results_dict["SMILES"],
+        clearsmiles=tuple(results_dict["ClearSMILES_set"]),
+        max_digit=int(results_dict["max_digit"]),
+        lowest_mem_score=float(results_dict["lowest_mem_score"]),
+        nb_equivalent_solution=results_dict["nb_equivalent_solution"],
+        search_path=results_dict["search_path"],
+        nb_drawn=results_dict["nb_drawn"],
+        lower_bound_reached=results_dict["lower_bound_reached"],
+        timed_out=results_dict["timed_out"],
+        total_time=results_dict["total_time"],
+        mem_maps=None if results_dict["ClearSMILES_mem_maps"] is None else
+        tuple(tuple(mem_map) for mem_map in results_dict["ClearSMILES_mem_maps"]))
+
+
+def results_to_table(results_iter) -> pa.Table:
+    """
+    This function convert records to an arrow table, a column per field
+
+    Args:
+        results_iter (iterable of ClearSmilesResult): the records
+
+    return:
+        table (pa.Table): the records, the ClearSMILES as a list of strings
+    """
+    # declare local variables
+    results_list = list(results_iter)
+    schema = pa.schema([
+        ("smiles", pa.string()),
+        ("clearsmiles", pa.list_(pa.string())),
+        ("max_digit", pa.int64()),
+        ("lowest_mem_score", pa.float64()),
+        ("nb_equivalent_solution", pa.int64()),
+        ("search_path", pa.string()),
+        ("nb_drawn", pa.int64()),
+        ("lower_bound_reached", pa.bool_()),
+        ("timed_out", pa.bool_()),
+        ("total_time", pa.float64()),
+        ("mem_maps", pa.list_(pa.list_(pa.int8()))),
+    ])
+
+    return pa.Table.from_pydict({field: [getattr(result, field) for result in results_list]
+                                 for field in ClearSmilesResult._fields}, schema=schema)
+
+
+class ClearSmilesGenerator:
+    """
+    This class generate the ClearSMILES of molecules with fixed search parameters,
+    the parameters are the keyword arguments of get_clearsmiles
+    """
+    __slots__ = ("clearsmiles_kwargs", "smiles_regex")
+
+    def __init__(self,
+                 nb_random: int = 100_000,
+                 batch_size: int = None,
+                 patience: int = 3,
+                 search: str = "random",
+                 max_exhaustive_atoms: int = 30,
+                 exhaustive_time_limit: float = 60.0,
+                 max_closure_orders: int = 64,
+                 sampling: str = "uniform",
+                 store_mem_maps: bool = False,
+                 time_budget: float = None):
+        self.clearsmiles_kwargs = {
+            "nb_random": nb_random,
+            "batch_size": batch_size,
+            "patience": patience,
+            "search": search,
+            "max_exhaustive_atoms": max_exhaustive_atoms,
+            "exhaustive_time_limit": exhaustive_time_limit,
+            "max_closure_orders": max_closure_orders,
+            "sampling": sampling,
+            "store_mem_maps": store_mem_maps,
+            "time_budget": time_budget,
+        }
+        self.smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+
+    def __getstate__(self) -> dict:
+        # the workers of stream compile the tokenizer again
+        return self.clearsmiles_kwargs
+
+    def __setstate__(self, clearsmiles_kwargs: dict) -> None:
+        self.clearsmiles_kwargs = clearsmiles_kwargs
+        self.smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+
+    def generate(self, smiles: str) -> ClearSmilesResult:
+        """
+        This method get the ClearSMILES of a molecule
+
+        Args:
+            smiles (str): a SMILES of the molecule
+
+        return:
+            result (ClearSmilesResult): the ClearSMILES and the statistics of the search
+        """
+        if not smiles or Chem.MolFromSmiles(smiles) is None:
+            raise ValueError(f"invalid SMILES: {smiles!r}")
+
+        return to_result(get_clearsmiles({"SMILES": smiles}, smiles_regex=self.smiles_regex,
+                                         **self.clearsmiles_kwargs))
+
+    def generate_batch(self, smiles_iter) -> list:
+        """ the ClearSMILES of several molecules, computed in this process, in order """
+        return [self.generate(smiles) for smiles in smiles_iter]
+
+    def stream(self, smiles_iter, workers: int = None, chunksize: int = 1,
+               max_pending: int = None, ordered: bool = False):
+        """
+        This generator compute the ClearSMILES of molecules in a pool of processes
+        and yield them as they complete. The input is consumed lazily and at most
+        max_pending chunks are computed or waiting to be read at any time,
+        thus a slow consumer stops the reading of the input instead of piling up results.
+        When the consumer stops iterating, the chunks in flight are cancelled and
+        the workers still computing are terminated
+
+        Args:
+            smiles_iter (iterable of str): the SMILES, possibly an infinite generator
+            workers (int): number of worker processes, all the available cores if None,
+            computed in this process if 0
+            chunksize (int): number of molecules sent at once to a worker
+            max_pending (int): number of chunks in flight, twice the number of workers if None
+            ordered (bool): yield the results in the order of the input instead of
+            in completion order
+
+        yield:
+            result (ClearSmilesResult): the ClearSMILES of the next molecule
+        """
+        # declare local variables
+        workers = len(os.sched_getaffinity(0)) if workers is None else workers
+        smiles_iter = iter(smiles_iter)
+        if not workers:
+            yield from map(self.generate, smiles_iter)
+            return
+        max_pending = max_pending or 2 * workers
+        pending_deque = deque()
+
+        executor = ProcessPoolExecutor(workers, initializer=init_stream_worker,
+                                       initargs=(self,))
+        try:
+            while True:
+                # refill the window from the input
+                while len(pending_deque) < max_pending:
+                    smiles_list = list(islice(smiles_iter, chunksize))
+                    if not smiles_list:
+                        break
+                    pending_deque.append(executor.submit(generate_chunk, smiles_list))
+                if not pending_deque:
+                    return
+
+                # the first chunk submitted, or any completed chunk
+                if ordered:
+                    future = pending_deque.popleft()
+                else:
+                    future = wait(pending_deque, return_when=FIRST_COMPLETED).done.pop()
+                    pending_deque.remove(future)
+                yield from future.result()
+        finally:
+            # shutdown forgets the processes, and does not stop a running computation
+            processes_list = list(executor._processes.values())  # pylint: disable=W0212
+            executor.shutdown(wait=False, cancel_futures=True)
+            if pending_deque:
+                for process in processes_list:
+                    process.terminate()
+
+
+def init_stream_worker(generator: ClearSmilesGenerator) -> None:
+    """ keep the generator of a worker of ClearSmilesGenerator.stream """
+    STREAM_WORKER_STATE_DICT["generator"] = generator
+
+
+def generate_chunk(smiles_list: list) -> list:
+    """ the ClearSMILES of a chunk of molecules, in a worker of ClearSmilesGenerator.stream """
+    return STREAM_WORKER_STATE_DICT["generator"].generate_batch(smiles_list)
+
+
+def try_generate_chunk(smiles_list: list) -> list:
+    """ the ClearSMILES of a chunk of molecules in a worker of the service, a molecule
+    whose search fails gets a ClearSmilesError instead of failing the whole chunk """
+    # declare local variables
+    generator = STREAM_WORKER_STATE_DICT["generator"]
+    results_list = []
+
+    for smiles in smiles_list:
+        try:
+            results_list.append(generator.generate(smiles))
+        except (ValueError, RuntimeError, ArithmeticError, LookupError) as error:
+            results_list.append(ClearSmilesError(smiles, f"{type(error).__name__}: {error}"))
+
+    return results_list
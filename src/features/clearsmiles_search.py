@@ -0,0 +1,508 @@
+"""
+This module search the ClearSMILES of a molecule: the randomized kekule SMILES
+with the lowest maximum ring closure digit, then the lowest semantic memory score.
+The search is random, by batches with early stopping, or an exhaustive enumeration
+of the traversals, both stop once the graph derived lower bounds are reached
+"""
+from __future__ import annotations
+import sys
+import time
+import re
+from pathlib import Path
+from functools import partial
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+
+# heavy dependencies are imported on first use
+np = LazyModule("numpy")
+pa = LazyModule("pyarrow")
+Chem = LazyModule("rdkit.Chem")
+batch_scoring = LazyModule("features.batch_scoring")
+search_bounds = LazyModule("features.search_bounds")
+enumeration = LazyModule("features.exhaustive_search")
+
+# regex used to tokenize SMILES, the batched scoring engine applies the same rules
+SMILES_TOKENS_REGEX = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|" + \
+    r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+
+# batch size of the random search when a time budget is given without batch size,
+# the deadline is checked between batches
+BUDGET_BATCH_SIZE = 1000
+
+# maximum number of SMILES drawn from a root atom in a round of the stratified sampling,
+# a root atom whose whole round was already seen is retired
+STRATIFIED_ROUND_SIZE = 100
+
+
+def get_results_fields() -> list:
+    """ columns written by get_clearsmiles, the columns of the csv database are appended
+    as strings """
+    return [
+        ("nb_random", pa.int64()),
+        ("search_path", pa.string()),
+        ("nb_drawn", pa.int64()),
+        ("nb_enumerated_smiles", pa.int64()),
+        ("max_digit_lower_bound", pa.int64()),
+        ("mem_score_lower_bound", pa.float64()),
+        ("lower_bound_reached", pa.bool_()),
+        ("timed_out", pa.bool_()),
+        ("max_digit", pa.int64()),
+        ("lowest_mem_score", pa.float64()),
+        ("nb_unique_random_smiles", pa.int64()),
+        ("sampling_efficiency", pa.float64()),
+        ("nb_lowest_max_digit_smiles", pa.int64()),
+        ("nb_equivalent_solution", pa.int64()),
+        ("ClearSMILES_set", pa.list_(pa.string())),
+        ("ClearSMILES_mem_maps", pa.list_(pa.list_(pa.int8()))),
+        ("random_gen_time", pa.float64()),
+        ("min_max_digit_time", pa.float64()),
+        ("mem_map_time", pa.float64()),
+        ("enumeration_time", pa.float64()),
+        ("total_time", pa.float64()),
+        ("cache_hit", pa.bool_()),
+    ]
+
+
+def find_biggest_digits(smiles=str()):
+    """
+    find the biggest digits by iterating throught possible max digits 
+    and test if there is a match in string
+    input: smiles (string)
+    output: max_digit (integer)
+    """
+
+    # iterate through max digits possible solution
+    for i in range(1, 10):
+        digit = 10-i
+        if smiles.find(str(digit)) != -1:
+            return digit
+
+    return 0
+
+
+def get_semantic_mem_map(smiles: str, smiles_regex: re.compile) -> np.array:
+    """
+    This function will generate a semantic memory map of a SMILES, 
+    i.e the number of semantic feature open for every token. 
+    Semantic feature include  branches and  rings 
+        smiles (string) : a valid SMILES 
+        smiles_regex (compiled regular expression): compiled regular expression 
+        used to tokenize SMILES
+        bonds_set (set of strings): a set containing all the bonds tokens
+    output :
+        mem_map  (numpy array):  the semantic memory map of the input SMILES
+    """
+
+    # declare local variables
+    tokens_list = smiles_regex.findall(smiles)
+    mem_map = np.zeros(len(tokens_list), dtype=int)
+    digit_set = set()
+
+    # iterate throught tokens
+    for i, token in enumerate(tokens_list):
+        if token == "(":
+            mem_map[i] += 1
+        elif token == ")":
+            mem_map[i] -= 1
+        elif token.isdigit():
+            if token in digit_set:
+                digit_set.remove(token)
+                mem_map[i] -= 1
+            else:
+                digit_set.add(token)
+                mem_map[i] += 1
+
+    return mem_map.cumsum()
+
+
+def update_clearsmiles_sets(results_dict: dict,
+                            clearsmiles_set: set,
+                            smiles_list: list) -> None:
+    """
+    This function update the running best solutions with a list of new unique SMILES,
+    the max digit and the semantic memory score of all the SMILES are computed at once
+
+    Args:
+        results_dict (dict): results dict of get_clearsmiles, updated in place
+        clearsmiles_set (set of strings): the current ClearSMILES, updated in place
+        smiles_list (list of strings): randomized kekule SMILES never scored before
+    """
+    # find SMILES with lowest maximum digit, all candidates are scored at once
+    start_time = time.perf_counter()
+    buffer, offsets = batch_scoring.pack_smiles(smiles_list)
+    max_digit_array = batch_scoring.batch_find_biggest_digits(buffer, offsets)
+    batch_max_digit = int(max_digit_array.min())
+
+    # if a new minimum is reached, the previous solutions are discarded
+    if batch_max_digit < results_dict["max_digit"]:
+        results_dict["max_digit"] = batch_max_digit
+        results_dict["nb_lowest_max_digit_smiles"] = 0
+        results_dict["lowest_mem_score"] = np.inf
+        clearsmiles_set.clear()
+
+    # discard SMILES if above current threshold
+    lowest_digit_smiles_list = [rd_smiles for rd_smiles, is_lowest in
+                                zip(smiles_list, max_digit_array == results_dict["max_digit"])
+                                if is_lowest]
+    results_dict["nb_lowest_max_digit_smiles"] += len(lowest_digit_smiles_list)
+    results_dict["min_max_digit_time"] += time.perf_counter() - start_time
+    if not lowest_digit_smiles_list:
+        return
+
+    # Keep SMILES with lowest maximum digit for which the semantic memory score is minimal
+    start_time = time.perf_counter()
+    buffer, offsets = batch_scoring.pack_smiles(lowest_digit_smiles_list)
+    mem_score_array = batch_scoring.batch_semantic_mem_score(buffer, offsets)
+    batch_mem_score = mem_score_array.min()
+
+    # if a new minimum is reached, clear the set
+    if batch_mem_score < results_dict["lowest_mem_score"]:
+        results_dict["lowest_mem_score"] = batch_mem_score
+        clearsmiles_set.clear()
+
+    # discard SMILES if mem score threshold is passed
+    clearsmiles_set.update(ld_smiles for ld_smiles, is_lowest in
+                           zip(lowest_digit_smiles_list,
+                               mem_score_array == results_dict["lowest_mem_score"])
+                           if is_lowest)
+    results_dict["mem_map_time"] += time.perf_counter() - start_time
+
+
+def update_unique_clearsmiles_sets(results_dict: dict,
+                                   clearsmiles_set: set,
+                                   seen_smiles_set: set,
+                                   smiles_list: list) -> None:
+    """
+    This function update the running best solutions with the SMILES never scored before
+
+    Args:
+        results_dict (dict): results dict of get_clearsmiles, updated in place
+        clearsmiles_set (set of strings): the current ClearSMILES, updated in place
+        seen_smiles_set (set of strings): the SMILES already scored, updated in place
+        smiles_list (list of strings): SMILES, possibly already scored
+    """
+    new_smiles_set = set(smiles_list)
+    new_smiles_set.difference_update(seen_smiles_set)
+    seen_smiles_set.update(new_smiles_set)
+    if new_smiles_set:
+        update_clearsmiles_sets(results_dict, clearsmiles_set, list(new_smiles_set))
+
+
+def get_kekule_mol(mol: Chem.Mol) -> Chem.Mol:
+    """ copy of the molecule with the kekule structure written by the rdkit writer,
+    the writer does not kekulize it again for every SMILES """
+    kekule_mol = Chem.Mol(mol)
+    Chem.Kekulize(kekule_mol, clearAromaticFlags=True)
+
+    return kekule_mol
+
+
+def get_symmetry_class_roots(kekule_mol: Chem.Mol) -> list:
+    """
+    This function select one root atom per symmetry class, symmetric atoms
+    start exactly the same set of randomized SMILES. The randomized kekule SMILES
+    are written from a single kekule structure, hence the symmetry classes are computed
+    on the kekulized molecule
+
+    Args:
+        kekule_mol (Chem.Mol): an rdkit molecule, kekulized by get_kekule_mol
+
+    return:
+        root_atoms_list (list of integers): the index of one atom per symmetry class
+    """
+    # declare local variables
+    root_dict = {}
+    symmetry_classes = Chem.CanonicalRankAtoms(kekule_mol, breakTies=False)
+
+    # keep the first atom of every class
+    for atom_idx, symmetry_class in enumerate(symmetry_classes):
+        root_dict.setdefault(symmetry_class, atom_idx)
+
+    return sorted(root_dict.values())
+
+
+def draw_stratified_smiles(kekule_mol: Chem.Mol, root_atoms_list: list, nb_draw: int,
+                           seen_smiles_set: set) -> tuple:
+    """
+    This function spread the draws of randomized kekule SMILES evenly over the root atoms,
+    by rounds of at most STRATIFIED_ROUND_SIZE SMILES per root atom. A root atom whose
+    whole round was already seen is exhausted, it is retired at once and its share
+    of the draws goes to the root atoms left. The SMILES of a root atom are written
+    from the kekulized molecule with a single set of writer parameters
+
+    Args:
+        kekule_mol (Chem.Mol): an rdkit molecule, kekulized by get_kekule_mol
+        root_atoms_list (list of integers): the root atoms to draw from
+        nb_draw (integer): the maximum number of randomized kekule SMILES to draw
+        seen_smiles_set (set of strings): the SMILES drawn by the previous batches
+
+    return:
+        smiles_list (list of strings): the randomized kekule SMILES drawn, fewer than nb_draw
+        if every root atom was exhausted
+        root_atoms_list (list of integers): the root atoms which are not exhausted
+    """
+    # declare local variables
+    smiles_list = []
+    drawn_smiles_set = set()
+    writer_params = Chem.SmilesWriteParams()
+    writer_params.doRandom = True
+    writer_params.canonical = False
+
+    while len(smiles_list) < nb_draw and root_atoms_list:
+        # declare loop variables
+        nb_draw_per_root = min(STRATIFIED_ROUND_SIZE,
+                               -(-(nb_draw - len(smiles_list)) // len(root_atoms_list)))
+        active_roots_list = []
+
+        for root_idx in root_atoms_list:
+            nb_round_draw = min(nb_draw_per_root, nb_draw - len(smiles_list))
+            writer_params.rootedAtAtom = root_idx
+            round_smiles_list = [Chem.MolToSmiles(kekule_mol, writer_params)
+                                 for _ in range(nb_round_draw)]
+            smiles_list += round_smiles_list
+
+            # a truncated last round does not retire its root atom
+            if nb_round_draw < nb_draw_per_root or \
+                    any(smiles not in seen_smiles_set and smiles not in drawn_smiles_set
+                        for smiles in round_smiles_list):
+                active_roots_list.append(root_idx)
+            drawn_smiles_set.update(round_smiles_list)
+        root_atoms_list = active_roots_list
+
+    return smiles_list, root_atoms_list
+
+
+def get_clearsmiles(params_dict: dict,
+                    nb_random: int,
+                    smiles_regex: re.compile,
+                    batch_size: int = None,
+                    patience: int = 3,
+                    search: str = "random",
+                    max_exhaustive_atoms: int = 30,
+                    exhaustive_time_limit: float = 60.0,
+                    max_closure_orders: int = 64,
+                    sampling: str = "uniform",
+                    store_mem_maps: bool = False,
+                    time_budget: float = None) -> dict:
+    """
+    This function will get a set of ClearSMILES, this is a stochastic process, 
+    thus the number of ClearSMILES may vary. A high number of random search  should yield 
+    a stable number of ClearSMILES.
+    The random search can be done by batches, in which case it stops as soon as the
+    lowest max digit, the lowest memory score and the set of ClearSMILES
+    did not change for patience consecutive batches.
+    The search also stops once the graph derived lower bounds are reached,
+    and acyclic unbranched molecules are directly written from both of their ends.
+    The exhaustive search enumerates every traversal of the molecule with branch-and-bound,
+    written with the kekule structure of the rdkit writer, the set of ClearSMILES is then
+    the exact set of the random search. It falls back to the random search above
+    max_exhaustive_atoms, after exhaustive_time_limit, or when the molecule
+    has stereochemistry or several fragments, the random search then skips the SMILES
+    already enumerated.
+    The stratified sampling draws from one root atom per symmetry class by rounds,
+    and stops drawing from a root atom once a whole round of its SMILES were already seen.
+    With a time budget, the deadline is checked between batches and caps the exhaustive
+    search, a molecule running out of time returns its best-so-far ClearSMILES
+    input :
+        smiles (string): a valid SMILES 
+        nb_random (integer): the number of randomized kekule SMILES to generate,
+        i.e the number of random search, it is the hard cap when using batches
+        smiles_regex (compiled regex):  regex pattern used to tokenize SMILES,
+        the batched scoring engine applies the same tokenization rules
+        batch_size (integer): optional, number of randomized kekule SMILES per batch,
+        by default all the SMILES are generated in one batch
+        patience (integer): number of batches without improvement before stopping
+        search (string): either "random" or "exhaustive"
+        max_exhaustive_atoms (integer): number of atoms above which the exhaustive search
+        falls back to the random search
+        exhaustive_time_limit (float): duration in seconds after which the exhaustive search
+        falls back to the random search
+        max_closure_orders (integer): maximal number of ring closure orders written
+        per traversal by the exhaustive search, the search is truncated above
+        sampling (string): either "uniform" (random root atom) or "stratified"
+        (draws spread over the symmetry classes of root atoms)
+        store_mem_maps (bool): also return the semantic memory map of every ClearSMILES
+        time_budget (float): optional, wall clock budget of the molecule in seconds,
+        without batch_size the random search is done by batches of BUDGET_BATCH_SIZE
+        without early stopping
+    output: 
+    results dict with string as keys and  various type of values 
+         nb_random  input is pass as such in 
+        search_path (string), the search actually used : linear, exhaustive, random,
+        or exhaustive_truncated when the ring closure orders of a traversal were capped
+        nb_drawn (integer), number of randomized kekule SMILES actually generated
+        nb_enumerated_smiles (integer), number of SMILES written by the exhaustive search
+        max_digit_lower_bound (integer), lower bound of the max digit for this molecule
+        mem_score_lower_bound (float), lower bound of the semantic memory score
+        lower_bound_reached (bool), True if the search stopped on the lower bounds
+        timed_out (bool), True if the search stopped on the time budget,
+        the ClearSMILES are then the best found so far
+        max digit (integer), indicating the lowest maximum digit found in random SMILES
+        lowest_mem_score (float), indicates the lowest score obtained 
+        by one or more ClearSMILES, currently the mean of semantic memory per token
+        nb_unique_random_smiles (integer), number of unique randomized kekule SMILES
+        found by random search, without the SMILES already enumerated
+        sampling_efficiency (float), nb_unique_random_smiles divided by nb_drawn
+        nb_lowest_max_digit_smiles (integer), number of randomized kekule SMILES 
+        with the lowest max digit found
+        nb_equivalent_solution  (integer) , which indicate the number of solution 
+        which achieved the lowest memory score 
+        ClearSMILES_set, value is (list of strings): the sorted ClearSMILES
+        ClearSMILES_mem_maps (list of lists of integers): the semantic memory map of every
+        ClearSMILES, in the same order, None unless store_mem_maps is True
+        all keys including keyword time contains the duration of each stage of the pipeline,
+        and value associated are float
+
+    """
+    # assert that there is a smiles key
+    assert "SMILES" in params_dict, " the SMILES key was not found in param_dict \
+        please, ensure that the columns with smiles is named as SMILES in uppercase"
+
+    # declare local variable
+    mol = Chem.MolFromSmiles(params_dict["SMILES"])
+    seen_smiles_set = set()
+    clearsmiles_set = set()
+    if time_budget is not None and batch_size is None:
+        batch_size, patience = BUDGET_BATCH_SIZE, nb_random
+    batch_size = batch_size or nb_random
+    nb_stable_batch = 0
+    kekule_mol = get_kekule_mol(mol) if sampling == "stratified" else None
+    root_atoms_list = get_symmetry_class_roots(kekule_mol) if kekule_mol is not None else None
+    results_dict = {
+        "nb_random": nb_random,
+        "search_path": "random",
+        "nb_drawn": 0,
+        "nb_enumerated_smiles": 0,
+        "max_digit_lower_bound": int,
+        "mem_score_lower_bound": float,
+        "lower_bound_reached": False,
+        "timed_out": False,
+        "max_digit": 9,
+        "lowest_mem_score": np.inf,
+        "nb_unique_random_smiles": int,
+        "sampling_efficiency": float,
+        "nb_lowest_max_digit_smiles": 0,
+        "nb_equivalent_solution": 0,
+        "ClearSMILES_set": list,
+        "ClearSMILES_mem_maps": None,
+        "random_gen_time": 0.0,
+        "min_max_digit_time": 0.0,
+        "mem_map_time": 0.0,
+        "enumeration_time": 0.0,
+        # neglect the time to instantiate mol + empty sets
+        "total_time": time.perf_counter(),
+    }
+    results_dict.update(params_dict)
+    deadline = results_dict["total_time"] + time_budget if time_budget is not None else None
+
+    # get the theoretical optimum of the molecule
+    bounds_dict = search_bounds.compute_lower_bounds(mol)
+    results_dict["max_digit_lower_bound"] = bounds_dict["max_digit"]
+    results_dict["mem_score_lower_bound"] = bounds_dict["mem_score"]
+
+    # SMILES of acyclic unbranched molecules written from one end are already optimal
+    if bounds_dict["is_linear"]:
+        linear_smiles_set = {Chem.MolToSmiles(mol, rootedAtAtom=atom.GetIdx(),
+                                              canonical=False, kekuleSmiles=True)
+                             for atom in mol.GetAtoms() if atom.GetDegree() <= 1}
+        update_clearsmiles_sets(results_dict, clearsmiles_set, list(linear_smiles_set))
+        results_dict["lower_bound_reached"] = True
+        results_dict["search_path"] = "linear"
+
+    # enumerate all traversals, scoring time is included in the enumeration time
+    elif search == "exhaustive" and \
+            enumeration.is_exhaustive_search_possible(mol, max_exhaustive_atoms):
+        start_time = time.perf_counter()
+        enumerated_smiles_set = set()
+        is_completed, results_dict["nb_enumerated_smiles"], is_truncated = \
+            enumeration.exhaustive_search(
+                mol=mol,
+                bounds_dict=bounds_dict,
+                results_dict=results_dict,
+                flush_callback=partial(update_unique_clearsmiles_sets, results_dict,
+                                       clearsmiles_set, enumerated_smiles_set),
+                time_limit=exhaustive_time_limit if deadline is None else
+                max(min(exhaustive_time_limit, deadline - start_time), 0.0),
+                max_closure_orders=max_closure_orders)
+        results_dict["enumeration_time"] = time.perf_counter() - start_time
+        # some ring closure orders were skipped, the set of ClearSMILES may be incomplete
+        exhaustive_path = "exhaustive_truncated" if is_truncated else "exhaustive"
+        if is_completed:
+            results_dict["search_path"] = exhaustive_path
+            results_dict["lower_bound_reached"] = bool(
+                results_dict["max_digit"] <= bounds_dict["max_digit"] and
+                results_dict["lowest_mem_score"] <= bounds_dict["mem_score"])
+
+        # the partial enumeration is kept rather than falling back to the random search
+        elif deadline is not None and time.perf_counter() >= deadline and clearsmiles_set:
+            results_dict["search_path"] = exhaustive_path
+            results_dict["timed_out"] = True
+
+        # the random search does not score the enumerated SMILES again
+        else:
+            seen_smiles_set.update(enumerated_smiles_set)
+    nb_enumerated_seen = len(seen_smiles_set)
+
+    # random search by batches until convergence, lower bounds or hard cap
+    while results_dict["search_path"] == "random" and results_dict["nb_drawn"] < nb_random \
+            and nb_stable_batch < patience and not results_dict["lower_bound_reached"]:
+
+        # the budget is only checked once some ClearSMILES were found
+        if deadline is not None and clearsmiles_set and time.perf_counter() >= deadline:
+            results_dict["timed_out"] = True
+            break
+
+        # declare loop variable
+        nb_draw = min(batch_size, nb_random - results_dict["nb_drawn"])
+        previous_state = (results_dict["max_digit"],
+                          results_dict["lowest_mem_score"],
+                          len(clearsmiles_set))
+
+        # generate randomized kekule SMILES
+        start_time = time.perf_counter()
+        if root_atoms_list is None:
+            randomized_kekule_smiles_list = Chem.MolToRandomSmilesVect(mol, nb_draw,
+                                                                       kekuleSmiles=True)
+        else:
+            # root atoms which only yield already seen SMILES are exhausted
+            randomized_kekule_smiles_list, root_atoms_list = draw_stratified_smiles(
+                kekule_mol, root_atoms_list, nb_draw, seen_smiles_set)
+        results_dict["nb_drawn"] += len(randomized_kekule_smiles_list)
+        results_dict["random_gen_time"] += time.perf_counter() - start_time
+
+        # only new SMILES are scored, sets only grow when the best scores are unchanged,
+        # hence comparing sizes is enough
+        update_unique_clearsmiles_sets(results_dict, clearsmiles_set, seen_smiles_set,
+                                       randomized_kekule_smiles_list)
+        if previous_state == (results_dict["max_digit"],
+                              results_dict["lowest_mem_score"],
+                              len(clearsmiles_set)):
+            nb_stable_batch += 1
+        else:
+            nb_stable_batch = 0
+        results_dict["lower_bound_reached"] = bool(
+            results_dict["max_digit"] <= bounds_dict["max_digit"] and
+            results_dict["lowest_mem_score"] <= bounds_dict["mem_score"])
+
+        # every traversal was already drawn
+        if root_atoms_list == []:
+            break
+    results_dict["nb_unique_random_smiles"] = len(seen_smiles_set) - nb_enumerated_seen
+    results_dict["sampling_efficiency"] = results_dict["nb_unique_random_smiles"] / \
+        results_dict["nb_drawn"] if results_dict["nb_drawn"] else np.nan
+
+    # sorted list of ClearSMILES, "_" is a SMILES token and can not be used as a separator
+    results_dict["ClearSMILES_set"] = sorted(clearsmiles_set)
+    results_dict["nb_equivalent_solution"] = len(clearsmiles_set)
+    if store_mem_maps:
+        results_dict["ClearSMILES_mem_maps"] = [
+            get_semantic_mem_map(clearsmiles, smiles_regex).tolist()
+            for clearsmiles in results_dict["ClearSMILES_set"]]
+
+    # compute total time duration
+    results_dict["total_time"] = time.perf_counter() - \
+        results_dict["total_time"]
+
+    return results_dict
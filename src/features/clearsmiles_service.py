@@ -0,0 +1,442 @@
+"""
+This script is a local generation service of ClearSMILES, for online augmentation
+during the training of models: a small asyncio HTTP server, on a loopback address
+or on a Unix socket, answering with the ClearSMILES of the requested molecules.
+Concurrent requests are collected into micro-batches computed by a pool of processes,
+identical molecules in flight are computed once, and the results of the recent molecules
+are served from an in-memory LRU cache keyed by canonical SMILES.
+The latency of the requests, the depth of the queue and the size of the batches
+are exposed on /metrics.
+Requests : POST /clearsmiles with a json body {"smiles": ["CCO", ...]}, GET /metrics
+"""
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import ipaddress
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import argparse
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+from features.run_metrics import summarize_values
+from features.clearsmiles_generator import ClearSmilesGenerator, ClearSmilesError, \
+    init_stream_worker, try_generate_chunk
+
+# heavy dependencies are imported on first use
+Chem = LazyModule("rdkit.Chem")
+
+# number of latencies kept for the percentiles of /metrics
+NB_LATENCIES = 10_000
+HTTP_REASONS_DICT = {200: "OK", 400: "Bad Request", 404: "Not Found",
+                     405: "Method Not Allowed", 413: "Payload Too Large",
+                     500: "Internal Server Error"}
+MAX_BODY_SIZE = 16 << 20
+
+
+def is_loopback(host: str) -> bool:
+    """ whether a host name resolves to a loopback address """
+    return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+
+
+def get_canonical_smiles(smiles: str) -> str:
+    """ canonical SMILES of a molecule, None if the SMILES is invalid """
+    mol = Chem.MolFromSmiles(smiles) if isinstance(smiles, str) and smiles else None
+
+    return Chem.MolToSmiles(mol) if mol is not None else None
+
+
+class ClearSmilesService:
+    """
+    This class hold the state of the service: the process pool, the queue of molecules
+    waiting for a batch, the molecules in flight, the LRU cache and the metrics
+    """
+
+    def __init__(self, generator: ClearSmilesGenerator, workers: int = None,
+                 max_batch_size: int = 32, max_wait: float = 0.005,
+                 cache_size: int = 100_000, max_pending_batches: int = None):
+        """
+        Args:
+            generator (ClearSmilesGenerator): the search parameters
+            workers (int): number of worker processes, all the available cores if None
+            max_batch_size (int): number of molecules per batch
+            max_wait (float): duration in seconds a batch waits for more molecules
+            cache_size (int): number of molecules kept in the LRU cache
+            max_pending_batches (int): number of batches in the pool,
+            twice the number of workers if None
+        """
+        self.generator = generator
+        self.workers = workers or len(os.sched_getaffinity(0))
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.max_pending_batches = max_pending_batches or 2 * self.workers
+        self.cache_dict = OrderedDict()
+        self.in_flight_dict = {}
+        self.executor = None
+        self.queue = None
+        self.batch_semaphore = None
+        self.batcher_task = None
+        self.batch_tasks_set = set()
+        self.metrics_dict = {
+            "nb_requests": 0,
+            "nb_molecules": 0,
+            "nb_invalid": 0,
+            "nb_cache_hits": 0,
+            "nb_coalesced": 0,
+            "nb_computed": 0,
+            "nb_failed_molecules": 0,
+            "nb_batches": 0,
+            "nb_failed_batches": 0,
+            "nb_pool_restarts": 0,
+            "max_queue_depth": 0,
+            "latencies": deque(maxlen=NB_LATENCIES),
+            "batch_sizes": deque(maxlen=NB_LATENCIES),
+        }
+
+    def start_executor(self) -> None:
+        """ start the process pool, also used to replace a broken pool """
+        # forked workers would inherit the sockets of the open connections
+        # and keep them open after the service closed them
+        self.executor = ProcessPoolExecutor(self.workers,
+                                            mp_context=multiprocessing.get_context("forkserver"),
+                                            initializer=init_stream_worker,
+                                            initargs=(self.generator,))
+
+    async def start(self) -> None:
+        """ start the pool and the batcher, in the running event loop """
+        self.start_executor()
+        self.queue = asyncio.Queue()
+        self.batch_semaphore = asyncio.Semaphore(self.max_pending_batches)
+        self.batcher_task = asyncio.create_task(self.run_batcher())
+
+    async def close(self) -> None:
+        """ stop the batcher and the pool, the molecules in flight are cancelled """
+        self.batcher_task.cancel()
+        for future in self.in_flight_dict.values():
+            future.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def get_result(self, canonical_smiles: str) -> tuple:
+        """
+        This method get the ClearSMILES of a molecule, from the cache, from the same
+        molecule in flight, or from a new computation
+
+        Args:
+            canonical_smiles (str): the canonical SMILES of the molecule
+
+        return:
+            (result, source) (tuple): the ClearSmilesResult, or the ClearSmilesError
+            of a failed search, and "cache", "coalesced" or "computed"
+        """
+        # the most recently used molecules are at the end
+        if canonical_smiles in self.cache_dict:
+            self.cache_dict.move_to_end(canonical_smiles)
+            self.metrics_dict["nb_cache_hits"] += 1
+            return self.cache_dict[canonical_smiles], "cache"
+
+        if canonical_smiles in self.in_flight_dict:
+            self.metrics_dict["nb_coalesced"] += 1
+            return await asyncio.shield(self.in_flight_dict[canonical_smiles]), "coalesced"
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight_dict[canonical_smiles] = future
+        self.queue.put_nowait(canonical_smiles)
+        self.metrics_dict["max_queue_depth"] = max(self.metrics_dict["max_queue_depth"],
+                                                   self.queue.qsize())
+
+        return await asyncio.shield(future), "computed"
+
+    async def run_batcher(self) -> None:
+        """ collect the queued molecules into batches, a batch is sent once full
+        or max_wait seconds after its first molecule """
+        loop = asyncio.get_running_loop()
+        while True:
+            smiles_list = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(smiles_list) < self.max_batch_size:
+                try:
+                    smiles_list.append(await asyncio.wait_for(self.queue.get(),
+                                                              deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+
+            # the queue grows while the pool is busy
+            await self.batch_semaphore.acquire()
+            batch_task = asyncio.create_task(self.run_batch(smiles_list))
+            self.batch_tasks_set.add(batch_task)
+            batch_task.add_done_callback(self.batch_tasks_set.discard)
+
+    async def run_batch(self, smiles_list: list) -> None:
+        """ compute a batch in the pool, then answer and cache its molecules,
+        a molecule whose search failed is cached with its error, the molecules
+        of a failed batch get a RuntimeError """
+        # declare local variables
+        executor = self.executor
+
+        try:
+            results_list = await asyncio.get_running_loop().run_in_executor(
+                executor, try_generate_chunk, smiles_list)
+        # the requests wait for the molecules of the batch, every error of the pool
+        # must reach them, otherwise they would never be answered
+        except Exception as error:  # pylint: disable=W0718
+            self.metrics_dict["nb_failed_batches"] += 1
+            # a dead worker breaks the whole pool, the batches sent to it fail together
+            # and the first of them replaces it
+            if isinstance(error, BrokenProcessPool) and self.executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.start_executor()
+                self.metrics_dict["nb_pool_restarts"] += 1
+            for smiles in smiles_list:
+                future = self.in_flight_dict.pop(smiles)
+                if not future.done():
+                    future.set_exception(RuntimeError(f"batch failed: {error!r}"))
+            return
+        finally:
+            self.batch_semaphore.release()
+        self.metrics_dict["nb_batches"] += 1
+        self.metrics_dict["nb_computed"] += len(smiles_list)
+        self.metrics_dict["nb_failed_molecules"] += sum(
+            isinstance(result, ClearSmilesError) for result in results_list)
+        self.metrics_dict["batch_sizes"].append(len(smiles_list))
+
+        for smiles, result in zip(smiles_list, results_list):
+            self.cache_dict[smiles] = result
+            future = self.in_flight_dict.pop(smiles)
+            if not future.done():
+                future.set_result(result)
+        while len(self.cache_dict) > self.cache_size:
+            self.cache_dict.popitem(last=False)
+
+    async def answer(self, smiles_list: list) -> list:
+        """
+        This method get the ClearSMILES of the molecules of a request, concurrently
+
+        Args:
+            smiles_list (list of str): the requested SMILES
+
+        return:
+            answers_list (list of dict): a json object per molecule,
+            with an error for invalid SMILES and failed searches
+        """
+        # declare local variables
+        canonical_smiles_list = [get_canonical_smiles(smiles) for smiles in smiles_list]
+        self.metrics_dict["nb_molecules"] += len(smiles_list)
+        self.metrics_dict["nb_invalid"] += canonical_smiles_list.count(None)
+
+        outputs_list = await asyncio.gather(*[self.get_result(canonical_smiles)
+                                              for canonical_smiles in canonical_smiles_list
+                                              if canonical_smiles is not None])
+        outputs_iter = iter(outputs_list)
+        answers_list = []
+        for smiles, canonical_smiles in zip(smiles_list, canonical_smiles_list):
+            if canonical_smiles is None:
+                answers_list.append({"smiles": smiles, "error": "invalid SMILES"})
+                continue
+            result, source = next(outputs_iter)
+            if isinstance(result, ClearSmilesError):
+                answers_list.append({"smiles": smiles,
+                                     "canonical_smiles": canonical_smiles,
+                                     "error": result.error,
+                                     "source": source})
+                continue
+            answers_list.append({"smiles": smiles,
+                                 "canonical_smiles": canonical_smiles,
+                                 "clearsmiles": list(result.clearsmiles),
+                                 "max_digit": result.max_digit,
+                                 "lowest_mem_score": result.lowest_mem_score,
+                                 "timed_out": result.timed_out,
+                                 "source": source})
+
+        return answers_list
+
+    def get_metrics(self) -> dict:
+        """ counters, current queue depth, and summaries of the latencies in seconds
+        and of the batch sizes """
+        metrics_dict = {key: value for key, value in self.metrics_dict.items()
+                        if not isinstance(value, deque)}
+        metrics_dict.update({
+            "queue_depth": self.queue.qsize(),
+            "nb_in_flight": len(self.in_flight_dict),
+            "nb_pending_batches": len(self.batch_tasks_set),
+            "nb_cached": len(self.cache_dict),
+            "latency": summarize_values(list(self.metrics_dict["latencies"])),
+            "batch_size": summarize_values(list(self.metrics_dict["batch_sizes"])),
+        })
+
+        return metrics_dict
+
+    async def handle_request(self, method: str, path: str, body: bytes) -> tuple:
+        """ route a request, return the status and the json answer """
+        if path == "/metrics":
+            return 200, self.get_metrics()
+        if path != "/clearsmiles":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        try:
+            smiles_list = json.loads(body)["smiles"]
+        except (ValueError, KeyError, TypeError):
+            smiles_list = None
+        if isinstance(smiles_list, str):
+            smiles_list = [smiles_list]
+        if not isinstance(smiles_list, list) or \
+                not all(isinstance(smiles, str) for smiles in smiles_list):
+            return 400, {"error": 'the body must be a json object {"smiles": [...]} '
+                                  'with a list of strings'}
+
+        try:
+            return 200, {"results": await self.answer(smiles_list)}
+        except RuntimeError as error:
+            return 500, {"error": f"generation failed: {error}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """ answer the HTTP/1.1 requests of a connection, kept alive until the client closes it """
+        try:
+            while request_line := await reader.readline():
+                start_time = time.perf_counter()
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers_dict = {}
+                while (header_line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    headers_dict[name.strip().lower()] = value.strip()
+                content_length = int(headers_dict.get("content-length", 0))
+                if content_length > MAX_BODY_SIZE:
+                    status, answer_dict = 413, {"error": "request too large"}
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, answer_dict = await self.handle_request(method, path, body)
+
+                # the metrics requests are not counted
+                if path != "/metrics":
+                    self.metrics_dict["nb_requests"] += 1
+                    self.metrics_dict["latencies"].append(time.perf_counter() - start_time)
+                payload = json.dumps(answer_dict).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS_DICT[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") +
+                             payload)
+                await writer.drain()
+                if headers_dict.get("connection", "").lower() == "close" or status == 413:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service: ClearSmilesService, host: str = "127.0.0.1", port: int = 8765,
+                unix_socket: str = None, ready_callback=None) -> None:
+    """
+    This function run the service until it is cancelled
+
+    Args:
+        service (ClearSmilesService): the service, started by this function
+        host (str): a loopback address, other addresses are refused
+        port (int): the port, 0 for any free port
+        unix_socket (str): optional, path of a Unix socket used instead of host and port
+        ready_callback (callable): optional, called with the server once it listens
+    """
+    await service.start()
+    try:
+        if unix_socket:
+            server = await asyncio.start_unix_server(service.handle_connection, path=unix_socket)
+        else:
+            if not is_loopback(host):
+                raise ValueError(f"{host} is not a loopback address, the service is local only")
+            server = await asyncio.start_server(service.handle_connection, host, port)
+        async with server:
+            if ready_callback is not None:
+                ready_callback(server)
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # network arguments
+    parser.add_argument('--host', help="loopback address of the service",
+                        default="127.0.0.1",
+                        type=str)
+    parser.add_argument('--port', help="port of the service",
+                        default=8765,
+                        type=int)
+    parser.add_argument('--unix_socket', help="path of a Unix socket used instead of the port",
+                        default=None,
+                        type=str)
+
+    # computation arguments
+    parser.add_argument('--workers', help="number of worker processes, \
+                        all the available cores by default",
+                        default=None,
+                        type=int)
+    parser.add_argument('--max_batch_size', help="number of molecules per batch of a worker",
+                        default=32,
+                        type=int)
+    parser.add_argument('--max_wait_ms', help="duration in milliseconds a batch waits \
+                        for more molecules",
+                        default=5.0,
+                        type=float)
+    parser.add_argument('--cache_size', help="number of molecules kept in the LRU cache",
+                        default=100_000,
+                        type=int)
+
+    # search arguments, see generate_clearsmiles.py
+    parser.add_argument('--nb_random', help="number of randomized kekule SMILES to use",
+                        default=10_000,
+                        type=int)
+    parser.add_argument('--batch_size', help="number of randomized kekule SMILES per batch",
+                        default=1_000,
+                        type=int)
+    parser.add_argument('--patience', help="number of batches without any change of the \
+                        ClearSMILES before stopping the random search",
+                        default=3,
+                        type=int)
+    parser.add_argument('--search', help="random search or exhaustive enumeration",
+                        default="random",
+                        choices=["random", "exhaustive"],
+                        type=str)
+    parser.add_argument('--sampling', help="uniform or stratified sampling of the root atoms",
+                        default="uniform",
+                        choices=["uniform", "stratified"],
+                        type=str)
+    parser.add_argument('--time_budget', help="wall clock budget of a molecule in seconds",
+                        default=None,
+                        type=float)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # execute
+    clearsmiles_service = ClearSmilesService(
+        generator=ClearSmilesGenerator(nb_random=args_dict["nb_random"],
+                                       batch_size=args_dict["batch_size"],
+                                       patience=args_dict["patience"],
+                                       search=args_dict["search"],
+                                       sampling=args_dict["sampling"],
+                                       time_budget=args_dict["time_budget"]),
+        workers=args_dict["workers"],
+        max_batch_size=args_dict["max_batch_size"],
+        max_wait=args_dict["max_wait_ms"] / 1000,
+        cache_size=args_dict["cache_size"])
+    try:
+        asyncio.run(serve(clearsmiles_service, host=args_dict["host"], port=args_dict["port"],
+                          unix_socket=args_dict["unix_socket"],
+                          ready_callback=lambda server: print(
+                              f"serving ClearSMILES on {server.sockets[0].getsockname()}")))
+    except KeyboardInterrupt:
+        pass
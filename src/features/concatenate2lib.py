@@ -1,43 +1,240 @@
-""" This script is used to concatenate all the subset 
-from the experiment into a unique database
+""" This script is used to concatenate all the subset
+from the experiment into a unique database.
+The subsets are read as a pyarrow dataset and written batch by batch,
+thus the memory used does not depend on the size of the database
 """
 import os
+import sys
 from pathlib import Path
 import argparse
 import glob
-from multiprocessing import Pool
-import pandas as pd
+import zlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 
+# name of the partitioning column of a partitioned database
+PARTITION_KEY = "partition"
+# separator of the ClearSMILES written by older versions as a single string
+LEGACY_SEPARATOR = "_"
 
-def main(search_pattern: str, output_filepath: str , use_multiprocessing : bool) -> None:
+
+def unify_subset_schemas(subset_path_list: list) -> pa.Schema:
+    """
+    This function unify the schemas of the subsets, only the parquet footers are read.
+    Types inferred from the content of a subset may differ between subsets:
+    null columns take the type of the other subsets, integers are promoted to floats,
+    strings written by older versions are promoted to lists of strings,
+    and any other conflict between scalar types is resolved as strings.
+    A conflict involving another nested type, e.g. the memory maps, cannot be resolved
+
+    Args:
+        subset_path_list (list of strings): the paths of the subsets
+
+    return:
+        schema (pa.Schema): a schema every subset can be cast to, the columns are ordered
+        by first appearance
+    """
+    # declare local variables
+    types_dict = {}
+
+    # collect the types of every column
+    for subset_path in subset_path_list:
+        for field in pq.read_schema(subset_path):
+            # parquet names the list items "element", arrow names them "item"
+            field_type = field.type
+            if pa.types.is_list(field_type):
+                field_type = pa.list_(field_type.value_type)
+            types_dict.setdefault(field.name, set()).add(field_type)
+
+    # resolve the conflicts
+    fields_list = []
+    for name, types_set in types_dict.items():
+        types_set.discard(pa.null())
+        if len(types_set) == 1:
+            field_type = types_set.pop()
+        elif not types_set:
+            field_type = pa.null()
+        elif all(pa.types.is_integer(field_type) or pa.types.is_floating(field_type)
+                 for field_type in types_set):
+            field_type = pa.int64() if all(pa.types.is_integer(field_type)
+                                           for field_type in types_set) else pa.float64()
+        elif types_set == {pa.string(), pa.list_(pa.string())}:
+            field_type = pa.list_(pa.string())
+        elif not any(pa.types.is_nested(field_type) for field_type in types_set):
+            field_type = pa.string()
+        else:
+            raise ValueError(f"the column {name} has the types "
+                             f"{sorted(str(field_type) for field_type in types_set)} "
+                             f"in the subsets, which cannot be cast to a common type")
+        fields_list.append((name, field_type))
+
+    return pa.schema(fields_list)
+
+
+def conform_batch(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    """
+    This function cast a batch of a subset to the unified schema,
+    missing columns are filled with nulls and legacy "_" joined strings are split in lists
+
+    Args:
+        batch (pa.RecordBatch): a batch read from a subset
+        schema (pa.Schema): the schema built by unify_subset_schemas
+
+    return:
+        batch (pa.RecordBatch): the batch with the unified schema
+    """
+    # declare local variables
+    arrays_list = []
+
+    for field in schema:
+        if field.name not in batch.schema.names:
+            arrays_list.append(pa.nulls(batch.num_rows, type=field.type))
+            continue
+        array = batch.column(field.name)
+
+        # an empty legacy string is an empty set
+        if array.type == pa.string() and pa.types.is_list(field.type):
+            array = pc.if_else(pc.equal(array, ""), pa.scalar([], type=field.type),
+                               pc.split_pattern(array, LEGACY_SEPARATOR))
+        arrays_list.append(array.cast(field.type))
+
+    return pa.RecordBatch.from_arrays(arrays_list, schema=schema)
+
+
+def iter_subset_batches(subset_path_list: list, schema: pa.Schema, use_threads: bool):
+    """
+    This generator read the subsets one after the other, batch by batch, as a dataset.
+    Every subset is read with its own schema, the legacy strings can not be cast
+    to lists by the dataset scanner, then conformed to the unified schema
+
+    Args:
+        subset_path_list (list of strings): the paths of the subsets
+        schema (pa.Schema): the schema built by unify_subset_schemas
+        use_threads (bool): decode the columns with several threads
+
+    yield:
+        batch (pa.RecordBatch): a batch with the unified schema
+    """
+    # the fragments keep the order of the paths
+    for fragment in ds.dataset(subset_path_list, format="parquet").get_fragments():
+        for batch in fragment.to_batches(schema=fragment.physical_schema,
+                                         use_threads=use_threads):
+            yield conform_batch(batch, schema)
+
+
+def write_single_file(batches_iter, schema: pa.Schema, output_filepath: str,
+                      row_group_size: int) -> int:
+    """
+    This function write batches to a single parquet file,
+    batches are buffered until a row group is complete, only the last row group is smaller
+
+    Args:
+        batches_iter (iterable of pa.RecordBatch): the batches of the subsets
+        schema (pa.Schema): the schema of the batches
+        output_filepath (str): the output parquet file
+        row_group_size (int): number of rows per row group
+
+    return:
+        nb_rows (int): number of rows written
+    """
+    # declare local variables
+    nb_rows = 0
+    batch_list = []
+    nb_buffered_rows = 0
+
+    # write full row groups as soon as enough rows are buffered, the remainder is kept
+    with pq.ParquetWriter(output_filepath, schema) as writer:
+        for batch in batches_iter:
+            batch_list.append(batch)
+            nb_buffered_rows += batch.num_rows
+            if nb_buffered_rows >= row_group_size:
+                table = pa.Table.from_batches(batch_list, schema)
+                nb_full_rows = nb_buffered_rows - nb_buffered_rows % row_group_size
+                writer.write_table(table.slice(0, nb_full_rows), row_group_size=row_group_size)
+                nb_rows += nb_full_rows
+                batch_list = table.slice(nb_full_rows).to_batches()
+                nb_buffered_rows -= nb_full_rows
+
+        # write the last incomplete row group
+        if batch_list:
+            writer.write_table(pa.Table.from_batches(batch_list, schema),
+                               row_group_size=row_group_size)
+            nb_rows += nb_buffered_rows
+
+    return nb_rows
+
+
+def iter_partitioned_batches(batches_iter, partition_column: str, nb_partitions: int):
+    """
+    This generator add the partition of every row to the batches,
+    the partition is the crc32 of the partition column modulo the number of partitions
+
+    Args:
+        batches_iter (iterable of pa.RecordBatch): the batches of the subsets
+        partition_column (str): the column hashed to get the partition
+        nb_partitions (int): number of partitions
+
+    yield:
+        batch (pa.RecordBatch): the batch with an extra partition column
+    """
+    for batch in batches_iter:
+        partition_list = [zlib.crc32(str(value).encode("utf-8")) % nb_partitions
+                          for value in batch.column(partition_column).to_pylist()]
+        yield batch.append_column(PARTITION_KEY, pa.array(partition_list, type=pa.int32()))
+
+
+def main(search_pattern: str,
+         output_filepath: str,
+         use_multiprocessing: bool,
+         row_group_size: int = 100_000,
+         nb_partitions: int = None,
+         partition_column: str = "SMILES",
+         build_index: bool = False) -> None:
     """  This function is used to aggregate all the data into a single parquet
-    file
+    file, or into a dataset partitioned by hash of a column
 
     Args:
         search_pattern (str):  the unix search filepath pattern used to find all finished jobs
-        output_filepath (str): the outpath of the concatenated database
+        output_filepath (str): the outpath of the concatenated database,
+        a directory when the database is partitioned
+        use_multiprocessing (bool): read the subsets with several threads
+        row_group_size (int): number of rows per row group
+        nb_partitions (int): optional, number of hash partitions
+        partition_column (str): the column hashed to get the partition
+        build_index (bool): write the md5 lookup index of library_index.py
+        next to a single file database, a ValueError is raised for a partitioned one
     """
+    if build_index and nb_partitions is not None:
+        raise ValueError("--build_index needs a single file database, "
+                         "it cannot be used with --nb_partitions")
 
     # get path of subset
-    subset_path_set = set(glob.glob(search_pattern))
-
-    # get the number of available cores
-    if use_multiprocessing:
-        nb_worker=len(os.sched_getaffinity(0))
-
-        # get subsets
-        with Pool(nb_worker) as pool:
-            df_list = pool.map(pd.read_parquet, subset_path_set)
-            pool.close()
-            pool.join()
-    else:
-        df_list=[pd.read_parquet(path) for path in subset_path_set]
+    subset_path_list = sorted(glob.glob(search_pattern))
 
-    # concatenate df
-    aggregated_df = pd.concat(df_list, ignore_index=True)
+    # the schema is unified from the footers before reading any data
+    schema = unify_subset_schemas(subset_path_list)
+    batches_iter = iter_subset_batches(subset_path_list, schema, use_multiprocessing)
 
     # writing file
-    aggregated_df.to_parquet(output_filepath)
+    if nb_partitions is None:
+        write_single_file(batches_iter, schema, output_filepath, row_group_size)
+        if build_index:
+            # rdkit is only imported when the index is built
+            sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+            from features.library_index import build_library_index  # pylint: disable=C0415
+            build_library_index(output_filepath)
+        return
+    ds.write_dataset(iter_partitioned_batches(batches_iter, partition_column, nb_partitions),
+                     output_filepath,
+                     schema=schema.append(pa.field(PARTITION_KEY, pa.int32())),
+                     format="parquet",
+                     partitioning=ds.partitioning(pa.schema([(PARTITION_KEY, pa.int32())]),
+                                                  flavor="hive"),
+                     max_rows_per_group=row_group_size,
+                     min_rows_per_group=row_group_size,
+                     existing_data_behavior="delete_matching")
 
 
 if __name__ == '__main__':
@@ -48,13 +245,29 @@ if __name__ == '__main__':
     parser.add_argument('--search_pattern', help="unix style pathname pattern to \
                         find finished task",
                         default="data/interim/ClearSMILES_MOSES_subset_*.parquet", type=str)
-    parser.add_argument('--output_filepath', help="the output file should be a parquet file",
+    parser.add_argument('--output_filepath', help="the output file should be a parquet file, \
+                        or a directory when the database is partitioned",
                         default="data/processed/whole_MOSES_ClearSMILES_results.parquet",
                         type=str)
-    parser.add_argument('--use_multiprocessing', help="enable multiprocessing for reading files",
+    parser.add_argument('--use_multiprocessing', help="read the subsets with several threads",
+                        default=False,
+                        action="store_true")
+
+    # output layout arguments
+    parser.add_argument('--row_group_size', help="number of rows per row group",
+                        default=100_000,
+                        type=int)
+    parser.add_argument('--nb_partitions', help="write a dataset partitioned by hash \
+                        of --partition_column instead of a single file",
+                        default=None,
+                        type=int)
+    parser.add_argument('--partition_column', help="the column hashed to get the partition",
+                        default="SMILES",
+                        type=str)
+    parser.add_argument('--build_index', help="write the md5 lookup index of the canonical \
+                        SMILES next to the database, single file only",
                         default=False,
-                        action="store_true",
-                        type=bool)
+                        action="store_true")
 
     # parse and converto dict
     args, _ = parser.parse_known_args()
@@ -67,5 +280,9 @@ if __name__ == '__main__':
     # execute main
     main(search_pattern=args_dict["search_pattern"],
          output_filepath=args_dict["output_filepath"],
-         use_multiprocessing= args_dict["use_multiprocessing"]
+         use_multiprocessing=args_dict["use_multiprocessing"],
+         row_group_size=args_dict["row_group_size"],
+         nb_partitions=args_dict["nb_partitions"],
+         partition_column=args_dict["partition_column"],
+         build_index=args_dict["build_index"]
          )
@@ -0,0 +1,161 @@
+"""
+This script build a byte offset index of a csv database, the offset of every Nth row
+is stored in a sidecar json file so that a task of the job array can seek directly
+to its chunk of data instead of parsing the whole file from the first row.
+The index records the size and modification time of the csv file,
+a stale index is ignored and the csv file is scanned from the first row
+"""
+import os
+import json
+from pathlib import Path
+import argparse
+
+# sidecar file written next to the csv database
+INDEX_SUFFIX = ".idx.json"
+QUOTE = ord('"')
+
+
+def get_index_path(csv_path: str) -> str:
+    """ default path of the sidecar index of a csv file """
+    return f"{csv_path}{INDEX_SUFFIX}"
+
+
+def build_csv_index(csv_path: str, index_path: str = None, step: int = 1000) -> dict:
+    """
+    This function record the byte offset of every step-th row of a csv file,
+    the header is not counted as a row. Quoted fields may contain line breaks,
+    a record is only complete when the number of quotes read so far is even
+
+    Args:
+        csv_path (str): the path to the csv file
+        index_path (str): optional, the path of the sidecar index,
+        by default the csv path followed by .idx.json
+        step (int): number of rows between two recorded offsets
+
+    return:
+        index_dict (dict): dict with string as keys and various type of values
+            csv_size (int): size of the csv file in bytes
+            csv_mtime_ns (int): modification time of the csv file in nanoseconds
+            step (int): number of rows between two recorded offsets
+            nb_rows (int): number of rows, the header excluded
+            offsets (list of int): byte offset of the rows 0, step, 2*step ...
+    """
+    # declare local variables
+    index_path = index_path or get_index_path(csv_path)
+    csv_stat = os.stat(csv_path)
+    offsets_list = []
+    nb_rows = 0
+    nb_quotes = 0
+
+    # read the file in binary mode, the offsets are then exact byte positions
+    with open(csv_path, "rb") as csv_file:
+        is_header = True
+        offset = 0
+        for line in csv_file:
+            offset += len(line)
+            nb_quotes += line.count(QUOTE)
+            if nb_quotes % 2:
+                continue
+
+            # offset is now the start of the next record
+            if is_header:
+                is_header = False
+            else:
+                nb_rows += 1
+            if nb_rows % step == 0 and offset < csv_stat.st_size:
+                offsets_list.append(offset)
+
+    # write the sidecar index
+    index_dict = {
+        "csv_size": csv_stat.st_size,
+        "csv_mtime_ns": csv_stat.st_mtime_ns,
+        "step": step,
+        "nb_rows": nb_rows,
+        "offsets": offsets_list,
+    }
+    with open(index_path, "w", encoding="utf-8") as index_file:
+        json.dump(index_dict, index_file)
+
+    return index_dict
+
+
+def load_csv_index(csv_path: str, index_path: str = None) -> dict:
+    """
+    This function load the sidecar index of a csv file if it is still valid
+
+    Args:
+        csv_path (str): the path to the csv file
+        index_path (str): optional, the path of the sidecar index,
+        by default the csv path followed by .idx.json
+
+    return:
+        index_dict (dict or None): the index built by build_csv_index,
+        None if the index is missing, unreadable or stale
+    """
+    # declare local variables
+    index_path = index_path or get_index_path(csv_path)
+
+    # missing or corrupted index
+    try:
+        with open(index_path, encoding="utf-8") as index_file:
+            index_dict = json.load(index_file)
+        csv_stat = os.stat(csv_path)
+    except (OSError, ValueError):
+        return None
+
+    # the csv file changed since the index was built
+    if index_dict.get("csv_size") != csv_stat.st_size or \
+            index_dict.get("csv_mtime_ns") != csv_stat.st_mtime_ns:
+        return None
+
+    return index_dict
+
+
+def get_row_offset(index_dict: dict, row_idx: int) -> tuple:
+    """
+    This function find the closest recorded offset before a row
+
+    Args:
+        index_dict (dict): the index built by build_csv_index
+        row_idx (int): the index of the row, the header excluded
+
+    return:
+        offset (int): byte offset of the closest recorded row
+        nb_rows_to_skip (int): number of rows between the recorded row and row_idx
+    """
+    block_idx = min(row_idx // index_dict["step"], len(index_dict["offsets"]) - 1)
+
+    return index_dict["offsets"][block_idx], row_idx - block_idx * index_dict["step"]
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--input_csv', help="the inputh path to csv database",
+                        default="data/raw/whole_original_MOSES.csv", type=str)
+    parser.add_argument('--index_path', help="the output path of the index, by default \
+                        the csv path followed by .idx.json",
+                        default=None, type=str)
+
+    # index argument
+    parser.add_argument('--step', help="number of rows between two recorded offsets",
+                        default=1000,
+                        type=int)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    print(project_dir)
+    os.chdir(project_dir)
+
+    # execute main
+    csv_index_dict = build_csv_index(csv_path=args_dict["input_csv"],
+                                     index_path=args_dict["index_path"],
+                                     step=args_dict["step"])
+    print(f"indexed {csv_index_dict['nb_rows']} rows "
+          f"with {len(csv_index_dict['offsets'])} offsets")
@@ -0,0 +1,466 @@
+"""This module contains a deterministic alternative to the random search of ClearSMILES,
+every depth first traversal of the molecule (root atom, branch order, ring closures)
+is enumerated with branch-and-bound pruning on the max digit and the semantic memory score.
+The SMILES of the best traversals are written like the rdkit writer does, with the single
+kekule structure it uses, so that the exhaustive search returns the same set of ClearSMILES
+as a random search drawing every randomized kekule SMILES
+"""
+import re
+import time
+from itertools import islice, permutations, product
+from math import prod
+from rdkit import Chem
+
+# atom tokens of the SMILES regex, used to get the token of every atom from a written SMILES
+ATOM_TOKENS_REGEX = re.compile(r"\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p")
+BOND_SYMBOLS_DICT = {
+    Chem.BondType.SINGLE: "",
+    Chem.BondType.DOUBLE: "=",
+    Chem.BondType.TRIPLE: "#",
+    Chem.BondType.QUADRUPLE: "$",
+    Chem.BondType.DATIVE: "->",
+}
+
+
+def is_exhaustive_search_possible(mol: Chem.Mol, max_atoms: int) -> bool:
+    """
+    This function assess if a molecule can be handled by the exhaustive search,
+    stereochemistry depends on the order of the neighbours in the SMILES and
+    several fragments would require to enumerate their order, both are left to the random search
+
+    Args:
+        mol (Chem.Mol): an rdkit molecule
+        max_atoms (int): the maximal number of atoms of the molecule
+
+    return:
+        is_possible (bool): True if the exhaustive search can be used
+    """
+    # declare local variables
+    has_chirality = any(atom.GetChiralTag() != Chem.ChiralType.CHI_UNSPECIFIED
+                        for atom in mol.GetAtoms())
+    has_stereo_bond = any(bond.GetStereo() != Chem.BondStereo.STEREONONE
+                          for bond in mol.GetBonds())
+
+    return 1 < mol.GetNumAtoms() <= max_atoms and len(Chem.GetMolFrags(mol)) == 1 \
+        and not has_chirality and not has_stereo_bond
+
+
+def get_atom_tokens(mol: Chem.Mol) -> list:
+    """
+    This function get the SMILES token of every atom,
+    without stereochemistry the token of an atom does not depend on the traversal
+
+    Args:
+        mol (Chem.Mol): an rdkit molecule
+
+    return:
+        atom_tokens_list (list of strings): the token of every atom, ordered by atom index
+    """
+    # declare local variables
+    smiles = Chem.MolToSmiles(mol, kekuleSmiles=True)
+    output_order = mol.GetProp("_smilesAtomOutputOrder").strip("[],").split(",")
+    atom_tokens_list = [str()] * mol.GetNumAtoms()
+
+    # atoms are written in the output order
+    for atom_idx, token in zip(output_order, ATOM_TOKENS_REGEX.findall(smiles)):
+        atom_tokens_list[int(atom_idx)] = token
+
+    return atom_tokens_list
+
+
+def get_writer_bond_symbols(mol: Chem.Mol) -> list:
+    """
+    This function get the kekule structure written by rdkit, whatever the traversal
+    the kekule SMILES are written from the same kekulization of the molecule,
+    the other kekule structures are never written
+
+    Args:
+        mol (Chem.Mol): an rdkit molecule
+
+    return:
+        bond_symbols (list of strings): the symbol of every bond ordered by bond index
+    """
+    # declare local variables
+    kekule_mol = Chem.Mol(mol)
+    Chem.Kekulize(kekule_mol, clearAromaticFlags=True)
+
+    return [BOND_SYMBOLS_DICT.get(bond.GetBondType(), "") for bond in kekule_mol.GetBonds()]
+
+
+def get_digit_token(digit: int) -> str:
+    """ ring closure token, %nn above 9 """
+    return str(digit) if digit < 10 else f"%{digit}"
+
+
+def write_traversal(order_list: list,
+                    children_list: list,
+                    parent_bond_list: list,
+                    closure_orders_dict: dict,
+                    atom_tokens_list: list,
+                    bond_symbols: list) -> list:
+    """
+    This function write the tokens of a traversal.
+    Like rdkit, a ring closure bond symbol is written on the closing side
+    and the lowest available digit is used, ring closures are closed before being opened
+
+    Args:
+        order_list (list): the atoms in the order they are written, the first one is the root
+        children_list (list of lists): children of every atom, ordered by visit
+        parent_bond_list (list): the index of the bond toward the parent of every atom
+        closure_orders_dict (dict): atom as keys, tuple of the ring closure bonds closed
+        and opened on the atom, in writing order
+        atom_tokens_list (list of strings): the token of every atom
+        bond_symbols (list of strings): the symbol of every bond, see get_writer_bond_symbols
+
+    return:
+        tokens_list (list of strings): the tokens of the SMILES
+    """
+    # declare local variables
+    tokens_list = []
+    open_digit_dict = {}
+
+    # actions are (kind, atom, bond), kind is 0 for the main chain, 1 for a branch, 2 to close it
+    actions_list = [(0, order_list[0], None)]
+    while actions_list:
+        kind, atom_idx, bond_idx = actions_list.pop()
+
+        # close branch
+        if kind == 2:
+            tokens_list.append(")")
+            continue
+
+        # open branch
+        if kind == 1:
+            tokens_list.append("(")
+
+        # bond symbol and atom
+        if bond_idx is not None and bond_symbols[bond_idx]:
+            tokens_list.append(bond_symbols[bond_idx])
+        tokens_list.append(atom_tokens_list[atom_idx])
+
+        # close ring closures first, a digit is not reused on the atom closing it
+        closing_bonds, opening_bonds = closure_orders_dict.get(atom_idx, ((), ()))
+        closed_digits_set = set()
+        for bond in closing_bonds:
+            if bond_symbols[bond]:
+                tokens_list.append(bond_symbols[bond])
+            digit = open_digit_dict.pop(bond)
+            tokens_list.append(get_digit_token(digit))
+            closed_digits_set.add(digit)
+
+        # open ring closures with the lowest available digits
+        for bond in opening_bonds:
+            digit = 1
+            while digit in closed_digits_set or digit in open_digit_dict.values():
+                digit += 1
+            open_digit_dict[bond] = digit
+            tokens_list.append(get_digit_token(digit))
+
+        # branches first, the last child continue the main chain
+        children = children_list[atom_idx]
+        if children:
+            actions_list.append((0, children[-1], parent_bond_list[children[-1]]))
+        for child_idx in reversed(children[:-1]):
+            actions_list.append((2, child_idx, None))
+            actions_list.append((1, child_idx, parent_bond_list[child_idx]))
+
+    return tokens_list
+
+
+def iter_closure_orders(search_dict: dict, max_closure_orders: int):
+    """
+    This generator yield the possible orders of the ring closures on every atom,
+    permuting the ring closures of an atom changes the digits, thus the max digit.
+    The number of orders is capped since it grows factorially with the ring closures,
+    is_truncated is set in search_dict when some orders are not yielded
+
+    Args:
+        search_dict (dict): the state of the enumeration, with a complete traversal
+        max_closure_orders (int): maximal number of orders to yield
+
+    yield:
+        closure_orders_dict (dict): atom as keys, tuple of the ring closure bonds closed
+        and opened on the atom
+    """
+    # declare local variables
+    position_dict = {atom_idx: i for i, atom_idx in enumerate(search_dict["order_list"])}
+    atoms_list = []
+    permutations_list = []
+
+    # closing and opening bonds of every atom
+    for atom_idx, closures in enumerate(search_dict["closures_list"]):
+        if not closures:
+            continue
+        closing_bonds = [bond for partner, bond in closures
+                         if position_dict[partner] < position_dict[atom_idx]]
+        opening_bonds = [bond for _, bond in sorted(
+            (position_dict[partner], bond) for partner, bond in closures
+            if position_dict[partner] > position_dict[atom_idx])]
+        atoms_list.append(atom_idx)
+        permutations_list.append(list(product(permutations(closing_bonds),
+                                              permutations(opening_bonds))))
+
+    if prod(len(orders_list) for orders_list in permutations_list) > max_closure_orders:
+        search_dict["is_truncated"] = True
+    for closure_orders in islice(product(*permutations_list), max_closure_orders):
+        yield dict(zip(atoms_list, closure_orders))
+
+
+def get_traversal_lower_bounds(search_dict: dict) -> tuple:
+    """
+    This function compute lower bounds of the max digit and of the semantic memory score
+    of every completion of a partial traversal, see search_bounds.compute_lower_bounds.
+    A ring closure is open on the whole tree path between its atoms whatever the order
+    of the branches, and the number of branches of an atom only depends on its children
+
+    Args:
+        search_dict (dict): the state of the enumeration
+
+    return:
+        lower_bounds (tuple): (max digit, semantic memory score) lower bounds
+    """
+    # declare local variables
+    nb_branches = search_dict["nb_branches"]
+    max_digit = max(search_dict["bracket_digit"], min(search_dict["max_open_closures"], 9))
+    mem_score = min((search_dict["ring_memory"] + 2 * nb_branches) /
+                    (search_dict["max_nb_tokens"] + 2 * nb_branches), 1.0)
+
+    return max_digit, mem_score
+
+
+def is_pruned(search_dict: dict) -> bool:
+    """ a partial traversal is pruned when its bounds are worse than the best solutions """
+    max_digit, mem_score = get_traversal_lower_bounds(search_dict)
+    results_dict = search_dict["results_dict"]
+
+    return max_digit > results_dict["max_digit"] or \
+        (max_digit == results_dict["max_digit"] and mem_score > results_dict["lowest_mem_score"])
+
+
+def write_traversal_smiles(search_dict: dict) -> None:
+    """
+    This function write the SMILES of a complete traversal, for every order of the ring closures
+
+    Args:
+        search_dict (dict): the state of the enumeration, its pending SMILES list is updated
+    """
+    for closure_orders_dict in iter_closure_orders(search_dict,
+                                                   search_dict["max_closure_orders"]):
+        tokens_list = write_traversal(search_dict["order_list"],
+                                      search_dict["children_list"],
+                                      search_dict["parent_bond_list"],
+                                      closure_orders_dict,
+                                      search_dict["atom_tokens_list"],
+                                      search_dict["bond_symbols"])
+        search_dict["pending_smiles_list"].append("".join(tokens_list))
+        search_dict["nb_enumerated_smiles"] += 1
+
+
+def visit_atom(search_dict: dict, atom_idx: int, parent_idx: int, bond_idx: int) -> dict:
+    """
+    This function add an atom to the traversal and update the bounds,
+    every visited neighbour other than the parent is an ancestor, i.e a ring closure
+
+    Args:
+        search_dict (dict): the state of the enumeration, updated in place
+        atom_idx (int): the atom to visit
+        parent_idx (int): the atom from which it is visited
+        bond_idx (int): the bond between both
+
+    return:
+        undo_dict (dict): the values needed to restore the state
+    """
+    # declare local variables
+    stack_list = search_dict["stack_list"]
+    undo_dict = {
+        "max_open_closures": search_dict["max_open_closures"],
+        "ring_memory": search_dict["ring_memory"],
+        "nb_branches": search_dict["nb_branches"],
+        "closures": [],
+    }
+
+    # tree edge
+    search_dict["visited"][atom_idx] = True
+    search_dict["order_list"].append(atom_idx)
+    search_dict["parent_bond_list"][atom_idx] = bond_idx
+    search_dict["children_list"][parent_idx].append(atom_idx)
+    if len(search_dict["children_list"][parent_idx]) >= 2:
+        search_dict["nb_branches"] += 1
+
+    # ring closures, they are open along the path from the ancestor
+    for neighbor_idx, neighbor_bond_idx in search_dict["neighbors_list"][atom_idx]:
+        if neighbor_idx == parent_idx or not search_dict["visited"][neighbor_idx]:
+            continue
+        stack_idx = search_dict["stack_position"][neighbor_idx]
+        for path_atom_idx in stack_list[stack_idx:]:
+            search_dict["open_closures"][path_atom_idx] += 1
+            search_dict["max_open_closures"] = max(search_dict["max_open_closures"],
+                                                   search_dict["open_closures"][path_atom_idx])
+        search_dict["ring_memory"] += len(stack_list) - stack_idx + 1
+        search_dict["closures_list"][atom_idx].append((neighbor_idx, neighbor_bond_idx))
+        search_dict["closures_list"][neighbor_idx].append((atom_idx, neighbor_bond_idx))
+        undo_dict["closures"].append((neighbor_idx, stack_idx))
+
+    search_dict["stack_position"][atom_idx] = len(stack_list)
+    stack_list.append(atom_idx)
+
+    return undo_dict
+
+
+def unvisit_atom(search_dict: dict, atom_idx: int, parent_idx: int, undo_dict: dict) -> None:
+    """ This function restore the state of the enumeration before visit_atom """
+    # declare local variables
+    stack_list = search_dict["stack_list"]
+    stack_list.pop()
+
+    # ring closures
+    for neighbor_idx, stack_idx in undo_dict["closures"]:
+        for path_atom_idx in stack_list[stack_idx:]:
+            search_dict["open_closures"][path_atom_idx] -= 1
+        search_dict["closures_list"][atom_idx].pop()
+        search_dict["closures_list"][neighbor_idx].pop()
+
+    # tree edge
+    search_dict["children_list"][parent_idx].pop()
+    search_dict["order_list"].pop()
+    search_dict["visited"][atom_idx] = False
+    search_dict["max_open_closures"] = undo_dict["max_open_closures"]
+    search_dict["ring_memory"] = undo_dict["ring_memory"]
+    search_dict["nb_branches"] = undo_dict["nb_branches"]
+
+
+def explore_traversals(search_dict: dict) -> bool:
+    """
+    This function recursively enumerate the depth first traversals,
+    the next atom is an unvisited neighbour of the deepest atom which has one
+
+    Args:
+        search_dict (dict): the state of the enumeration
+
+    return:
+        is_completed (bool): False if the time limit was reached
+    """
+    # check time limit from time to time
+    search_dict["nb_nodes"] += 1
+    if search_dict["nb_nodes"] % 1024 == 0 and time.perf_counter() > search_dict["deadline"]:
+        return False
+
+    # complete traversal
+    if len(search_dict["order_list"]) == search_dict["nb_atoms"]:
+        write_traversal_smiles(search_dict)
+        if len(search_dict["pending_smiles_list"]) >= search_dict["flush_size"]:
+            search_dict["flush_callback"](search_dict["pending_smiles_list"])
+            search_dict["pending_smiles_list"] = []
+        return True
+
+    # backtrack to the deepest atom with unvisited neighbours
+    stack_list = search_dict["stack_list"]
+    finished_list = []
+    while not any(not search_dict["visited"][neighbor_idx]
+                  for neighbor_idx, _ in search_dict["neighbors_list"][stack_list[-1]]):
+        finished_list.append(stack_list.pop())
+    parent_idx = stack_list[-1]
+
+    # every unvisited neighbour is a possible next atom
+    is_completed = True
+    for atom_idx, bond_idx in search_dict["neighbors_list"][parent_idx]:
+        if search_dict["visited"][atom_idx]:
+            continue
+        undo_dict = visit_atom(search_dict, atom_idx, parent_idx, bond_idx)
+        if not is_pruned(search_dict):
+            is_completed = explore_traversals(search_dict)
+        unvisit_atom(search_dict, atom_idx, parent_idx, undo_dict)
+        if not is_completed:
+            break
+
+    # restore the finished atoms
+    for atom_idx in reversed(finished_list):
+        search_dict["stack_position"][atom_idx] = len(stack_list)
+        stack_list.append(atom_idx)
+
+    return is_completed
+
+
+def exhaustive_search(mol: Chem.Mol,
+                      bounds_dict: dict,
+                      results_dict: dict,
+                      flush_callback,
+                      time_limit: float,
+                      flush_size: int = 256,
+                      max_closure_orders: int = 64) -> tuple:
+    """
+    This function enumerate all the depth first traversals of a molecule with
+    branch-and-bound pruning, the root atoms are restricted to one atom per symmetry class
+    of the kekule structure.
+    The best solutions are read from results_dict, which is expected to be updated
+    by flush_callback with the SMILES of the complete traversals
+
+    Args:
+        mol (Chem.Mol): an rdkit molecule accepted by is_exhaustive_search_possible
+        bounds_dict (dict): the lower bounds computed by search_bounds.compute_lower_bounds
+        results_dict (dict): results dict of get_clearsmiles
+        flush_callback (callable): function called with a list of new SMILES
+        time_limit (float): maximal duration of the enumeration in seconds
+        flush_size (int): number of SMILES scored at once
+        max_closure_orders (int): maximal number of ring closure orders written per traversal
+
+    return:
+        is_completed (bool): False if the time limit was reached
+        nb_enumerated_smiles (int): number of SMILES written
+        is_truncated (bool): True if some ring closure orders were not written,
+        the set of ClearSMILES may then be incomplete
+    """
+    # declare local variables
+    nb_atoms = mol.GetNumAtoms()
+    kekule_mol = Chem.Mol(mol)
+    Chem.Kekulize(kekule_mol, clearAromaticFlags=True)
+    # the kekule structure may break the symmetry of the aromatic rings
+    symmetry_classes = Chem.CanonicalRankAtoms(kekule_mol, breakTies=False)
+    root_dict = {}
+    for atom in mol.GetAtoms():
+        root_dict.setdefault(symmetry_classes[atom.GetIdx()], atom.GetIdx())
+    search_dict = {
+        "nb_atoms": nb_atoms,
+        "neighbors_list": [[(bond.GetOtherAtomIdx(atom.GetIdx()), bond.GetIdx())
+                            for bond in atom.GetBonds()] for atom in mol.GetAtoms()],
+        "atom_tokens_list": get_atom_tokens(mol),
+        "bond_symbols": get_writer_bond_symbols(mol),
+        "bracket_digit": bounds_dict["bracket_digit"],
+        "max_nb_tokens": bounds_dict["max_nb_tokens"],
+        "results_dict": results_dict,
+        "flush_callback": flush_callback,
+        "flush_size": flush_size,
+        "max_closure_orders": max_closure_orders,
+        "deadline": time.perf_counter() + time_limit,
+        "nb_nodes": 0,
+        "nb_enumerated_smiles": 0,
+        "is_truncated": False,
+        "pending_smiles_list": [],
+    }
+
+    # one root per symmetry class
+    is_completed = True
+    for root_idx in sorted(root_dict.values()):
+        search_dict.update({
+            "visited": [False] * nb_atoms,
+            "stack_position": [0] * nb_atoms,
+            "open_closures": [0] * nb_atoms,
+            "children_list": [[] for _ in range(nb_atoms)],
+            "parent_bond_list": [None] * nb_atoms,
+            "closures_list": [[] for _ in range(nb_atoms)],
+            "order_list": [root_idx],
+            "stack_list": [root_idx],
+            "max_open_closures": 0,
+            "ring_memory": 0,
+            "nb_branches": 0,
+        })
+        search_dict["visited"][root_idx] = True
+        is_completed = explore_traversals(search_dict)
+        if not is_completed:
+            break
+
+    # score the remaining SMILES
+    if search_dict["pending_smiles_list"]:
+        flush_callback(search_dict["pending_smiles_list"])
+
+    return is_completed, search_dict["nb_enumerated_smiles"], search_dict["is_truncated"]
@@ -1,18 +1,76 @@
 """This script is used to generate ClearSMILES from a csv file,
 it main use case is to be use during a SLURM job array 
 """
+from __future__ import annotations
 import os
+import sys
 import csv
 import time
-import re
 from pathlib import Path
 import argparse
 from multiprocessing import Pool
-from functools import partial
-import numpy as np
-from rdkit import Chem
-import pyarrow as pa
-import pyarrow.parquet as pq
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+from features.csv_index import load_csv_index, get_row_offset
+from features.input_readers import get_input_format, read_parquet_rows, read_text_rows
+from features.plan_chunks import load_plan_chunks, load_coefficients, get_descriptors, \
+    parse_job_array_range
+from features.result_cache import open_cache, add_cache_counters, get_cache_stats, close_cache
+from features.run_metrics import get_metrics_path, get_peak_rss_mb, summarize_values, \
+    read_stage_times, write_metrics
+from features.work_queue import create_queue, get_worker_id
+from features.checkpoint import ROW_IDX_KEY, get_checkpoint_dir, load_finished_rows, \
+    write_checkpoint_part, merge_checkpoint, check_checkpoint_params
+from features.clearsmiles_search import get_results_fields
+from features.generation_worker import init_worker, process_batch, iter_worker_results, \
+    iter_until_deadline, print_worker_report
+
+# heavy dependencies are imported on first use, --help and the planning scripts
+# importing this module do not load them
+np = LazyModule("numpy")
+pa = LazyModule("pyarrow")
+# the task runners call main, they are only imported by the command line
+task_runners = LazyModule("features.task_runners")
+
+# configuration of a task, the keys of config_dict in main with their default value
+DEFAULT_CONFIG_DICT = {
+    # input database
+    "input_csv": None,
+    "columns_list": None,
+    "index_path": None,
+    # search parameters, the keyword arguments of get_clearsmiles
+    "nb_random": 100_000,
+    "batch_size": None,
+    "patience": 3,
+    "search": "random",
+    "max_exhaustive_atoms": 30,
+    "exhaustive_time_limit": 60.0,
+    "max_closure_orders": 64,
+    "sampling": "uniform",
+    "store_mem_maps": False,
+    "time_budget": None,
+    # pool of workers
+    "nb_core": None,
+    "max_tasks_per_child": None,
+    "chunksize": None,
+    "coefficients_list": None,
+    "cache_dir": None,
+    "cache_max_size_mb": None,
+    # output, metrics and time limit
+    "row_group_size": 1000,
+    "metrics_path": None,
+    "nb_profiled": 0,
+    "task_time_limit": None,
+}
+CLEARSMILES_KEYS = ("nb_random", "batch_size", "patience", "search", "max_exhaustive_atoms",
+                    "exhaustive_time_limit", "max_closure_orders", "sampling", "store_mem_maps",
+                    "time_budget")
+# the search parameters recorded in the checkpoint, the time limits are left out
+# so that a task interrupted by its deadline can be relaunched with more time
+CHECKPOINT_KEYS = ("nb_random", "batch_size", "patience", "search", "max_exhaustive_atoms",
+                   "max_closure_orders", "sampling", "store_mem_maps")
 
 
 def compute_chunk_idx(nb_smiles: int, task_id: int, job_array_size: int) -> dict:
@@ -53,18 +111,86 @@ def compute_chunk_idx(nb_smiles: int, task_id: int, job_array_size: int) -> dict
     return chunk_idx_dict
 
 
+def get_row_dict(row: list, keys_list: list, row_idx: int, row_idx_key: str = None) -> dict:
+    """
+    This function package a csv row as a dictionnary
+
+    Args:
+        row (list of strings): the values of the row
+        keys_list (list of strings): the columns names found in the header
+        row_idx (integer): the index of the row, used in the error message
+        row_idx_key (string): optional, key under which the index of the row is added
+
+    return:
+        row_dict (dictionnary): columns names as keys and values of the row as values
+    """
+    nb_keys = len(keys_list)
+    nb_values = len(row)
+    assert nb_values == nb_keys, f"Discrepancy between the number of values in row\
+        ({nb_values}) and number of columns detected in header \
+            ({nb_keys}), this happened for line : {row_idx+1} "
+
+    row_dict = {keys_list[j]: row[j] for j in range(nb_keys)}
+    if row_idx_key is not None:
+        row_dict[row_idx_key] = row_idx
+
+    return row_dict
+
+
+def read_indexed_rows(csv_file, index_dict: dict, keys_list: list,
+                      first_idx: int, last_idx: int, row_idx_key: str = None) -> list:
+    """
+    This function seek to the closest indexed row before first_idx
+    and read the rows from first_idx to last_idx
+
+    Args:
+        csv_file (file object): the csv file opened in text mode
+        index_dict (dict): the index built by csv_index.build_csv_index
+        keys_list (list of strings): the columns names found in the header
+        first_idx (integer) : the first index to be read
+        last_idx (integer) : the last index to be read, excluded
+        row_idx_key (string): optional, key under which the index of the row is added
+
+    return:
+        data_list (list of dictionnary): the rows packaged by get_row_dict
+    """
+    # declare local variables
+    data_list = []
+    if first_idx >= min(last_idx, index_dict["nb_rows"]):
+        return data_list
+    offset, nb_rows_to_skip = get_row_offset(index_dict, first_idx)
+
+    # a fresh reader is needed after seeking
+    csv_file.seek(offset)
+    csv_reader = csv.reader(csv_file)
+    for i, row in enumerate(csv_reader, start=first_idx - nb_rows_to_skip):
+        if i >= last_idx:
+            break
+        if i >= first_idx:
+            data_list.append(get_row_dict(row, keys_list, i, row_idx_key))
+
+    return data_list
+
+
 def wrapper_csv_reader(csv_path: str,
                        first_idx: int,
                        last_idx: int,
-                       extra_idx: int
+                       extra_idx: int,
+                       index_path: str = None,
+                       row_idx_key: str = None
                        ) -> list:
-    """This function purpose is to read a chunk of data from a csv file
+    """This function purpose is to read a chunk of data from a csv file,
+    if a valid byte offset index was built with csv_index.py the chunk is read directly,
+    otherwise the file is scanned from the first row
 
     Args:
         csv_path (string):  the path to the csv file
         first_idx (integer) : the first index to be read
         last_idx (integer) : the last index to be read 
         extra_idx (integer) :  optional,an extra index for load balancing 
+        index_path (string) : optional, the path of the sidecar index,
+        by default the csv path followed by .idx.json
+        row_idx_key (string): optional, key under which the index of the row is added
 
 
     return:
@@ -73,7 +199,7 @@ def wrapper_csv_reader(csv_path: str,
     """
     # declare local variables
     data_list = []
-    temp_dict = {}
+    index_dict = load_csv_index(csv_path, index_path)
 
     # open file
     with open(csv_path, encoding="utf-8") as csv_file:
@@ -82,7 +208,15 @@ def wrapper_csv_reader(csv_path: str,
         # get header
         header = next(csv_reader)  # Assuming the first row is the header
         keys_list = header
-        nb_keys = len(keys_list)
+
+        # seek directly to the chunk and to the extra row
+        if index_dict is not None:
+            data_list = read_indexed_rows(csv_file, index_dict, keys_list,
+                                          first_idx, last_idx, row_idx_key)
+            if extra_idx and extra_idx >= last_idx:
+                data_list += read_indexed_rows(csv_file, index_dict, keys_list,
+                                               extra_idx, extra_idx + 1, row_idx_key)
+            return data_list
 
         # iterate through file
         for i, row in enumerate(csv_reader):
@@ -106,222 +240,475 @@ def wrapper_csv_reader(csv_path: str,
 
             # read line and package it as a dictionnary
             if read_line:
-                nb_values = len(row)
-                assert nb_values == nb_keys, f"Discrepancy between the number of values in row\
-                    ({nb_values}) and number of columns detected in header \
-                        ({nb_keys}), this happened for line : {i+1} "
-                temp_dict = {keys_list[j]: row[j]
-                             for j in range(nb_keys)}
-                data_list.append(temp_dict)
+                data_list.append(get_row_dict(row, keys_list, i, row_idx_key))
 
     return data_list
 
 
-def find_biggest_digits(smiles=str()):
-    """
-    find the biggest digits by iterating throught possible max digits 
-    and test if there is a match in string
-    input: smiles (string)
-    output: max_digit (integer)
+def wrapper_input_reader(input_path: str,
+                         first_idx: int,
+                         last_idx: int,
+                         extra_idx: int,
+                         index_path: str = None,
+                         row_idx_key: str = None,
+                         columns_list: list = None) -> list:
+    """This function read a chunk of data from any supported input,
+    the format and the compression are guessed from the suffixes of the path:
+    parquet files are read by row groups, compressed csv and .smi files are streamed
+    with pyarrow, and plain csv files are read by wrapper_csv_reader
+
+    Args:
+        input_path (string): the path to the parquet, csv or .smi file
+        first_idx (integer) : the first index to be read
+        last_idx (integer) : the last index to be read
+        extra_idx (integer) :  optional,an extra index for load balacing
+        index_path (string) : optional, the byte offset index of a plain csv file
+        row_idx_key (string): optional, key under which the index of the row is added
+        columns_list (list of strings): optional, the columns passed to the workers,
+        all columns if None
+
+    return:
+        data_list (list of dictionnary): list of dictionaries containing columns names
+        as keys and and values of the row as values
     """
+    # declare local variables
+    input_format, compression = get_input_format(input_path)
+
+    if input_format == "parquet":
+        return read_parquet_rows(input_path, first_idx, last_idx, extra_idx,
+                                 columns_list, row_idx_key)
+    if input_format == "smi" or compression is not None:
+        return read_text_rows(input_path, first_idx, last_idx, extra_idx,
+                              columns_list, row_idx_key)
+
+    # plain csv keeps the byte offset index
+    data_list = wrapper_csv_reader(input_path, first_idx, last_idx, extra_idx,
+                                   index_path, row_idx_key)
+    if columns_list is not None:
+        kept_keys_list = columns_list + ([row_idx_key] if row_idx_key else [])
+        data_list = [{key: row_dict[key] for key in kept_keys_list} for row_dict in data_list]
 
-    # iterate through max digits possible solution
-    for i in range(1, 10):
-        digit = 10-i
-        if smiles.find(str(digit)) != -1:
-            return digit
+    return data_list
 
-    return 0
 
+def get_results_schema(csv_keys_list: list) -> pa.Schema:
+    """
+    This function build the explicit schema of the results parquet file
 
-def get_semantic_mem_map(smiles: str, smiles_regex: re.compile) -> np.array:
+    Args:
+        csv_keys_list (list of strings): the columns names of the csv database
+
+    return:
+        schema (pa.Schema): the result columns, the index of the row in the csv database
+        and the csv columns as strings
     """
-    This function will generate a semantic memory map of a SMILES, 
-    i.e the number of semantic feature open for every token. 
-    Semantic feature include  branches and  rings 
-        smiles (string) : a valid SMILES 
-        smiles_regex (compiled regular expression): compiled regular expression 
-        used to tokenize SMILES
-        bonds_set (set of strings): a set containing all the bonds tokens
-    output :
-        mem_map  (numpy array):  the semantic memory map of the input SMILES
+    # declare local variables
+    results_fields_list = get_results_fields()
+    result_keys_set = {key for key, _ in results_fields_list}
+    result_keys_set.add(ROW_IDX_KEY)
+
+    # csv values are passed as such, the SMILES column is appended there
+    return pa.schema(results_fields_list + [(ROW_IDX_KEY, pa.int64())] +
+                     [(key, pa.string()) for key in csv_keys_list
+                      if key not in result_keys_set])
+
+
+def write_results(batches_iter,
+                  checkpoint_dir: str,
+                  schema: pa.Schema,
+                  row_group_size: int,
+                  metrics_dict: dict = None,
+                  writer_id: str = None) -> int:
     """
+    This function write the results to the checkpoint directory as soon as a row group
+    is complete, thus the memory used is bounded by the row group size
+    and not by the number of molecules, and a killed task loses at most one row group.
+    Batches are concatenated and sliced without converting rows to python objects
 
-    # declare local variables
-    tokens_list = smiles_regex.findall(smiles)
-    mem_map = np.zeros(len(tokens_list), dtype=int)
-    digit_set = set()
-
-    # iterate throught tokens
-    for i, token in enumerate(tokens_list):
-        if token == "(":
-            mem_map[i] += 1
-        elif token == ")":
-            mem_map[i] -= 1
-        elif token.isdigit():
-            if token in digit_set:
-                digit_set.remove(token)
-                mem_map[i] -= 1
-            else:
-                digit_set.add(token)
-                mem_map[i] += 1
+    Args:
+        batches_iter (iterable of pa.RecordBatch): results of the workers, with the schema
+        checkpoint_dir (string): the checkpoint directory
+        schema (pa.Schema): schema built by get_results_schema
+        row_group_size (integer): number of rows per row group
+        metrics_dict (dict): optional, the time spent writing is added to its write_time
+        writer_id (string): optional, the worker id naming the part files
 
-    return mem_map.cumsum()
+    return:
+        nb_rows (integer): number of rows written
+    """
+    # declare local variables
+    nb_rows = 0
+    batch_list = []
+    nb_buffered_rows = 0
+    write_time = 0.0
+
+    # every row group is a part file, the remainder is kept for the next part
+    for batch in batches_iter:
+        batch_list.append(batch)
+        nb_buffered_rows += batch.num_rows
+        while nb_buffered_rows >= row_group_size:
+            start_time = time.perf_counter()
+            table = pa.Table.from_batches(batch_list, schema)
+            write_checkpoint_part(table.slice(0, row_group_size).combine_chunks(),
+                                  checkpoint_dir, writer_id)
+            nb_rows += row_group_size
+            batch_list = table.slice(row_group_size).to_batches()
+            nb_buffered_rows -= row_group_size
+            write_time += time.perf_counter() - start_time
+
+    # write the last incomplete row group
+    if nb_buffered_rows:
+        start_time = time.perf_counter()
+        write_checkpoint_part(pa.Table.from_batches(batch_list, schema).combine_chunks(),
+                              checkpoint_dir, writer_id)
+        nb_rows += nb_buffered_rows
+        write_time += time.perf_counter() - start_time
+    if metrics_dict is not None:
+        metrics_dict["write_time"] = metrics_dict.get("write_time", 0.0) + write_time
+
+    return nb_rows
+
+
+def sort_by_predicted_cost(data_list: list, coefficients_list: list = None) -> list:
+    """
+    This function sort the molecules from the most to the least expensive,
+    so that the slowest molecules do not leave cores idle at the end of the task
 
+    Args:
+        data_list (list of dict): the rows of the csv database
+        coefficients_list (list of float): optional, the cost model of plan_chunks.py,
+        without it molecules are sorted by number of atoms, ring closures and branches
 
-def get_clearsmiles(params_dict: dict, nb_random: int, smiles_regex: re.compile) -> dict:
+    return:
+        sorted_data_list (list of dict): the rows sorted by decreasing predicted cost
     """
-    This function will get a set of ClearSMILES, this is a stochastic process, 
-    thus the number of ClearSMILES may vary. A high number of random search  should yield 
-    a stable number of ClearSMILES
-    input :
-        smiles (string): a valid SMILES 
-        nb_random (integer): the number of randomized kekule SMILES to generate,
-        i.e the number of random search
-        smiles_regex (compiled regex):  regex pattern used to tokenize SMILES 
-    output: 
-    results dict with string as keys and  various type of values 
-         nb_random  input is pass as such in 
-        max digit (integer), indicating the lowest maximum digit found in random SMILES
-        lowest_mem_score (float), indicates the lowest score obtained 
-        by one or more ClearSMILES, currently the mean of semantic memory per token
-        nb_unique_random_smiles (integer), number of unique randomized kekule SMILES
-        found by random search 
-        nb_lowest_max_digit_smiles (integer), number of randomized kekule SMILES 
-        with the lowest max digit found
-        nb_equivalent_solution  (integer) , which indicate the number of solution 
-        which achieved the lowest memory score 
-        ClearSMILES_set, value is (string): concatenation of the ClearSMILES_set 
-        as a string using "_" as a separator 
-        all keys including keyword time contains the duration of each stage of the pipeline,
-        and value associated are float
+    # the intercept is the first descriptor
+    if coefficients_list is None:
+        return sorted(data_list, key=lambda params_dict: get_descriptors(params_dict["SMILES"]),
+                      reverse=True)
+    coefficients_array = np.array(coefficients_list)
 
-    """
-    # assert that there is a smiles key
-    assert "SMILES" in params_dict, " the SMILES key was not found in param_dict \
-        please, ensure that the columns with smiles is named as SMILES in uppercase"
-
-    # declare local variable
-    mol = Chem.MolFromSmiles(params_dict["SMILES"])
-    lowest_digit_smiles_set = set()
-    lowest_mem_score_smiles_set = set()
-    results_dict = {
-        "nb_random": nb_random,
-        "max_digit": 9,
-        "lowest_mem_score": np.inf,
-        "nb_unique_random_smiles": int,
-        "nb_lowest_max_digit_smiles": int,
-        "nb_equivalent_solution": 0,
-        "ClearSMILES_set": str,
-        "random_gen_time": float,
-        "min_max_digit_time": float,
-        "mem_map_time": float,
-        # neglect the time to instantiate mol + empty sets
-        "total_time": time.perf_counter(),
-    }
-    results_dict.update(params_dict)
+    return sorted(data_list,
+                  key=lambda params_dict: float(
+                      np.dot(get_descriptors(params_dict["SMILES"]), coefficients_array)),
+                  reverse=True)
 
-    # generate randomized kekule SMILES
-    start_time = time.perf_counter()
-    randomized_kekule_smiles_set = set(
-        Chem.MolToRandomSmilesVect(mol, nb_random, kekuleSmiles=True))
-    results_dict["nb_unique_random_smiles"] = len(randomized_kekule_smiles_set)
-    results_dict["random_gen_time"] = time.perf_counter() - start_time
 
-    # find SMILES with lowest maximum digit
-    start_time = time.perf_counter()
-    for rd_smiles in randomized_kekule_smiles_set:
+def get_chunksize(nb_molecules: int, nb_core: int) -> int:
+    """ number of molecules per batch of a worker, small enough to keep the cores balanced """
+    return max(1, min(32, nb_molecules // (nb_core * 32)))
 
-        # declare loop variable
-        temp_max_digit = find_biggest_digits(rd_smiles)
 
-        # if a new minimum is reach clear the set
-        if temp_max_digit < results_dict["max_digit"]:
-            lowest_digit_smiles_set.clear()
-            results_dict["max_digit"] = temp_max_digit
+def get_task_config(config_dict: dict) -> dict:
+    """
+    This function complete the configuration of a task with the default values
 
-        # discard smiles if above current threshold
-        elif temp_max_digit > results_dict["max_digit"]:
-            continue
+    Args:
+        config_dict (dict): keys of DEFAULT_CONFIG_DICT, input_csv is required
 
-        lowest_digit_smiles_set.add(rd_smiles)
-    results_dict["nb_lowest_max_digit_smiles"] = len(lowest_digit_smiles_set)
-    results_dict["min_max_digit_time"] = time.perf_counter() - start_time
+    return:
+        task_config_dict (dict): a copy holding every key of DEFAULT_CONFIG_DICT
+    """
+    unknown_keys_list = sorted(set(config_dict) - set(DEFAULT_CONFIG_DICT))
+    if unknown_keys_list:
+        raise ValueError(f"unknown configuration keys: {unknown_keys_list}")
+    if not config_dict.get("input_csv"):
+        raise ValueError("the configuration of a task needs an input_csv")
 
-    # Keep SMILES with lowest maximum digit for which the semantic memory score is minimal
-    start_time = time.perf_counter()
-    for ld_smiles in lowest_digit_smiles_set:
+    return {**DEFAULT_CONFIG_DICT, **config_dict}
 
-        # declare loop variable
-        mem_map = get_semantic_mem_map(ld_smiles, smiles_regex)
-        temp_mem_score = np.mean(mem_map)
 
-        # if a new minimum is reached, clear the set
-        if temp_mem_score < results_dict["lowest_mem_score"]:
-            lowest_mem_score_smiles_set.clear()
-            results_dict["lowest_mem_score"] = temp_mem_score
+def load_task_rows(chunk_indices: dict, task_dict: dict, config_dict: dict) -> tuple:
+    """
+    This function read the rows of a task which are missing from its checkpoint,
+    sorted from the most to the least expensive
 
-        # discard SMILES if mem score threshold is passed
-        elif temp_mem_score > results_dict["lowest_mem_score"]:
-            continue
+    Args:
+        chunk_indices (dict): first_idx, last_idx and extra_idx of the rows of the task
+        task_dict (dict): checkpoint_dir and writer_id of the task
+        config_dict (dict): the configuration of the task
 
-        lowest_mem_score_smiles_set.add(ld_smiles)
-    results_dict["mem_map_time"] = time.perf_counter() - start_time
+    return:
+        data_list (list of dict): the rows to compute, with their row index
+        csv_keys_list (list of str): the columns of the database
+    """
+    # load data
+    data_list = wrapper_input_reader(input_path=config_dict["input_csv"],
+                                     first_idx=chunk_indices["first_idx"],
+                                     last_idx=chunk_indices["last_idx"],
+                                     extra_idx=chunk_indices["extra_idx"],
+                                     index_path=config_dict["index_path"],
+                                     row_idx_key=ROW_IDX_KEY,
+                                     columns_list=config_dict["columns_list"])
 
-    # concatenate found ClearSMILES as string
-    results_dict["ClearSMILES_set"] = "_".join(lowest_mem_score_smiles_set)
-    results_dict["nb_equivalent_solution"] = len(lowest_mem_score_smiles_set)
+    # skip the rows computed by a previous run of the task
+    finished_rows_set = load_finished_rows(task_dict["checkpoint_dir"], task_dict["writer_id"])
+    csv_keys_list = [key for key in data_list[0] if key != ROW_IDX_KEY] \
+        if data_list else ["SMILES"]
+    data_list = [params_dict for params_dict in data_list
+                 if params_dict[ROW_IDX_KEY] not in finished_rows_set]
 
-    # compute total time duration
-    results_dict["total_time"] = time.perf_counter() - \
-        results_dict["total_time"]
+    return sort_by_predicted_cost(data_list, config_dict["coefficients_list"]), csv_keys_list
 
-    return results_dict
 
+def get_task_pool(pool_dict: dict, config_dict: dict, schema: pa.Schema) -> Pool:
+    """
+    This function create the pool of workers, or reuse the persistent pool
+    created by a previous task of the process, the arguments are sent once per worker
 
-def main(input_csv: str,
-         output_filepath: str,
-         nb_random: int,
-         chunk_indices: dict,
-         ) -> None:
-    """ generate ClearSMILES for a chunck of csv database 
+    Args:
+        pool_dict (dict): the pool and the schema of its record batches, updated in place
+        config_dict (dict): the configuration of the task
+        schema (pa.Schema): schema of the results of the task
 
+    return:
+        pool (multiprocessing.Pool): the pool computing the task
     """
-    # declare local variables
-    smiles_tokens_regex = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|"
-    smiles_tokens_regex += r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
-    smiles_regex = re.compile(smiles_tokens_regex)
+    if pool_dict.get("pool") is None:
+        pool_dict["pool"] = Pool(config_dict["nb_core"], initializer=init_worker,
+                                 initargs=({key: config_dict[key] for key in CLEARSMILES_KEYS},
+                                           config_dict["cache_dir"],
+                                           config_dict["cache_max_size_mb"],
+                                           schema, config_dict["nb_profiled"]),
+                                 maxtasksperchild=config_dict["max_tasks_per_child"])
+        pool_dict["schema"] = schema
+    elif pool_dict["schema"] != schema:
+        raise ValueError("the tasks sharing a pool must read the same columns")
 
-    # load data
-    data_list = wrapper_csv_reader(csv_path=input_csv,
-                                   first_idx=chunk_indices["first_idx"],
-                                   last_idx=chunk_indices["last_idx"],
-                                   extra_idx=chunk_indices["extra_idx"])
+    return pool_dict["pool"]
 
-    # prep multiprocessing
-    gen_clearsmiles = partial(get_clearsmiles,
-                              nb_random=nb_random,
-                              smiles_regex=smiles_regex)
 
-    # number of worker is number of available cores
-    with Pool(len(os.sched_getaffinity(0))) as pool:
-        results_list = pool.map(gen_clearsmiles, data_list)
-        pool.close()
-        pool.join()
+def run_pool(task_dict: dict, config_dict: dict, metrics_dict: dict) -> dict:
+    """
+    This function compute the batches of a task in the pool and write their results
+    to the checkpoint as they complete. A task interrupted by its deadline or by the loss
+    of its lease terminates the pool, the molecules still running are lost
 
-    # convert into pyarrow table then to parquet file
-    # not seting schema due to csv content incertainty
-    table = pa.Table.from_pylist(results_list)
-    pq.write_table(table, output_filepath)
+    Args:
+        task_dict (dict): checkpoint_dir, writer_id, schema, params_batches_list, pool_dict,
+        is_own_pool and lease_dict of the task
+        config_dict (dict): the configuration of the task
+        metrics_dict (dict): the metrics of the task, updated in place
 
+    return:
+        worker_stats_dict (dict): the statistics of every worker, see iter_worker_results
+    """
+    # declare local variables
+    worker_stats_dict = {}
+    pool_dict = task_dict["pool_dict"]
+    task_time_limit = config_dict["task_time_limit"]
+
+    # an empty task does not check the schema of the persistent pool
+    if not task_dict["params_batches_list"] and pool_dict.get("pool") is not None:
+        pool = pool_dict["pool"]
+    else:
+        pool = get_task_pool(pool_dict, config_dict, task_dict["schema"])
+    is_interrupted = True
+    try:
+        metrics_dict["pool_start_time"] = time.time()
+        results_iter = pool.imap_unordered(process_batch, task_dict["params_batches_list"])
+        if task_time_limit is not None or task_dict["lease_dict"] is not None:
+            results_iter = iter_until_deadline(results_iter,
+                                               None if task_time_limit is None else
+                                               metrics_dict["task_start_time"] + task_time_limit,
+                                               metrics_dict, task_dict["lease_dict"])
+        write_results(batches_iter=iter_worker_results(results_iter, worker_stats_dict,
+                                                       metrics_dict),
+                      checkpoint_dir=task_dict["checkpoint_dir"],
+                      schema=task_dict["schema"],
+                      row_group_size=config_dict["row_group_size"],
+                      metrics_dict=metrics_dict,
+                      writer_id=task_dict["writer_id"])
+        is_interrupted = metrics_dict["deadline_reached"] or metrics_dict["lease_lost"]
+    finally:
+        # the molecules still running are lost, they are computed again by the relaunch
+        if is_interrupted:
+            pool.terminate()
+            pool_dict["pool"] = None
+        elif task_dict["is_own_pool"]:
+            pool.close()
+        if is_interrupted or task_dict["is_own_pool"]:
+            pool.join()
+    pool_dict["deadline_reached"] = metrics_dict["deadline_reached"]
+
+    # the lease may have been lost after the last output
+    metrics_dict["lease_lost"] = task_dict["lease_dict"] is not None and \
+        task_dict["lease_dict"]["lost"]
+
+    return worker_stats_dict
+
+
+def report_cache(cache_dir: str, worker_stats_dict: dict) -> None:
+    """ add the hits and misses of a task to the persistent counters of the cache,
+    and print them """
+    cache_dict = open_cache(cache_dir)
+    nb_hits = sum(worker_stats["nb_hits"] for worker_stats in worker_stats_dict.values())
+    nb_molecules = sum(worker_stats["nb_molecules"] for worker_stats in worker_stats_dict.values())
+    add_cache_counters(cache_dict, nb_hits, nb_molecules - nb_hits)
+    stats_dict = get_cache_stats(cache_dict)
+    close_cache(cache_dict)
+    print(f"cache: {nb_hits} hits, {nb_molecules - nb_hits} misses for this task, "
+          f"{stats_dict['hits']} hits, {stats_dict['misses']} misses, "
+          f"{stats_dict['nb_entries']} entries, {stats_dict['size'] / 1e6:.1f} MB in total")
+
+
+def write_task_metrics(task_dict: dict, config_dict: dict, metrics_dict: dict,
+                       worker_stats_dict: dict) -> None:
+    """
+    This function write the metrics of a task, the stages are summarized from the output
+
+    Args:
+        task_dict (dict): output_filepath and params_batches_list of the task
+        config_dict (dict): the configuration of the task
+        metrics_dict (dict): the metrics collected while the task ran
+        worker_stats_dict (dict): the statistics of every worker
+    """
+    # declare local variables
+    output_filepath = task_dict["output_filepath"]
+    pool_time = metrics_dict["pool_time"]
+
+    write_metrics({
+        "task": {
+            "output_filepath": output_filepath,
+            "input_path": config_dict["input_csv"],
+            "nb_molecules": metrics_dict["nb_molecules"],
+            "nb_batches": len(task_dict["params_batches_list"]),
+            "nb_core": config_dict["nb_core"],
+            "chunksize": config_dict["chunksize"],
+            "read_time": metrics_dict["read_time"],
+            "pool_time": pool_time,
+            "write_time": metrics_dict["write_time"],
+            "merge_time": metrics_dict["merge_time"],
+            "wall_time": time.perf_counter() - metrics_dict["task_start_time"],
+            "peak_rss_mb": get_peak_rss_mb(),
+            "deadline_reached": metrics_dict["deadline_reached"],
+            "lease_lost": metrics_dict["lease_lost"],
+        },
+        "workers": {str(worker_pid): dict(worker_stats,
+                                          utilization=worker_stats["busy_time"] / pool_time
+                                          if pool_time else 0.0)
+                    for worker_pid, worker_stats in worker_stats_dict.items()},
+        "queue_wait_time": metrics_dict["queue_wait_time"],
+        "result_wait_time": metrics_dict["result_wait_time"],
+        "stages": {column: summarize_values(values_list) for column, values_list
+                   in read_stage_times(output_filepath).items()}
+        if os.path.exists(output_filepath) else {},
+        "slowest_molecules": metrics_dict["slowest_molecules"],
+    }, config_dict["metrics_path"] or get_metrics_path(output_filepath))
+
+
+def main(output_filepath: str,
+         chunk_indices: dict,
+         config_dict: dict,
+         pool_dict: dict = None,
+         lease_dict: dict = None,
+         ) -> None:
+    """ generate ClearSMILES for a chunck of a parquet, csv or .smi database,
+    compressed csv and .smi files are supported, only the columns of columns_list
+    are read and passed to the workers, all columns if None.
+    results are checkpointed by row groups of row_group_size molecules as soon as
+    they are computed, a relaunched task only computes the rows missing from the checkpoint,
+    and refuses a checkpoint written with other search parameters (CHECKPOINT_KEYS).
+    The checkpoint is merged into the output parquet file at the end of the task,
+    sorted by row index.
+    Molecules are dispatched from the most to the least expensive to nb_core workers,
+    by default the number of available cores, by batches of chunksize molecules whose
+    results are sent back as Arrow record batches. When a cache directory is given,
+    molecules already computed with the same parameters are read from the cache.
+    The metrics of the task are written to metrics_path, by default next to the output,
+    with the cProfile reports of the nb_profiled slowest molecules.
+    Every molecule gets a wall clock budget of time_budget seconds, and the task stops
+    task_time_limit seconds after its start: the completed results are written
+    to the checkpoint and the workers are killed, the checkpoint is not merged
+    so that the relaunched task only computes the missing rows.
+    A persistent pool can be shared by the tasks run in the same process through pool_dict,
+    it is created by the first task, and closed by the caller.
+    The rows of a work queue are computed under the lease of lease_dict: once it is lost,
+    the rows belong to another worker, the task stops like at its deadline and the output
+    is not written. The part files of the checkpoint are then named with the worker id,
+    and a row computed by both workers is merged once
+
+    Args:
+        output_filepath (str): the output parquet file
+        chunk_indices (dict): first_idx, last_idx and extra_idx of the rows of the task
+        config_dict (dict): the configuration of the task, the keys of DEFAULT_CONFIG_DICT,
+        input_csv is required and the missing keys get their default value
+        pool_dict (dict): optional, the persistent pool shared by the tasks of the process
+        lease_dict (dict): optional, the lease of the rows yielded by work_queue.hold_lease
+    """
+    # declare local variables
+    config_dict = get_task_config(config_dict)
+    metrics_dict = {"task_start_time": time.perf_counter(), "queue_wait_time": [],
+                    "result_wait_time": [], "slowest_molecules": [],
+                    "nb_profiled": config_dict["nb_profiled"], "write_time": 0.0,
+                    "deadline_reached": False, "lease_lost": False}
+    task_dict = {"output_filepath": output_filepath,
+                 "checkpoint_dir": get_checkpoint_dir(output_filepath),
+                 "pool_dict": {} if pool_dict is None else pool_dict,
+                 "is_own_pool": pool_dict is None,
+                 "lease_dict": lease_dict,
+                 "writer_id": None if lease_dict is None else get_worker_id()}
+
+    # load the rows missing from the checkpoint, computed with the same parameters
+    check_checkpoint_params(task_dict["checkpoint_dir"],
+                            {key: config_dict[key] for key in CHECKPOINT_KEYS})
+    data_list, csv_keys_list = load_task_rows(chunk_indices, task_dict, config_dict)
+    metrics_dict["read_time"] = time.perf_counter() - metrics_dict["task_start_time"]
+    metrics_dict["nb_molecules"] = len(data_list)
+
+    # the csv columns are known from the header, every value is read as a string
+    task_dict["schema"] = get_results_schema(csv_keys_list)
+    config_dict["nb_core"] = config_dict["nb_core"] or len(os.sched_getaffinity(0))
+    config_dict["chunksize"] = config_dict["chunksize"] or \
+        get_chunksize(len(data_list), config_dict["nb_core"])
+
+    # largest molecules first, results are written in completion order
+    start_time = time.perf_counter()
+    task_dict["params_batches_list"] = [data_list[batch_idx:batch_idx + config_dict["chunksize"]]
+                                        for batch_idx in range(0, len(data_list),
+                                                               config_dict["chunksize"])]
+    worker_stats_dict = run_pool(task_dict, config_dict, metrics_dict)
+    metrics_dict["pool_time"] = time.perf_counter() - start_time
+    print_worker_report(worker_stats_dict, metrics_dict["pool_time"])
+
+    # persistent hit and miss counters of the cache
+    if config_dict["cache_dir"]:
+        report_cache(config_dict["cache_dir"], worker_stats_dict)
+
+    # merge the checkpoint into the output parquet file, unless the task is incomplete
+    start_time = time.perf_counter()
+    if metrics_dict["lease_lost"]:
+        print(f"lease of {output_filepath} lost, the rows are computed by another worker")
+    elif metrics_dict["deadline_reached"]:
+        nb_finished_rows = len(load_finished_rows(task_dict["checkpoint_dir"],
+                                                  task_dict["writer_id"]))
+        print(f"deadline of {config_dict['task_time_limit']}s reached, {nb_finished_rows} "
+              f"rows are kept in {task_dict['checkpoint_dir']}, relaunch the task to complete it")
+    else:
+        merge_checkpoint(task_dict["checkpoint_dir"], output_filepath, task_dict["schema"],
+                         config_dict["row_group_size"])
+    metrics_dict["merge_time"] = time.perf_counter() - start_time
+
+    # the metrics of the task
+    write_task_metrics(task_dict, config_dict, metrics_dict, worker_stats_dict)
 
 if __name__ == '__main__':
     # argparser
     parser = argparse.ArgumentParser()
 
     # files & directory arguments
-    parser.add_argument('--input_csv', help="the inputh path to csv database",
+    parser.add_argument('--input_csv', help="the inputh path to the database, a csv file, \
+                        a parquet file or a .smi file, csv and .smi files can be compressed \
+                        with gzip (.gz) or zstd (.zst)",
                         default="data/raw/whole_original_MOSES.csv", type=str)
+    parser.add_argument('--columns', help="columns of the database passed to the workers \
+                        and copied to the results, must include SMILES, all columns by default",
+                        default=None,
+                        nargs="+",
+                        type=str)
+    parser.add_argument('--index_path', help="the byte offset index built by csv_index.py, \
+                        by default the csv path followed by .idx.json",
+                        default=None, type=str)
     parser.add_argument('--output_filepath', help="the output file should be a parquet",
                         default="data/interim/ClearSMILES_MOSES_subset_0.parquet",
                         type=str)
@@ -333,17 +720,119 @@ if __name__ == '__main__':
     parser.add_argument('--task_id', help="the job id in the job array",
                         default=0,
                         type=int)
+    parser.add_argument('--task_ids', help="several job ids run one after another \
+                        in this process with a single pool, in SLURM --array syntax, \
+                        e.g: 0-99 or 1,14,30, replaces --task_id",
+                        default=None,
+                        type=str)
+    parser.add_argument('--output_pattern', help="output path of the tasks of --task_ids \
+                        or of the ranges of --queue_dir, * is replaced by the task id \
+                        or by the range name",
+                        default="data/interim/ClearSMILES_MOSES_subset_*.parquet",
+                        type=str)
     parser.add_argument('--job_array_size', help="the number of jobs in the job array",
                         default=2000,
                         type=int)
+    parser.add_argument('--plan_file', help="json plan written by plan_chunks.py, \
+                        replaces the equal-count split of --nb_smiles and --job_array_size",
+                        default=None,
+                        type=str)
+    parser.add_argument('--queue_dir', help="shared work queue replacing the job array split, \
+                        the worker claims ranges of --range_size rows until none is left, \
+                        the queue is created by the first worker",
+                        default=None,
+                        type=str)
+    parser.add_argument('--range_size', help="number of rows per range of the work queue",
+                        default=1000,
+                        type=int)
+    parser.add_argument('--lease_time', help="duration in seconds after which the range \
+                        of a worker which stopped renewing its lease is claimed again",
+                        default=600.0,
+                        type=float)
 
     # computation argument
-    parser.add_argument('--nb_core', help="number of core to allocate for multiprocressing",
-                        default=4,
+    parser.add_argument('--nb_core', help="number of core to allocate for multiprocressing, \
+                        by default the number of available cores",
+                        default=None,
+                        type=int)
+    parser.add_argument('--max_tasks_per_child', help="number of batches of --chunksize \
+                        molecules after which a worker is replaced, caps the memory growth \
+                        of workers",
+                        default=None,
+                        type=int)
+    parser.add_argument('--store_mem_maps', help="store the semantic memory map \
+                        of every ClearSMILES as a list of int8",
+                        default=False,
+                        action="store_true")
+    parser.add_argument('--cache_dir', help="directory of the result cache shared by the tasks, \
+                        keyed by canonical SMILES and search parameters, disabled by default",
+                        default=None,
+                        type=str)
+    parser.add_argument('--cache_max_size_mb', help="size limit of the result cache \
+                        in megabytes, the least recently used results are evicted",
+                        default=None,
+                        type=float)
+    parser.add_argument('--chunksize', help="number of molecules per batch of a worker, \
+                        by default computed from the number of molecules and of cores",
+                        default=None,
+                        type=int)
+    parser.add_argument('--metrics_path', help="the metrics json file of the task, \
+                        by default the output path followed by .metrics.json",
+                        default=None,
+                        type=str)
+    parser.add_argument('--nb_profiled', help="number of slowest molecules whose cProfile \
+                        report is stored in the metrics, every molecule is then profiled",
+                        default=0,
+                        type=int)
+    parser.add_argument('--row_group_size', help="number of molecules written at once \
+                        in the checkpoint, it bounds the memory used by the results \
+                        and the work lost when a task is killed",
+                        default=1000,
                         type=int)
     parser.add_argument('--nb_random', help="number of randomized kekule SMILES to use",
                         default=1_00_000,
                         type=int)
+    parser.add_argument('--batch_size', help="number of randomized kekule SMILES per batch, \
+                        enable early stopping of the random search, nb_random is the hard cap",
+                        default=None,
+                        type=int)
+    parser.add_argument('--patience', help="number of batches without any change of the \
+                        ClearSMILES before stopping the random search",
+                        default=3,
+                        type=int)
+    parser.add_argument('--search', help="random search, or exhaustive enumeration of the \
+                        traversals with branch-and-bound which falls back to random search",
+                        default="random",
+                        choices=["random", "exhaustive"],
+                        type=str)
+    parser.add_argument('--max_exhaustive_atoms', help="number of atoms above which the \
+                        exhaustive search falls back to random search",
+                        default=30,
+                        type=int)
+    parser.add_argument('--exhaustive_time_limit', help="duration in seconds after which the \
+                        exhaustive search falls back to random search",
+                        default=60.0,
+                        type=float)
+    parser.add_argument('--max_closure_orders', help="maximal number of ring closure orders \
+                        written per traversal by the exhaustive search, the molecules above it \
+                        are flagged as exhaustive_truncated",
+                        default=64,
+                        type=int)
+    parser.add_argument('--time_budget', help="wall clock budget of a molecule in seconds, \
+                        checked between batches of the search, a molecule running out of time \
+                        keeps its best ClearSMILES so far and is flagged as timed_out",
+                        default=None,
+                        type=float)
+    parser.add_argument('--task_time_limit', help="duration in seconds after which the task \
+                        writes its completed results to the checkpoint and stops, \
+                        set it a few minutes below the time limit of the SLURM job",
+                        default=None,
+                        type=float)
+    parser.add_argument('--sampling', help="draw randomized SMILES from random root atoms, \
+                        or spread the draws over the symmetry classes of root atoms",
+                        default="uniform",
+                        choices=["uniform", "stratified"],
+                        type=str)
 
     # parse and converto dict
     args, _ = parser.parse_known_args()
@@ -358,16 +847,60 @@ if __name__ == '__main__':
     log_dir = Path(__file__).resolve().parents[0]
     os.makedirs("logs/", exist_ok=True)
 
-    # compute data chunk indices
-    chunk_dict = compute_chunk_idx(
-        nb_smiles=args_dict["nb_smiles"],
-        task_id=args_dict["task_id"],
-        job_array_size=args_dict["job_array_size"]
-    )
+    # compute data chunk indices, the plan file replaces the equal-count split
+    task_id_list = parse_job_array_range(args_dict["task_ids"]) if args_dict["task_ids"] \
+        else [args_dict["task_id"]]
+    if args_dict["plan_file"]:
+        plan_chunks_list = load_plan_chunks(args_dict["plan_file"])
+        chunks_list = [(task_id, plan_chunks_list[task_id]) for task_id in task_id_list]
+    else:
+        chunks_list = [(task_id, compute_chunk_idx(nb_smiles=args_dict["nb_smiles"],
+                                                   task_id=task_id,
+                                                   job_array_size=args_dict["job_array_size"]))
+                       for task_id in task_id_list]
+
+    # the configuration shared by the tasks
+    task_config_dict = {
+        "input_csv": args_dict["input_csv"],
+        "nb_random": args_dict["nb_random"],
+        "batch_size": args_dict["batch_size"],
+        "patience": args_dict["patience"],
+        "search": args_dict["search"],
+        "max_exhaustive_atoms": args_dict["max_exhaustive_atoms"],
+        "exhaustive_time_limit": args_dict["exhaustive_time_limit"],
+        "max_closure_orders": args_dict["max_closure_orders"],
+        "sampling": args_dict["sampling"],
+        "index_path": args_dict["index_path"],
+        "row_group_size": args_dict["row_group_size"],
+        "nb_core": args_dict["nb_core"],
+        "max_tasks_per_child": args_dict["max_tasks_per_child"],
+        "chunksize": args_dict["chunksize"],
+        "coefficients_list": load_coefficients(args_dict["plan_file"])
+        if args_dict["plan_file"] else None,
+        "cache_dir": args_dict["cache_dir"],
+        "cache_max_size_mb": args_dict["cache_max_size_mb"],
+        "store_mem_maps": args_dict["store_mem_maps"],
+        "columns_list": args_dict["columns"],
+        "nb_profiled": args_dict["nb_profiled"],
+        "time_budget": args_dict["time_budget"],
+        "metrics_path": args_dict["metrics_path"],
+        "task_time_limit": args_dict["task_time_limit"],
+    }
 
     # execute main
-    main(input_csv=args_dict["input_csv"],
-         output_filepath=args_dict["output_filepath"],
-         nb_random=args_dict["nb_random"],
-         chunk_indices=chunk_dict
-         )
+    if args_dict["queue_dir"]:
+        create_queue(queue_dir=args_dict["queue_dir"],
+                     nb_smiles=args_dict["nb_smiles"],
+                     range_size=args_dict["range_size"])
+        task_runners.run_queue_worker(queue_dir=args_dict["queue_dir"],
+                                      output_pattern=args_dict["output_pattern"],
+                                      config_dict=task_config_dict,
+                                      lease_time=args_dict["lease_time"])
+    elif args_dict["task_ids"]:
+        task_runners.run_tasks(task_chunks_list=chunks_list,
+                               output_pattern=args_dict["output_pattern"],
+                               config_dict=task_config_dict)
+    else:
+        main(output_filepath=args_dict["output_filepath"],
+             chunk_indices=chunks_list[0][1],
+             config_dict=task_config_dict)
@@ -0,0 +1,271 @@
+"""
+This module is the engine of the pool workers of generate_clearsmiles.py:
+a worker is initialized once with the search parameters and the result cache,
+then computes batches of molecules and sends back their results as Arrow IPC buffers.
+The parent unpacks the buffers, accumulates the statistics of every worker
+and stops reading the pool at the deadline of the task or once its lease is lost
+"""
+from __future__ import annotations
+import os
+import sys
+import time
+import re
+from multiprocessing import TimeoutError as PoolTimeoutError
+from pathlib import Path
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+from features.clearsmiles_search import SMILES_TOKENS_REGEX, get_results_fields, \
+    get_clearsmiles
+from features.result_cache import open_cache, get_cache_key, cache_get, cache_put, \
+    flush_accesses
+from features.run_metrics import get_peak_rss_mb, profile_call, keep_slowest
+
+# heavy dependencies are imported on first use
+pa = LazyModule("pyarrow")
+Chem = LazyModule("rdkit.Chem")
+
+# interval in seconds at which a task holding a lease checks that it was not lost
+LEASE_POLL_TIME = 0.5
+
+# state of a pool worker, set once by init_worker
+WORKER_STATE_DICT = {}
+
+
+def serialize_batch(batch: pa.RecordBatch) -> bytes:
+    """ write a record batch as an Arrow IPC stream, sent by the workers to the parent """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize_batch(buffer: bytes) -> pa.RecordBatch:
+    """ read a record batch written by serialize_batch, the columns are not copied """
+    return pa.ipc.open_stream(buffer).read_next_batch()
+
+
+def init_worker(clearsmiles_kwargs: dict, cache_dir: str = None,
+                cache_max_size_mb: float = None, schema: pa.Schema = None,
+                nb_profiled: int = 0) -> None:
+    """
+    This function initialize a pool worker once, the tokenizer is compiled in the worker
+    instead of being pickled with every molecule, and the result cache is opened
+
+    Args:
+        clearsmiles_kwargs (dict): keyword arguments of get_clearsmiles, except smiles_regex
+        cache_dir (str): optional, the directory of the result cache
+        cache_max_size_mb (float): optional, size limit of the result cache in megabytes
+        schema (pa.Schema): optional, schema of the record batches built by process_batch
+        nb_profiled (int): number of slowest molecules of the worker profiled with cProfile
+    """
+    WORKER_STATE_DICT["smiles_regex"] = re.compile(SMILES_TOKENS_REGEX)
+    WORKER_STATE_DICT["clearsmiles_kwargs"] = clearsmiles_kwargs
+    WORKER_STATE_DICT["schema"] = schema
+    WORKER_STATE_DICT["nb_profiled"] = nb_profiled
+    WORKER_STATE_DICT["profiles_list"] = []
+    WORKER_STATE_DICT["cache_dict"] = open_cache(cache_dir, max_size_mb=cache_max_size_mb) \
+        if cache_dir else None
+
+
+def process_molecule(params_dict: dict) -> tuple:
+    """
+    This function get the ClearSMILES of a molecule in a pool worker,
+    the result cache is consulted before searching
+
+    Args:
+        params_dict (dict): a row of the csv database
+
+    return:
+        results_dict (dict): the results of get_clearsmiles
+        worker_pid (int): the process id of the worker
+        busy_time (float): the duration of the computation in seconds
+    """
+    # declare local variables
+    start_time = time.perf_counter()
+    cache_dict = WORKER_STATE_DICT["cache_dict"]
+    mol = Chem.MolFromSmiles(params_dict["SMILES"]) if cache_dict else None
+
+    # the cached results are computed on the same molecule, whatever its input SMILES
+    if mol is not None:
+        canonical_smiles = Chem.MolToSmiles(mol)
+        key = get_cache_key(canonical_smiles, WORKER_STATE_DICT["clearsmiles_kwargs"])
+        results_dict = cache_get(cache_dict, key)
+        if results_dict is not None:
+            results_dict.update(params_dict)
+            results_dict["cache_hit"] = True
+            return results_dict, os.getpid(), time.perf_counter() - start_time
+
+    # search then cache the results without the csv columns
+    results_dict = get_clearsmiles(params_dict,
+                                   smiles_regex=WORKER_STATE_DICT["smiles_regex"],
+                                   **WORKER_STATE_DICT["clearsmiles_kwargs"])
+    results_dict["cache_hit"] = False
+    # the best-so-far results of a timed out molecule are not final
+    if mol is not None and not results_dict["timed_out"]:
+        cache_put(cache_dict, key, canonical_smiles,
+                  {column: results_dict[column] for column, _ in get_results_fields()})
+
+    return results_dict, os.getpid(), time.perf_counter() - start_time
+
+
+def process_batch(params_list: list) -> tuple:
+    """
+    This function get the ClearSMILES of a batch of molecules in a pool worker,
+    the results are sent back as an Arrow IPC buffer built with the schema of the output,
+    so that the parent never handles the results row by row.
+    When profiling is enabled, every molecule is run under cProfile
+    and the reports of the slowest molecules of the worker are sent back
+
+    Args:
+        params_list (list of dict): rows of the csv database
+
+    return:
+        buffer (bytes): the results, serialized by serialize_batch
+        batch_metrics_dict (dict): pid of the worker, busy_time, nb_molecules, nb_hits,
+        nb_timed_out, start and end wall clock times, peak_rss_mb of the worker, and new profiles
+    """
+    # declare local variables
+    start_time = time.time()
+    nb_profiled = WORKER_STATE_DICT["nb_profiled"]
+    results_list = []
+    new_profiles_list = []
+    busy_time = 0.0
+
+    for params_dict in params_list:
+        if not nb_profiled:
+            results_dict, _, molecule_time = process_molecule(params_dict)
+        else:
+            (results_dict, _, molecule_time), profile_text = profile_call(process_molecule,
+                                                                          params_dict)
+            new_profiles_list.append({"SMILES": params_dict["SMILES"],
+                                      "total_time": molecule_time,
+                                      "profile": profile_text})
+        results_list.append(results_dict)
+        busy_time += molecule_time
+    batch = pa.RecordBatch.from_pylist(results_list, schema=WORKER_STATE_DICT["schema"])
+
+    # the access times of the cache hits of the batch are written at once
+    if WORKER_STATE_DICT["cache_dict"]:
+        flush_accesses(WORKER_STATE_DICT["cache_dict"])
+
+    # only the profiles entering the slowest molecules of the worker are sent
+    if nb_profiled:
+        profiles_list = keep_slowest(WORKER_STATE_DICT["profiles_list"], new_profiles_list,
+                                     nb_profiled)
+        new_profiles_list = [profile_dict for profile_dict in profiles_list
+                             if profile_dict not in WORKER_STATE_DICT["profiles_list"]]
+        WORKER_STATE_DICT["profiles_list"] = profiles_list
+
+    batch_metrics_dict = {
+        "pid": os.getpid(),
+        "busy_time": busy_time,
+        "nb_molecules": len(results_list),
+        "nb_hits": sum(results_dict["cache_hit"] for results_dict in results_list),
+        "nb_timed_out": sum(bool(results_dict.get("timed_out"))
+                            for results_dict in results_list),
+        "start_time": start_time,
+        "end_time": time.time(),
+        "peak_rss_mb": get_peak_rss_mb(),
+        "profiles": new_profiles_list,
+    }
+
+    return serialize_batch(batch), batch_metrics_dict
+
+
+def iter_worker_results(results_iter, worker_stats_dict: dict, metrics_dict: dict = None):
+    """
+    This generator unpack the outputs of process_batch
+    and accumulate the statistics of every worker
+
+    Args:
+        results_iter (iterable of tuple): outputs of process_batch
+        worker_stats_dict (dict): pid as keys, number of molecules, busy time,
+        number of cache hits, number of timed out molecules and peak memory as values,
+        updated in place
+        metrics_dict (dict): optional, the queue and result wait times of the batches
+        and the profiles of the slowest molecules are added to it,
+        it must hold the pool_start_time and the number of profiled molecules
+
+    yield:
+        batch (pa.RecordBatch): the results of get_clearsmiles
+    """
+    for buffer, batch_metrics_dict in results_iter:
+        worker_stats = worker_stats_dict.setdefault(
+            batch_metrics_dict["pid"],
+            {"nb_molecules": 0, "busy_time": 0.0, "nb_hits": 0, "nb_timed_out": 0,
+             "peak_rss_mb": 0.0})
+        for key in ("nb_molecules", "busy_time", "nb_hits", "nb_timed_out"):
+            worker_stats[key] += batch_metrics_dict[key]
+        worker_stats["peak_rss_mb"] = max(worker_stats["peak_rss_mb"],
+                                          batch_metrics_dict["peak_rss_mb"])
+
+        # every batch is queued when the pool starts
+        if metrics_dict is not None:
+            metrics_dict["queue_wait_time"].append(batch_metrics_dict["start_time"] -
+                                                   metrics_dict["pool_start_time"])
+            metrics_dict["result_wait_time"].append(time.time() -
+                                                    batch_metrics_dict["end_time"])
+            metrics_dict["slowest_molecules"] = keep_slowest(
+                metrics_dict["slowest_molecules"], batch_metrics_dict["profiles"],
+                metrics_dict["nb_profiled"])
+        yield deserialize_batch(buffer)
+
+
+def iter_until_deadline(results_iter, deadline: float, metrics_dict: dict,
+                        lease_dict: dict = None):
+    """
+    This generator yield the outputs of the pool until the deadline of the task,
+    or until the lease of the rows is lost, the outputs already completed
+    at the deadline are still yielded. The file of the claimed range is checked
+    on every tick, a range claimed again by another worker is thus noticed
+    within LEASE_POLL_TIME, long before the renewal of the lease fails
+
+    Args:
+        results_iter (multiprocessing IMapIterator): the outputs of imap_unordered
+        deadline (float): the deadline, a time.perf_counter value, None for no deadline
+        metrics_dict (dict): deadline_reached is set to True if the deadline was reached
+        before the last output, lease_lost if the lease was lost
+        lease_dict (dict): optional, the lease held by the task, checked every LEASE_POLL_TIME
+
+    yield:
+        output (tuple): the next output of the pool
+    """
+    # declare local variables
+    deadline = float("inf") if deadline is None else deadline
+
+    while True:
+        if lease_dict is not None and \
+                (lease_dict["lost"] or not os.path.exists(lease_dict["claim_path"])):
+            lease_dict["lost"] = True
+            metrics_dict["lease_lost"] = True
+            return
+        timeout = max(deadline - time.perf_counter(), 0.0)
+        try:
+            yield results_iter.next(timeout=timeout if lease_dict is None else
+                                    min(timeout, LEASE_POLL_TIME))
+        except StopIteration:
+            return
+        except PoolTimeoutError:
+            if time.perf_counter() >= deadline:
+                metrics_dict["deadline_reached"] = True
+                return
+
+
+def print_worker_report(worker_stats_dict: dict, wall_time: float) -> None:
+    """
+    This function print the number of molecules, the utilization and the peak memory
+    of every worker
+
+    Args:
+        worker_stats_dict (dict): statistics filled by iter_worker_results
+        wall_time (float): duration of the pool in seconds
+    """
+    for worker_pid, worker_stats in sorted(worker_stats_dict.items()):
+        utilization = worker_stats["busy_time"] / wall_time * 100 if wall_time else 0.0
+        print(f"worker {worker_pid}: {worker_stats['nb_molecules']} molecules, "
+              f"{worker_stats['nb_hits']} cache hits, "
+              f"{worker_stats['nb_timed_out']} timed out, busy {worker_stats['busy_time']:.2f}s, "
+              f"utilization {utilization:.1f}%, peak rss {worker_stats['peak_rss_mb']:.0f} MB")
@@ -1,56 +1,138 @@
 """
-This scripts is used to find the jobs that have failed during 
-the jobs array so they can be relaunched
+This scripts is used to find the jobs that have failed during
+the jobs array so they can be relaunched.
+Only the parquet footers are read, in parallel threads, the number of rows of every task
+is checked against the chunk the task was assigned, hence truncated or partially written
+files are reported as failed
 """
+from __future__ import annotations
 import os
+import sys
 from pathlib import Path
 import argparse
-import glob
+from concurrent.futures import ThreadPoolExecutor
 
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+from features.plan_chunks import load_plan_chunks, parse_job_array_range, \
+    format_job_array_range
+from features.generate_clearsmiles import compute_chunk_idx
 
-def main(search_pattern: str, output_filepath: str, job_array_range: str) -> None:
+# heavy dependencies are imported on first use
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
+
+
+def get_expected_nb_rows(task_id: int, nb_smiles: int, job_array_size: int,
+                         plan_chunks_list: list = None) -> int:
+    """
+    This function compute the number of rows a task should have written
+
+    Args:
+        task_id (int): the index of the task in job array
+        nb_smiles (int): number of total smiles to be processed
+        job_array_size (int): number of task in job array
+        plan_chunks_list (list of dict): optional, the chunks of the plan written by
+        plan_chunks.py, read once by load_plan_chunks
+
+    return:
+        nb_rows (int): the size of the chunk of the task
+    """
+    if plan_chunks_list:
+        chunk_dict = plan_chunks_list[task_id]
+    else:
+        chunk_dict = compute_chunk_idx(nb_smiles, task_id, job_array_size)
+
+    return chunk_dict["last_idx"] - chunk_dict["first_idx"] + \
+        (chunk_dict["extra_idx"] is not None)
+
+
+def validate_task(task_path: str, expected_nb_rows: int) -> str:
+    """
+    This function check the output of a task from its parquet footer
+
+    Args:
+        task_path (str): the output parquet file of the task
+        expected_nb_rows (int): the size of the chunk of the task
+
+    return:
+        status (str): "ok", "missing", "corrupt", "short" or "long"
+    """
+    # the footer is the last part written, a truncated file has none
+    try:
+        nb_rows = pq.read_metadata(task_path).num_rows
+    except FileNotFoundError:
+        return "missing"
+    except (OSError, pa.ArrowException):
+        return "corrupt"
+
+    if nb_rows < expected_nb_rows:
+        return "short"
+    if nb_rows > expected_nb_rows:
+        return "long"
+
+    return "ok"
+
+
+def main(search_pattern: str,
+         output_filepath: str,
+         job_array_range: str,
+         nb_smiles: int = 1_936_962,
+         job_array_size: int = 2000,
+         plan_file: str = None,
+         nb_threads: int = 32) -> list:
     """  This function will found all finished generation task and check them against
-    against the regular number of code 
+    against the regular number of code
 
     Args:
         search_pattern (str):  the unix search filepath pattern used to find all finished jobs
         output_filepath (str): the outpout path for file with failed jobs indices
-        job_array_range (str):  the range of 
-    """
+        job_array_range (str):  the range of task ids to check, in SLURM --array syntax
+        nb_smiles (int): number of total smiles to be processed
+        job_array_size (int): number of task in job array
+        plan_file (str): optional, the json plan written by plan_chunks.py
+        nb_threads (int): number of threads reading the footers
 
-    # get  finished task
-    finished_tasks = set(glob.glob(search_pattern))
+    return:
+        failed_task_id_list (list of int): the task ids to relaunch
+    """
 
     # get index range + data casting
-    if "-" in job_array_range and "," in job_array_range:
-        raise ValueError(
-            'the job array should not contains both "-" and "," separator')
-    if "-" in job_array_range:
-        first_idx, last_idx = job_array_range.split("-")
-        jobs2check = range(int(first_idx), int(last_idx)+1)
-    elif "," in job_array_range:
-        jobs2check = [int(idx)for idx in job_array_range.split(",")]
-    else:
-        raise ValueError("the range used for the jobs array, can be \
-                        either a list of jobs,e.g: 1,14,30 or a range : 1-2000")
+    jobs2check = parse_job_array_range(job_array_range)
+    plan_chunks_list = load_plan_chunks(plan_file) if plan_file else None
+
+    # read the footers in parallel, the expected sizes are cheap to compute
+    with ThreadPoolExecutor(nb_threads) as executor:
+        status_list = list(executor.map(
+            lambda task_id: validate_task(
+                search_pattern.replace("*", str(task_id)),
+                get_expected_nb_rows(task_id, nb_smiles, job_array_size, plan_chunks_list)),
+            jobs2check))
 
     # check failed task
-    failed_task_id_list = [i for i in jobs2check
-                           if not search_pattern.replace("*", str(i)) in finished_tasks]
+    failed_task_id_list = [task_id for task_id, status in zip(jobs2check, status_list)
+                           if status != "ok"]
+    for status in ("missing", "corrupt", "short", "long"):
+        nb_tasks = status_list.count(status)
+        if nb_tasks:
+            print(f"{nb_tasks} tasks are {status}")
 
     # write to file
     if failed_task_id_list:
-        nb_succesful_task = job_array_range - len(failed_task_id_list)
-        sucess_rate = nb_succesful_task/job_array_range * 100
+        nb_succesful_task = len(jobs2check) - len(failed_task_id_list)
+        sucess_rate = nb_succesful_task/len(jobs2check) * 100
         print(f"{sucess_rate:.2f}% tasks were successfully completed\n")
         print(f"writting task id of failed jobs in {output_filepath}")
+        job_array_range = format_job_array_range(failed_task_id_list)
+        print(f"relaunch with --array={job_array_range}")
         with open(output_filepath, "w", encoding="utf-8") as file:
-            failed_task_id_list = [str(i) for i in sorted(failed_task_id_list)]
-            file.write(f"{','.join(failed_task_id_list)}\n")
-            file.close()
+            file.write(f"{job_array_range}\n")
     else:
         print("all task were sucessfully completed, no file will be written")
 
+    return failed_task_id_list
+
 
 if __name__ == '__main__':
     # argparser
@@ -69,6 +151,21 @@ if __name__ == '__main__':
                         either a list of jobs,e.g: 1,14,30 or a range : 1-2000",
                         default="1-2000",
                         type=str)
+    parser.add_argument('--nb_smiles', help="the number of molecules/smiles for the WHOLE database",
+                        default=1_936_962,
+                        type=int)
+    parser.add_argument('--job_array_size', help="the number of jobs in the job array",
+                        default=2000,
+                        type=int)
+    parser.add_argument('--plan_file', help="json plan written by plan_chunks.py, \
+                        replaces the equal-count split of --nb_smiles and --job_array_size",
+                        default=None,
+                        type=str)
+
+    # computation argument
+    parser.add_argument('--nb_threads', help="number of threads reading the parquet footers",
+                        default=32,
+                        type=int)
 
     # parse and converto dict
     args, _ = parser.parse_known_args()
@@ -82,5 +179,9 @@ if __name__ == '__main__':
     # execute main
     main(search_pattern=args_dict["search_pattern"],
          output_filepath=args_dict["output_filepath"],
-         job_array_range=args_dict["job_array_size"]
+         job_array_range=args_dict["job_array_range"],
+         nb_smiles=args_dict["nb_smiles"],
+         job_array_size=args_dict["job_array_size"],
+         plan_file=args_dict["plan_file"],
+         nb_threads=args_dict["nb_threads"]
          )
@@ -0,0 +1,305 @@
+"""
+This script read the chunk of a task from the inputs supported besides plain csv:
+parquet files, of which only the row groups overlapping the chunk are read,
+gzip or zstd compressed csv files and .smi files, streamed with pyarrow.
+Every value is read as a string, like the values of the csv reader,
+and only the requested columns are kept.
+Converting the csv database to parquet once makes the loading of a task near-instant
+"""
+from __future__ import annotations
+import os
+import sys
+import io
+import csv
+from pathlib import Path
+import argparse
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+
+# heavy dependencies are imported on first use
+pa = LazyModule("pyarrow")
+pv = LazyModule("pyarrow.csv")
+pq = LazyModule("pyarrow.parquet")
+
+# compression suffixes detected by pyarrow input streams
+COMPRESSION_SUFFIXES_DICT = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd", ".bz2": "bz2",
+                             ".lz4": "lz4"}
+# columns of a .smi file, the name is optional
+SMI_COLUMNS_LIST = ["SMILES", "name"]
+
+
+def get_input_format(input_path: str) -> tuple:
+    """
+    This function guess the format and the compression of an input file from its suffixes
+
+    Args:
+        input_path (str): the path to the input file
+
+    return:
+        (input_format, compression) (tuple): "parquet", "smi" or "csv",
+        and the compression of the file, None if not compressed
+    """
+    # declare local variables
+    suffixes_list = [suffix.lower() for suffix in Path(input_path).suffixes]
+    compression = None
+
+    if suffixes_list and suffixes_list[-1] in COMPRESSION_SUFFIXES_DICT:
+        compression = COMPRESSION_SUFFIXES_DICT[suffixes_list.pop()]
+    input_format = suffixes_list[-1].lstrip(".") if suffixes_list else "csv"
+    if input_format not in ("parquet", "smi"):
+        input_format = "csv"
+
+    return input_format, compression
+
+
+def get_row_ranges(first_idx: int, last_idx: int, extra_idx: int) -> list:
+    """ the ranges of rows of a chunk, the extra row is read if it is after the chunk """
+    ranges_list = [(first_idx, last_idx)]
+    if extra_idx is not None and extra_idx >= last_idx:
+        ranges_list.append((extra_idx, extra_idx + 1))
+
+    return ranges_list
+
+
+def table_to_rows(table: pa.Table, first_row_idx: int, row_idx_key: str = None) -> list:
+    """
+    This function convert a table to rows packaged as dictionnaries, values are strings
+
+    Args:
+        table (pa.Table): the rows
+        first_row_idx (int): the index of the first row of the table in the input file
+        row_idx_key (str): optional, key under which the index of the row is added
+
+    return:
+        data_list (list of dict): columns names as keys and values of the row as values
+    """
+    # the csv columns of the results are strings
+    table = table.cast(pa.schema([(name, pa.string()) for name in table.column_names]))
+    data_list = table.to_pylist()
+    if row_idx_key is not None:
+        for row_idx, row_dict in enumerate(data_list, start=first_row_idx):
+            row_dict[row_idx_key] = row_idx
+
+    return data_list
+
+
+def read_parquet_rows(input_path: str, first_idx: int, last_idx: int, extra_idx: int,
+                      columns_list: list = None, row_idx_key: str = None) -> list:
+    """
+    This function read the chunk of a task from a parquet file,
+    only the row groups overlapping the chunk are decompressed
+
+    Args:
+        input_path (str): the path to the parquet file
+        first_idx (int): the first index to be read
+        last_idx (int): the last index to be read, excluded
+        extra_idx (int): optional, an extra index for load balacing
+        columns_list (list of str): optional, the columns to read, all columns if None
+        row_idx_key (str): optional, key under which the index of the row is added
+
+    return:
+        data_list (list of dict): columns names as keys and values of the row as values
+    """
+    # declare local variables
+    parquet_file = pq.ParquetFile(input_path)
+    data_list = []
+
+    # the first row of every row group is known from the footer
+    row_group_offsets_list = [0]
+    for row_group_idx in range(parquet_file.num_row_groups):
+        row_group_offsets_list.append(row_group_offsets_list[-1] +
+                                      parquet_file.metadata.row_group(row_group_idx).num_rows)
+
+    for range_first_idx, range_last_idx in get_row_ranges(first_idx, last_idx, extra_idx):
+        range_last_idx = min(range_last_idx, row_group_offsets_list[-1])
+        if range_first_idx >= range_last_idx:
+            continue
+        row_group_idx_list = [row_group_idx for row_group_idx in
+                              range(parquet_file.num_row_groups)
+                              if row_group_offsets_list[row_group_idx] < range_last_idx and
+                              row_group_offsets_list[row_group_idx + 1] > range_first_idx]
+        table = parquet_file.read_row_groups(row_group_idx_list, columns=columns_list)
+        first_row_idx = row_group_offsets_list[row_group_idx_list[0]]
+        data_list += table_to_rows(
+            table.slice(range_first_idx - first_row_idx, range_last_idx - range_first_idx),
+            range_first_idx, row_idx_key)
+
+    return data_list
+
+
+def iter_csv_batches(input_path: str, compression: str, columns_list: list = None):
+    """
+    This generator stream the record batches of a possibly compressed csv file,
+    every column is read as a string
+
+    Args:
+        input_path (str): the path to the csv file
+        compression (str): the compression of the file, None if not compressed
+        columns_list (list of str): optional, the columns to read, all columns if None
+
+    yield:
+        batch (pa.RecordBatch): the next rows of the file
+    """
+    # the header is read first so that no type is inferred, an empty file has no batch
+    with pa.input_stream(input_path, compression=compression) as input_stream:
+        column_names_list = next(csv.reader(
+            [io.TextIOWrapper(input_stream, encoding="utf-8").readline()]), None)
+    if not column_names_list:
+        return
+
+    convert_options = pv.ConvertOptions(
+        column_types={name: pa.string() for name in column_names_list},
+        include_columns=columns_list,
+        strings_can_be_null=False,
+        quoted_strings_can_be_null=False)
+    with pa.input_stream(input_path, compression=compression) as input_stream:
+        yield from pv.open_csv(input_stream,
+                               parse_options=pv.ParseOptions(newlines_in_values=True),
+                               convert_options=convert_options)
+
+
+def iter_smi_batches(input_path: str, compression: str, columns_list: list = None,
+                     batch_size: int = 65_536):
+    """
+    This generator stream the record batches of a possibly compressed .smi file,
+    a SMILES and an optional name separated by whitespace on every line, without header
+
+    Args:
+        input_path (str): the path to the .smi file
+        compression (str): the compression of the file, None if not compressed
+        columns_list (list of str): optional, the columns to read, all columns if None
+        batch_size (int): number of lines per batch
+
+    yield:
+        batch (pa.RecordBatch): the next rows of the file
+    """
+    # declare local variables
+    columns_list = columns_list or SMI_COLUMNS_LIST
+    values_lists = [[] for _ in SMI_COLUMNS_LIST]
+
+    with pa.input_stream(input_path, compression=compression) as input_stream:
+        for line in io.TextIOWrapper(input_stream, encoding="utf-8"):
+            values_list = line.split(maxsplit=1)
+            if not values_list:
+                continue
+            values_lists[0].append(values_list[0])
+            values_lists[1].append(values_list[1].strip() if len(values_list) > 1 else "")
+            if len(values_lists[0]) == batch_size:
+                yield pa.RecordBatch.from_pydict(
+                    {name: values_lists[SMI_COLUMNS_LIST.index(name)] for name in columns_list})
+                values_lists = [[] for _ in SMI_COLUMNS_LIST]
+    if values_lists[0]:
+        yield pa.RecordBatch.from_pydict(
+            {name: values_lists[SMI_COLUMNS_LIST.index(name)] for name in columns_list})
+
+
+def iter_text_batches(input_path: str, columns_list: list = None):
+    """ record batches of a csv or .smi file, the format and compression come from the suffixes """
+    input_format, compression = get_input_format(input_path)
+    if input_format == "smi":
+        return iter_smi_batches(input_path, compression, columns_list)
+
+    return iter_csv_batches(input_path, compression, columns_list)
+
+
+def read_text_rows(input_path: str, first_idx: int, last_idx: int, extra_idx: int,
+                   columns_list: list = None, row_idx_key: str = None) -> list:
+    """
+    This function read the chunk of a task from a csv or .smi file, possibly compressed.
+    The file is streamed by record batches, the batches before the chunk are dropped
+    and the reading stops after the last row needed
+
+    Args:
+        input_path (str): the path to the csv or .smi file
+        first_idx (int): the first index to be read
+        last_idx (int): the last index to be read, excluded
+        extra_idx (int): optional, an extra index for load balacing
+        columns_list (list of str): optional, the columns to read, all columns if None
+        row_idx_key (str): optional, key under which the index of the row is added
+
+    return:
+        data_list (list of dict): columns names as keys and values of the row as values
+    """
+    # declare local variables
+    ranges_list = get_row_ranges(first_idx, last_idx, extra_idx)
+    data_list = []
+    batch_first_idx = 0
+
+    for batch in iter_text_batches(input_path, columns_list):
+        batch_last_idx = batch_first_idx + batch.num_rows
+        for range_first_idx, range_last_idx in ranges_list:
+            slice_first_idx = max(range_first_idx, batch_first_idx)
+            slice_last_idx = min(range_last_idx, batch_last_idx)
+            if slice_first_idx < slice_last_idx:
+                data_list += table_to_rows(
+                    pa.Table.from_batches([batch.slice(slice_first_idx - batch_first_idx,
+                                                       slice_last_idx - slice_first_idx)]),
+                    slice_first_idx, row_idx_key)
+        batch_first_idx = batch_last_idx
+        if batch_first_idx >= ranges_list[-1][1]:
+            break
+
+    return data_list
+
+
+def convert_to_parquet(input_path: str, output_filepath: str,
+                       row_group_size: int = 10_000) -> int:
+    """
+    This function convert a csv or .smi file, possibly compressed, to a parquet file,
+    batch by batch, every column is stored as a string
+
+    Args:
+        input_path (str): the path to the csv or .smi file
+        output_filepath (str): the output parquet file
+        row_group_size (int): number of rows per row group, a task reads whole row groups
+
+    return:
+        nb_rows (int): number of rows written
+    """
+    # declare local variables
+    nb_rows = 0
+    writer = None
+
+    for batch in iter_text_batches(input_path):
+        if writer is None:
+            writer = pq.ParquetWriter(output_filepath, batch.schema)
+        writer.write_batch(batch, row_group_size=row_group_size)
+        nb_rows += batch.num_rows
+    if writer is not None:
+        writer.close()
+
+    return nb_rows
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--input_path', help="the csv or .smi database, possibly compressed \
+                        with gzip (.gz) or zstd (.zst)",
+                        default="data/raw/whole_original_MOSES.csv", type=str)
+    parser.add_argument('--output_filepath', help="the output file should be a parquet file",
+                        default="data/raw/whole_original_MOSES.parquet", type=str)
+
+    # layout arguments
+    parser.add_argument('--row_group_size', help="number of rows per row group, \
+                        a task reads the row groups overlapping its chunk",
+                        default=10_000,
+                        type=int)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    os.chdir(project_dir)
+
+    # execute
+    nb_rows_written = convert_to_parquet(input_path=args_dict["input_path"],
+                                         output_filepath=args_dict["output_filepath"],
+                                         row_group_size=args_dict["row_group_size"])
+    print(f"{nb_rows_written} rows written to {args_dict['output_filepath']}")
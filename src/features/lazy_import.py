@@ -0,0 +1,25 @@
+"""
+This module defer the import of the heavy dependencies (rdkit, numpy, pyarrow)
+and of the modules built on them to their first use, so that the command line
+interfaces and the planning scripts start without loading them.
+A module is imported on the first access to one of its attributes,
+its attributes are then copied on the proxy so that later accesses are plain lookups
+"""
+import importlib
+
+
+class LazyModule:
+    """ proxy of a module imported on the first access to one of its attributes """
+
+    def __init__(self, module_name: str):
+        self.__dict__["_module_name"] = module_name
+
+    def __getattr__(self, name: str):
+        # only called while the attribute is missing from the proxy
+        module = importlib.import_module(self.__dict__["_module_name"])
+        self.__dict__.update(module.__dict__)
+
+        return getattr(module, name)
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{self.__dict__['_module_name']}'>"
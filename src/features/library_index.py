@@ -0,0 +1,241 @@
+"""
+This script build a content-addressed index of the aggregated ClearSMILES library:
+the md5 digest of the canonical SMILES of every row, sorted, with the position of the row.
+The index is a numpy file read as a memory map, so that a batch of molecules
+is looked up by binary search without loading the library nor the whole index,
+then only the row groups holding the matching rows are read from the library
+"""
+import os
+import hashlib
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rdkit import Chem, RDLogger
+
+# sidecar file written next to the library
+INDEX_SUFFIX = ".md5.npy"
+# a digest and the position of its row in the library
+INDEX_DTYPE = np.dtype([("digest", "S16"), ("row", "<i8")])
+
+
+def get_index_path(library_path: str) -> str:
+    """ default path of the sidecar index of a library """
+    return f"{library_path}{INDEX_SUFFIX}"
+
+
+def get_smiles_digest(smiles: str) -> bytes:
+    """
+    This function hash a molecule, the SMILES is canonicalized first so that any SMILES
+    of the molecule gives the same digest. An unparsable SMILES is hashed as is
+
+    Args:
+        smiles (str): a SMILES
+
+    return:
+        digest (bytes): the 16 bytes md5 digest of the canonical SMILES
+    """
+    mol = Chem.MolFromSmiles(smiles) if smiles else None
+    canonical_smiles = Chem.MolToSmiles(mol) if mol is not None else (smiles or "")
+
+    return hashlib.md5(canonical_smiles.encode("utf-8")).digest()
+
+
+def get_row_group_offsets(parquet_file: pq.ParquetFile) -> np.array:
+    """ position of the first row of every row group, followed by the number of rows """
+    return np.cumsum([0] + [parquet_file.metadata.row_group(row_group_idx).num_rows
+                            for row_group_idx in range(parquet_file.num_row_groups)])
+
+
+def digest_row_group(library_path: str, smiles_column: str, row_group_idx: int) -> np.array:
+    """
+    This function hash the molecules of a row group of the library
+
+    Args:
+        library_path (str): the library parquet file
+        smiles_column (str): the column of SMILES hashed
+        row_group_idx (int): index of the row group
+
+    return:
+        index_array (numpy array): the digests and positions of the rows, not sorted
+    """
+    # declare local variables
+    RDLogger.DisableLog("rdApp.*")
+    parquet_file = pq.ParquetFile(library_path)
+    first_row = get_row_group_offsets(parquet_file)[row_group_idx]
+    smiles_list = parquet_file.read_row_group(row_group_idx, columns=[smiles_column]) \
+        .column(smiles_column).to_pylist()
+
+    index_array = np.empty(len(smiles_list), dtype=INDEX_DTYPE)
+    index_array["digest"] = [get_smiles_digest(smiles) for smiles in smiles_list]
+    index_array["row"] = np.arange(first_row, first_row + len(smiles_list))
+
+    return index_array
+
+
+def build_library_index(library_path: str, index_path: str = None,
+                        smiles_column: str = "SMILES", nb_core: int = None) -> int:
+    """
+    This function hash the molecules of the library by row group in parallel,
+    then sort the digests and write the index
+
+    Args:
+        library_path (str): the library parquet file
+        index_path (str): optional, by default the library path followed by .md5.npy
+        smiles_column (str): the column of SMILES hashed
+        nb_core (int): number of worker processes, all the available cores if None
+
+    return:
+        nb_rows (int): number of rows indexed
+    """
+    # declare local variables
+    index_path = index_path or get_index_path(library_path)
+    nb_row_groups = pq.ParquetFile(library_path).num_row_groups
+
+    with Pool(nb_core) as pool:
+        index_list = pool.map(partial(digest_row_group, library_path, smiles_column),
+                              range(nb_row_groups))
+    index_array = np.concatenate(index_list) if index_list else np.empty(0, dtype=INDEX_DTYPE)
+
+    # a stable sort keeps the first row of duplicated molecules first
+    index_array = index_array[np.argsort(index_array["digest"], kind="stable")]
+    with open(index_path, "wb") as index_file:
+        np.save(index_file, index_array)
+
+    return len(index_array)
+
+
+def load_library_index(library_path: str, index_path: str = None) -> np.memmap:
+    """ memory map of the index of a library, its pages are read on demand """
+    return np.load(index_path or get_index_path(library_path), mmap_mode="r")
+
+
+def lookup_rows(index_array: np.memmap, smiles_list: list) -> np.array:
+    """
+    This function find the rows of a batch of molecules by binary search in the index,
+    the cost is O(log n) per molecule
+
+    Args:
+        index_array (numpy memmap): the index loaded by load_library_index
+        smiles_list (list of str): the SMILES of the molecules, canonical or not
+
+    return:
+        row_array (numpy array): the position of the first row of every molecule
+        in the library, -1 if the molecule is not in the library
+    """
+    # declare local variables
+    digest_array = np.array([get_smiles_digest(smiles) for smiles in smiles_list], dtype="S16")
+    index_digest_array = index_array["digest"]
+    row_array = np.full(len(smiles_list), -1, dtype=np.int64)
+    if not index_array.size:
+        return row_array
+
+    # the digests are sorted, a match is at the insertion point
+    position_array = np.searchsorted(index_digest_array, digest_array)
+    in_bounds_array = position_array < len(index_array)
+    found_array = in_bounds_array.copy()
+    found_array[in_bounds_array] = \
+        index_digest_array[position_array[in_bounds_array]] == digest_array[in_bounds_array]
+    row_array[found_array] = index_array["row"][position_array[found_array]]
+
+    return row_array
+
+
+def read_library_rows(library_path: str, row_array: np.array,
+                      columns_list: list = None) -> pa.Table:
+    """
+    This function read rows of the library by position,
+    only the row groups holding the rows are read
+
+    Args:
+        library_path (str): the library parquet file
+        row_array (numpy array): positions of the rows, -1 gives a null row
+        columns_list (list of str): optional, the columns to read, all columns if None
+
+    return:
+        table (pa.Table): the rows, in the order of row_array
+    """
+    # declare local variables
+    parquet_file = pq.ParquetFile(library_path)
+    row_group_offsets_array = get_row_group_offsets(parquet_file)
+    row_array = np.asarray(row_array, dtype=np.int64)
+    found_array = row_array >= 0
+    row_group_idx_array = np.searchsorted(row_group_offsets_array, row_array, side="right") - 1
+    row_group_idx_list = np.unique(row_group_idx_array[found_array]).tolist()
+
+    # position of every row in the concatenation of the row groups read
+    table = parquet_file.read_row_groups(row_group_idx_list, columns=columns_list)
+    read_offsets_array = np.zeros(parquet_file.num_row_groups, dtype=np.int64)
+    read_offsets_array[row_group_idx_list] = np.cumsum(
+        [0] + [parquet_file.metadata.row_group(row_group_idx).num_rows
+               for row_group_idx in row_group_idx_list[:-1]])
+    take_array = np.zeros(len(row_array), dtype=np.int64)
+    take_array[found_array] = read_offsets_array[row_group_idx_array[found_array]] + \
+        row_array[found_array] - row_group_offsets_array[row_group_idx_array[found_array]]
+
+    # a null index takes a null row
+    return table.take(pa.array(take_array, mask=~found_array))
+
+
+def lookup_clearsmiles(library_path: str, smiles_list: list, columns_list: list = None,
+                       index_array: np.memmap = None) -> pa.Table:
+    """
+    This function fetch the rows of the library of a batch of molecules
+
+    Args:
+        library_path (str): the library parquet file
+        smiles_list (list of str): the SMILES of the molecules, canonical or not
+        columns_list (list of str): optional, the columns to read,
+        by default SMILES and ClearSMILES_set
+        index_array (numpy memmap): optional, the index, loaded from its default path if None
+
+    return:
+        table (pa.Table): a row per molecule, in the order of smiles_list,
+        null rows for the molecules not in the library
+    """
+    if index_array is None:
+        index_array = load_library_index(library_path)
+
+    return read_library_rows(library_path, lookup_rows(index_array, smiles_list),
+                             columns_list or ["SMILES", "ClearSMILES_set"])
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--library_path', help="the aggregated library parquet file",
+                        default="data/processed/whole_MOSES_ClearSMILES_results.parquet",
+                        type=str)
+    parser.add_argument('--index_path', help="the output index, by default the library path \
+                        followed by .md5.npy",
+                        default=None,
+                        type=str)
+    parser.add_argument('--smiles_column', help="the column of SMILES hashed",
+                        default="SMILES",
+                        type=str)
+
+    # computation argument
+    parser.add_argument('--nb_core', help="number of worker processes, \
+                        all the available cores by default",
+                        default=None,
+                        type=int)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    os.chdir(project_dir)
+
+    # execute
+    nb_indexed_rows = build_library_index(library_path=args_dict["library_path"],
+                                          index_path=args_dict["index_path"],
+                                          smiles_column=args_dict["smiles_column"],
+                                          nb_core=args_dict["nb_core"])
+    print(f"{nb_indexed_rows} rows indexed")
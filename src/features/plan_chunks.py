@@ -0,0 +1,332 @@
+"""
+This script plan the chunks of a job array so that every task gets roughly
+the same predicted amount of work instead of the same number of molecules.
+The cost of a molecule is predicted from cheap descriptors read from its SMILES,
+the cost model is calibrated on the total_time column of previous runs.
+The plan is a json file giving the rows of the database processed by every task,
+the database is read with the readers of generate_clearsmiles.py
+"""
+from __future__ import annotations
+import os
+import sys
+import re
+import json
+import glob
+from pathlib import Path
+import argparse
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+from features.input_readers import get_input_format, iter_text_batches
+
+# heavy dependencies are imported on first use
+np = LazyModule("numpy")
+pq = LazyModule("pyarrow.parquet")
+
+# descriptors are read from the SMILES string, without building rdkit molecules
+ATOM_TOKENS_REGEX = re.compile(r"\[[^\]]+]|Br|Cl|[BCNOSPFIbcnosp]")
+BRACKET_ATOM_REGEX = re.compile(r"\[[^\]]+]")
+RING_CLOSURE_REGEX = re.compile(r"%[0-9]{2}|[0-9]")
+DESCRIPTORS_LIST = ["intercept", "nb_atoms", "nb_ring_closures", "nb_branches"]
+
+
+def get_descriptors(smiles: str) -> list:
+    """
+    This function compute the descriptors used by the cost model
+
+    Args:
+        smiles (str): a valid SMILES
+
+    return:
+        descriptors_list (list of int): the descriptors ordered as DESCRIPTORS_LIST
+    """
+    # digits inside bracket atoms are not ring closures
+    nb_ring_closures = len(RING_CLOSURE_REGEX.findall(BRACKET_ATOM_REGEX.sub("", smiles))) // 2
+
+    return [1, len(ATOM_TOKENS_REGEX.findall(smiles)), nb_ring_closures, smiles.count("(")]
+
+
+def fit_cost_model(search_pattern: str, max_nb_samples: int = 200_000) -> list:
+    """
+    This function fit a log-linear cost model on the results of previous runs,
+    the cost of molecules vary by orders of magnitude, hence the fit is done on log(total_time)
+
+    Args:
+        search_pattern (str): unix style pathname pattern of previous results parquet files
+        max_nb_samples (int): maximal number of molecules used for the fit
+
+    return:
+        coefficients_list (list of float): the coefficients of the descriptors,
+        None if no previous result was found
+    """
+    # declare local variables
+    smiles_list = []
+    total_time_list = []
+
+    # read only the needed columns
+    for filepath in sorted(glob.glob(search_pattern)):
+        table = pq.read_table(filepath, columns=["SMILES", "total_time"])
+        smiles_list += table.column("SMILES").to_pylist()
+        total_time_list += table.column("total_time").to_pylist()
+        if len(smiles_list) >= max_nb_samples:
+            break
+    if not smiles_list:
+        return None
+
+    # least squares in log space
+    descriptors_array = np.array([get_descriptors(smiles)
+                                  for smiles in smiles_list[:max_nb_samples]], dtype=float)
+    log_time_array = np.log(np.maximum(np.array(total_time_list[:max_nb_samples]), 1e-6))
+    coefficients_array, *_ = np.linalg.lstsq(descriptors_array, log_time_array, rcond=None)
+
+    return coefficients_array.tolist()
+
+
+def iter_smiles_batches(input_path: str):
+    """
+    This generator stream the SMILES column of a database, a parquet, csv or .smi file,
+    csv and .smi files may be compressed
+
+    Args:
+        input_path (str): the path to the database, with a SMILES column
+
+    yield:
+        smiles_list (list of str): the SMILES of the next rows
+    """
+    # declare local variables
+    input_format, _ = get_input_format(input_path)
+
+    # read the SMILES column only
+    if input_format == "parquet":
+        batches_iter = pq.ParquetFile(input_path).iter_batches(columns=["SMILES"])
+    else:
+        batches_iter = iter_text_batches(input_path, ["SMILES"])
+    for batch in batches_iter:
+        yield batch.column(0).to_pylist()
+
+
+def predict_costs(input_csv: str, coefficients_list: list) -> np.array:
+    """
+    This function predict the cost of every molecule of the database
+
+    Args:
+        input_csv (str): the path to the database, a parquet, csv or .smi file
+        with a SMILES column, csv and .smi files may be compressed
+        coefficients_list (list of float): the coefficients of the cost model,
+        every molecule has the same cost if None
+
+    return:
+        cost_array (numpy array): the predicted cost of every row
+    """
+    if coefficients_list is None:
+        return np.ones(sum(len(smiles_list) for smiles_list in iter_smiles_batches(input_csv)))
+    descriptors_array = np.array([get_descriptors(smiles)
+                                  for smiles_list in iter_smiles_batches(input_csv)
+                                  for smiles in smiles_list],
+                                 dtype=float).reshape(-1, len(DESCRIPTORS_LIST))
+
+    return np.exp(descriptors_array @ np.array(coefficients_list))
+
+
+def split_costs(cost_array: np.array, job_array_size: int) -> list:
+    """
+    This function split the rows in contiguous ranges of roughly equal cumulative cost
+
+    Args:
+        cost_array (numpy array): the predicted cost of every row
+        job_array_size (int): number of tasks in the job array
+
+    return:
+        tasks_list (list of dict): first_idx, last_idx (excluded) and predicted cost of every task
+    """
+    # declare local variables
+    cumulative_cost_array = np.cumsum(cost_array)
+    total_cost = cumulative_cost_array[-1] if len(cost_array) else 0.0
+    targets_array = total_cost * np.arange(1, job_array_size) / job_array_size
+
+    # a task ends on the first row reaching its share of the total cost
+    boundaries_list = [0] + np.searchsorted(cumulative_cost_array, targets_array,
+                                            side="right").tolist() + [len(cost_array)]
+    tasks_list = [{"first_idx": first_idx,
+                   "last_idx": last_idx,
+                   "predicted_cost": float(cost_array[first_idx:last_idx].sum())}
+                  for first_idx, last_idx in zip(boundaries_list[:-1], boundaries_list[1:])]
+
+    return tasks_list
+
+
+def load_plan_chunks(plan_file: str) -> list:
+    """
+    This function read the chunks of all the tasks from a plan file at once,
+    every chunk has the same keys than compute_chunk_idx
+
+    Args:
+        plan_file (str): the json plan written by this script
+
+    return:
+        chunks_list (list of dict) : first_idx, last_idx and extra_idx (always None)
+        of every task, indexed by task id
+    """
+    with open(plan_file, encoding="utf-8") as json_file:
+        plan_dict = json.load(json_file)
+
+    return [{"first_idx": task_dict["first_idx"],
+             "last_idx": task_dict["last_idx"],
+             "extra_idx": None} for task_dict in plan_dict["tasks"]]
+
+
+def load_chunk_idx(plan_file: str, task_id: int) -> dict:
+    """
+    This function read the chunk of a task from a plan file,
+    the returned dict has the same keys than compute_chunk_idx
+
+    Args:
+        plan_file (str): the json plan written by this script
+        task_id (int): the index of the current task in job array
+
+    return:
+        chunk_idx_dict (dict) : first_idx, last_idx and extra_idx (always None)
+    """
+    return load_plan_chunks(plan_file)[task_id]
+
+
+def load_coefficients(plan_file: str) -> list:
+    """
+    This function read the coefficients of the cost model from a plan file
+
+    Args:
+        plan_file (str): the json plan written by this script
+
+    return:
+        coefficients_list (list of float): the coefficients, None if the model was not calibrated
+    """
+    with open(plan_file, encoding="utf-8") as json_file:
+        return json.load(json_file)["coefficients"]
+
+
+def parse_job_array_range(job_array_range: str) -> list:
+    """
+    This function parse a job array range in SLURM --array syntax
+
+    Args:
+        job_array_range (str): a list of jobs, e.g: 1,14,30, a range : 1-2000, or both : 1-5,8
+
+    return:
+        jobs2check (list of int): the task ids, sorted
+    """
+    # declare local variables
+    jobs2check = set()
+
+    # a throttle suffix, e.g: 1-2000%50, does not change the task ids
+    for item in job_array_range.split("%")[0].split(","):
+        if "-" in item:
+            first_idx, last_idx = item.split("-")
+            jobs2check.update(range(int(first_idx), int(last_idx)+1))
+        elif item.strip().isdigit():
+            jobs2check.add(int(item))
+        else:
+            raise ValueError("the range used for the jobs array, can be \
+                            either a list of jobs,e.g: 1,14,30 or a range : 1-2000")
+
+    return sorted(jobs2check)
+
+
+def format_job_array_range(task_id_list: list) -> str:
+    """
+    This function write task ids in SLURM --array syntax, consecutive ids are merged in ranges
+
+    Args:
+        task_id_list (list of int): the task ids
+
+    return:
+        job_array_range (str): e.g: 1-5,8,10-12
+    """
+    # declare local variables
+    ranges_list = []
+
+    # extend the last range while ids are consecutive
+    for task_id in sorted(task_id_list):
+        if ranges_list and task_id == ranges_list[-1][1] + 1:
+            ranges_list[-1][1] = task_id
+        else:
+            ranges_list.append([task_id, task_id])
+
+    return ",".join(str(first_idx) if first_idx == last_idx else f"{first_idx}-{last_idx}"
+                    for first_idx, last_idx in ranges_list)
+
+
+def main(input_csv: str, search_pattern: str, plan_file: str, job_array_size: int) -> dict:
+    """ This function calibrate the cost model, plan the chunks and write the plan file
+
+    Args:
+        input_csv (str): the path to the database, a parquet, csv or .smi file
+        search_pattern (str): unix style pathname pattern of previous results parquet files
+        plan_file (str): the output json plan
+        job_array_size (int): number of tasks in the job array
+
+    return:
+        plan_dict (dict): the content of the plan file
+    """
+    # calibrate then predict
+    coefficients_list = fit_cost_model(search_pattern)
+    if coefficients_list is None:
+        print(f"no previous results found with {search_pattern}, every molecule has the same cost")
+    cost_array = predict_costs(input_csv, coefficients_list)
+
+    # write the plan
+    tasks_list = split_costs(cost_array, job_array_size)
+    plan_dict = {
+        "input_csv": input_csv,
+        "nb_smiles": len(cost_array),
+        "job_array_size": job_array_size,
+        "descriptors": DESCRIPTORS_LIST,
+        "coefficients": coefficients_list,
+        "tasks": tasks_list,
+    }
+    with open(plan_file, "w", encoding="utf-8") as json_file:
+        json.dump(plan_dict, json_file, indent=1)
+
+    # the task with the highest predicted cost sets the wall time of the job array
+    predicted_cost_array = np.array([task_dict["predicted_cost"] for task_dict in tasks_list])
+    print(f"predicted cost per task, mean: {predicted_cost_array.mean():.2f} "
+          f"max: {predicted_cost_array.max():.2f}")
+
+    return plan_dict
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--input_csv', help="the inputh path to the database, a csv file, \
+                        a parquet file or a .smi file, csv and .smi files can be compressed \
+                        with gzip (.gz) or zstd (.zst)",
+                        default="data/raw/whole_original_MOSES.csv", type=str)
+    parser.add_argument('--search_pattern', help="unix style pathname pattern \
+                        to find the results of previous runs used for calibration",
+                        default="data/interim/ClearSMILES_MOSES_subset_*.parquet", type=str)
+    parser.add_argument('--plan_file', help="the output file should be a json file",
+                        default="data/external/chunks_plan.json",
+                        type=str)
+
+    # data spliting argument
+    parser.add_argument('--job_array_size', help="the number of jobs in the job array",
+                        default=2000,
+                        type=int)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    print(project_dir)
+    os.chdir(project_dir)
+
+    # execute main
+    main(input_csv=args_dict["input_csv"],
+         search_pattern=args_dict["search_pattern"],
+         plan_file=args_dict["plan_file"],
+         job_array_size=args_dict["job_array_size"])
@@ -0,0 +1,247 @@
+"""
+This module is a persistent cache of the results of get_clearsmiles,
+keyed by the canonical SMILES of the molecule and the search parameters.
+The cache is split in sqlite shards so that concurrent tasks of a job array
+rarely wait on the same lock, sqlite locks are used instead of WAL mode
+which is not supported on network filesystems.
+The least recently used entries of a shard are evicted once it exceeds its share of the size limit.
+Reads do not take the write lock of a shard, the access times of the hits are kept in memory
+and written in batches: with the next write to the shard, every ACCESS_FLUSH_SIZE hits
+or ACCESS_FLUSH_INTERVAL seconds, and when the cache is closed
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# written once in the cache directory, the number of shards can not change afterwards
+CACHE_CONFIG_FILENAME = "cache.json"
+# fraction of the size limit kept after an eviction
+EVICTION_RATIO = 0.9
+# the access times of the hits are written once there are this many of them,
+# or once the oldest of them is this many seconds old
+ACCESS_FLUSH_SIZE = 1000
+ACCESS_FLUSH_INTERVAL = 60.0
+
+
+def open_cache(cache_dir: str, nb_shards: int = 16, max_size_mb: float = None) -> dict:
+    """
+    This function open a cache directory, creating it if needed.
+    The connections to the shards are opened on first use, thus a cache must be opened
+    in the process using it and not inherited from a parent process
+
+    Args:
+        cache_dir (str): the cache directory
+        nb_shards (int): number of shards of a new cache, an existing cache keeps its own
+        max_size_mb (float): optional, size limit of the cached results in megabytes
+
+    return:
+        cache_dict (dict): the state of the cache used by the other functions
+    """
+    # declare local variables
+    os.makedirs(cache_dir, exist_ok=True)
+    config_path = os.path.join(cache_dir, CACHE_CONFIG_FILENAME)
+
+    # the first task to create the cache sets the number of shards
+    try:
+        with open(config_path, "x", encoding="utf-8") as config_file:
+            json.dump({"nb_shards": nb_shards}, config_file)
+    except FileExistsError:
+        with open(config_path, encoding="utf-8") as config_file:
+            nb_shards = json.load(config_file)["nb_shards"]
+
+    return {
+        "cache_dir": cache_dir,
+        "nb_shards": nb_shards,
+        "max_shard_size": max_size_mb * 1e6 / nb_shards if max_size_mb else None,
+        "connections": {},
+        "pending_accesses": {},
+        "last_flush_time": time.time(),
+    }
+
+
+def get_cache_key(canonical_smiles: str, search_params_dict: dict) -> str:
+    """
+    This function build the key of a molecule searched with given parameters
+
+    Args:
+        canonical_smiles (str): the canonical SMILES of the molecule
+        search_params_dict (dict): the parameters of get_clearsmiles which change the results
+
+    return:
+        key (str): sha1 hex digest of the SMILES and of the sorted parameters
+    """
+    key_string = canonical_smiles + json.dumps(search_params_dict, sort_keys=True)
+
+    return hashlib.sha1(key_string.encode("utf-8")).hexdigest()
+
+
+def get_shard_idx(cache_dict: dict, key: str) -> int:
+    """ index of the shard of a key """
+    return int(key[:8], 16) % cache_dict["nb_shards"]
+
+
+def get_connection(cache_dict: dict, key: str) -> sqlite3.Connection:
+    """ connection to the shard of a key, the shard tables are created on first use """
+    # declare local variables
+    shard_idx = get_shard_idx(cache_dict, key)
+
+    if shard_idx not in cache_dict["connections"]:
+        connection = sqlite3.connect(
+            os.path.join(cache_dict["cache_dir"], f"shard_{shard_idx:03d}.sqlite"),
+            timeout=600)
+        connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, "
+                           "canonical_smiles TEXT, results TEXT, size INTEGER, "
+                           "last_access REAL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS last_access_idx "
+                           "ON results (last_access)")
+        connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, "
+                           "value INTEGER)")
+        connection.commit()
+        cache_dict["connections"][shard_idx] = connection
+
+    return cache_dict["connections"][shard_idx]
+
+
+def cache_get(cache_dict: dict, key: str) -> dict:
+    """
+    This function read the results of a key, and mark it as recently used,
+    the access time is written later by flush_accesses
+
+    Args:
+        cache_dict (dict): the cache opened by open_cache
+        key (str): the key built by get_cache_key
+
+    return:
+        results_dict (dict or None): the cached results, None if the key is not cached
+    """
+    # declare local variables
+    connection = get_connection(cache_dict, key)
+    row = connection.execute("SELECT results FROM results WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+
+    # last access is used by the eviction
+    cache_dict["pending_accesses"].setdefault(get_shard_idx(cache_dict, key), {})[key] = \
+        time.time()
+    if sum(map(len, cache_dict["pending_accesses"].values())) >= ACCESS_FLUSH_SIZE or \
+            time.time() - cache_dict["last_flush_time"] >= ACCESS_FLUSH_INTERVAL:
+        flush_accesses(cache_dict)
+
+    return json.loads(row[0])
+
+
+def write_accesses(cache_dict: dict, shard_idx: int, connection: sqlite3.Connection) -> None:
+    """ write the pending access times of a shard, in the running transaction """
+    # the entries evicted meanwhile are not updated
+    accesses_dict = cache_dict["pending_accesses"].pop(shard_idx, {})
+    connection.executemany("UPDATE results SET last_access = ? WHERE key = ?",
+                           [(access_time, key) for key, access_time in accesses_dict.items()])
+
+
+def flush_accesses(cache_dict: dict) -> None:
+    """
+    This function write the pending access times of the hits, a transaction per shard
+
+    Args:
+        cache_dict (dict): the cache opened by open_cache
+    """
+    for shard_idx in list(cache_dict["pending_accesses"]):
+        connection = get_connection(cache_dict, f"{shard_idx:08x}")
+        with connection:
+            write_accesses(cache_dict, shard_idx, connection)
+    cache_dict["last_flush_time"] = time.time()
+
+
+def cache_put(cache_dict: dict, key: str, canonical_smiles: str, results_dict: dict) -> None:
+    """
+    This function write the results of a key and the pending access times of its shard,
+    then evict the least recently used entries of the shard if it exceeds its share
+    of the size limit
+
+    Args:
+        cache_dict (dict): the cache opened by open_cache
+        key (str): the key built by get_cache_key
+        canonical_smiles (str): the canonical SMILES of the molecule
+        results_dict (dict): the results to cache, values must be json serializable
+    """
+    # declare local variables
+    connection = get_connection(cache_dict, key)
+    results_string = json.dumps(results_dict)
+
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                           (key, canonical_smiles, results_string, len(results_string),
+                            time.time()))
+        write_accesses(cache_dict, get_shard_idx(cache_dict, key), connection)
+
+        # evict down to a fraction of the limit, so that eviction is not done at every write
+        if cache_dict["max_shard_size"] is None:
+            return
+        shard_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results") \
+            .fetchone()[0]
+        if shard_size <= cache_dict["max_shard_size"]:
+            return
+        excess_size = shard_size - cache_dict["max_shard_size"] * EVICTION_RATIO
+        evicted_size = 0
+        evicted_keys_list = []
+        for evicted_key, size in connection.execute(
+                "SELECT key, size FROM results ORDER BY last_access"):
+            if evicted_size >= excess_size:
+                break
+            evicted_keys_list.append((evicted_key,))
+            evicted_size += size
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted_keys_list)
+
+
+def add_cache_counters(cache_dict: dict, nb_hits: int, nb_misses: int) -> None:
+    """
+    This function add the hits and misses of a task to the persistent counters,
+    the counters are stored in the first shard
+
+    Args:
+        cache_dict (dict): the cache opened by open_cache
+        nb_hits (int): number of results read from the cache
+        nb_misses (int): number of results missing from the cache
+    """
+    # the key "0" * 8 belongs to the first shard
+    connection = get_connection(cache_dict, "0" * 8)
+    with connection:
+        connection.executemany("INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) "
+                               "DO UPDATE SET value = value + excluded.value",
+                               [("hits", nb_hits), ("misses", nb_misses)])
+
+
+def get_cache_stats(cache_dict: dict) -> dict:
+    """
+    This function read the persistent counters and the size of the cache
+
+    Args:
+        cache_dict (dict): the cache opened by open_cache
+
+    return:
+        stats_dict (dict): hits, misses, number of entries and size in bytes of the cached results
+    """
+    # declare local variables
+    stats_dict = {"hits": 0, "misses": 0, "nb_entries": 0, "size": 0}
+
+    # every shard is opened
+    for shard_idx in range(cache_dict["nb_shards"]):
+        connection = get_connection(cache_dict, f"{shard_idx:08x}")
+        nb_entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        stats_dict["nb_entries"] += nb_entries
+        stats_dict["size"] += size
+        for name, value in connection.execute("SELECT name, value FROM counters"):
+            stats_dict[name] += value
+
+    return stats_dict
+
+
+def close_cache(cache_dict: dict) -> None:
+    """ write the pending access times, then close the connections to the shards """
+    flush_accesses(cache_dict)
+    for connection in cache_dict["connections"].values():
+        connection.close()
+    cache_dict["connections"].clear()
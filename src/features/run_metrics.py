@@ -0,0 +1,225 @@
+"""
+This script gather the metrics of the generation runs: every task of the job array
+writes a small json file next to its output with the duration of its stages,
+the utilization and peak memory of its workers, the time its batches waited in the pool
+queue, and optionally the profiles of its slowest molecules.
+Run as a script, it summarizes the metrics of a whole job array in percentile tables
+"""
+from __future__ import annotations
+import os
+import sys
+import io
+import json
+import glob
+import pstats
+import cProfile
+import resource
+from pathlib import Path
+import argparse
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.lazy_import import LazyModule
+
+# heavy dependencies are imported on first use
+np = LazyModule("numpy")
+pq = LazyModule("pyarrow.parquet")
+
+# sidecar file written next to the output of a task
+METRICS_SUFFIX = ".metrics.json"
+# durations recorded by get_clearsmiles for every molecule
+STAGE_COLUMNS_LIST = ["random_gen_time", "min_max_digit_time", "mem_map_time",
+                      "enumeration_time", "total_time"]
+# durations of the task, measured in the parent process
+TASK_TIMES_LIST = ["read_time", "pool_time", "write_time", "merge_time", "wall_time"]
+PERCENTILES_LIST = [50, 90, 99]
+
+
+def get_metrics_path(output_filepath: str) -> str:
+    """ default path of the metrics of a task """
+    return f"{output_filepath}{METRICS_SUFFIX}"
+
+
+def get_peak_rss_mb() -> float:
+    """ peak resident memory of the calling process in megabytes, ru_maxrss is in kB on linux """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize_values(values_list: list) -> dict:
+    """
+    This function summarize a distribution of values
+
+    Args:
+        values_list (list of float): the values, None values are ignored
+
+    return:
+        summary_dict (dict): count, sum, mean, percentiles and max of the values
+    """
+    # declare local variables
+    values_array = np.array([value for value in values_list if value is not None], dtype=float)
+    summary_dict = {"count": len(values_array), "sum": float(values_array.sum())}
+    if not values_array.size:
+        return summary_dict
+
+    summary_dict["mean"] = float(values_array.mean())
+    for percentile in PERCENTILES_LIST:
+        summary_dict[f"p{percentile}"] = float(np.percentile(values_array, percentile))
+    summary_dict["max"] = float(values_array.max())
+
+    return summary_dict
+
+
+def profile_call(function, *call_args, nb_lines: int = 15) -> tuple:
+    """
+    This function call a function under cProfile
+
+    Args:
+        function (callable): the profiled function
+        *call_args: the arguments of the function
+        nb_lines (int): number of functions kept in the report, by cumulative time
+
+    return:
+        (result, profile_text) (tuple): the result of the function and the profile report
+    """
+    # declare local variables
+    profiler = cProfile.Profile()
+    stream = io.StringIO()
+
+    result = profiler.runcall(function, *call_args)
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(nb_lines)
+
+    return result, stream.getvalue()
+
+
+def keep_slowest(profiles_list: list, new_profiles_list: list, nb_slowest: int) -> list:
+    """
+    This function keep the profiles of the slowest molecules
+
+    Args:
+        profiles_list (list of dict): the profiles kept so far
+        new_profiles_list (list of dict): new profiles, with a total_time key
+        nb_slowest (int): number of profiles kept
+
+    return:
+        profiles_list (list of dict): the nb_slowest slowest profiles, slowest first
+    """
+    return sorted(profiles_list + new_profiles_list,
+                  key=lambda profile_dict: profile_dict["total_time"], reverse=True)[:nb_slowest]
+
+
+def read_stage_times(output_filepath: str) -> dict:
+    """
+    This function read the durations of the stages of every molecule of an output,
+    only the duration columns are read
+
+    Args:
+        output_filepath (str): the output parquet file of a task
+
+    return:
+        stage_times_dict (dict): the durations of every molecule, per stage
+    """
+    # older outputs may miss some stages
+    schema_names_list = pq.read_schema(output_filepath).names
+    table = pq.read_table(output_filepath, columns=[column for column in STAGE_COLUMNS_LIST
+                                                    if column in schema_names_list])
+
+    return {column: table.column(column).to_pylist() for column in table.column_names}
+
+
+def write_metrics(metrics_dict: dict, metrics_path: str) -> None:
+    """ write the metrics of a task, through a temporary file so that a reader never sees
+    a partial file """
+    with open(metrics_path + ".tmp", "w", encoding="utf-8") as json_file:
+        json.dump(metrics_dict, json_file, indent=1)
+    os.replace(metrics_path + ".tmp", metrics_path)
+
+
+def summarize_metrics(search_pattern: str) -> dict:
+    """
+    This function summarize the metrics of the tasks of a job array in percentile tables.
+    The durations of the stages are read from the outputs of the tasks,
+    so that their percentiles are computed over every molecule of the job array
+
+    Args:
+        search_pattern (str): unix style pathname pattern of the metrics files
+
+    return:
+        summary_dict (dict): nb_tasks, and a summary per metric
+    """
+    # declare local variables
+    metrics_list = []
+    for metrics_path in sorted(glob.glob(search_pattern)):
+        with open(metrics_path, encoding="utf-8") as json_file:
+            metrics_list.append(json.load(json_file))
+    summary_dict = {"nb_tasks": len(metrics_list)}
+
+    # task level values
+    for key in ["nb_molecules"] + TASK_TIMES_LIST:
+        summary_dict[key] = summarize_values([metrics_dict["task"].get(key)
+                                              for metrics_dict in metrics_list])
+
+    # worker level values, every worker of every task
+    for key in ["peak_rss_mb", "utilization"]:
+        summary_dict[f"worker_{key}"] = summarize_values(
+            [worker_dict[key] for metrics_dict in metrics_list
+             for worker_dict in metrics_dict["workers"].values()])
+
+    # batch level values
+    for key in ["queue_wait_time", "result_wait_time"]:
+        summary_dict[key] = summarize_values([value for metrics_dict in metrics_list
+                                              for value in metrics_dict[key]])
+
+    # molecule level values, a missing output is skipped
+    stage_values_dict = {column: [] for column in STAGE_COLUMNS_LIST}
+    for metrics_dict in metrics_list:
+        output_filepath = metrics_dict["task"]["output_filepath"]
+        if not os.path.exists(output_filepath):
+            continue
+        for column, values_list in read_stage_times(output_filepath).items():
+            stage_values_dict[column] += values_list
+    for column, values_list in stage_values_dict.items():
+        summary_dict[column] = summarize_values(values_list)
+
+    return summary_dict
+
+
+def print_summary(summary_dict: dict) -> None:
+    """ print the summary of a job array as a percentile table """
+    print(f"{summary_dict['nb_tasks']} tasks")
+    print(f"{'metric':<24}{'count':>10}{'sum':>14}{'mean':>12}{'p50':>12}{'p90':>12}"
+          f"{'p99':>12}{'max':>12}")
+    for key, value_dict in summary_dict.items():
+        if not isinstance(value_dict, dict):
+            continue
+        print(f"{key:<24}{value_dict['count']:>10}{value_dict['sum']:>14.2f}" +
+              "".join(f"{value_dict.get(column, float('nan')):>12.3f}"
+                      for column in ["mean"] + [f"p{percentile}" for percentile
+                                                in PERCENTILES_LIST] + ["max"]))
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--search_pattern', help="unix style pathname pattern \
+                         to find the metrics of the tasks",
+                        default="data/interim/ClearSMILES_MOSES_subset_*.parquet.metrics.json",
+                        type=str)
+    parser.add_argument('--output_filepath', help="the output file should be a json file",
+                        default="data/processed/generation_metrics_summary.json",
+                        type=str)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    os.chdir(project_dir)
+
+    # execute
+    job_array_summary_dict = summarize_metrics(args_dict["search_pattern"])
+    print_summary(job_array_summary_dict)
+    with open(args_dict["output_filepath"], "w", encoding="utf-8") as summary_file:
+        json.dump(job_array_summary_dict, summary_file, indent=1)
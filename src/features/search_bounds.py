@@ -0,0 +1,124 @@
+"""This module compute lower bounds of the max digit and of the semantic memory score
+that any SMILES of a molecule can achieve, the bounds are derived from the molecular graph.
+They are used to stop the search of ClearSMILES as soon as the theoretical optimum is reached
+"""
+import re
+from rdkit import Chem
+
+# bracket atoms may contain digits (isotopes, hydrogen count, charges)
+BRACKET_ATOM_REGEX = re.compile(r"\[[^\]]+]")
+
+
+def get_bracket_digit(smiles: str) -> int:
+    """
+    This function find the biggest digit written inside bracket atoms,
+    these digits do not depend on the traversal of the molecule
+
+    Args:
+        smiles (str): a valid SMILES
+
+    return:
+        bracket_digit (int): the biggest digit inside bracket atoms, 0 if there is none
+    """
+    digits_list = [int(char) for token in BRACKET_ATOM_REGEX.findall(smiles)
+                   for char in token if char.isdigit()]
+
+    return max(digits_list, default=0)
+
+
+def get_min_nb_branches(mol: Chem.Mol) -> int:
+    """
+    This function compute the minimal number of branches of any SMILES of an acyclic molecule,
+    a tree with L leaves written from one of its leaves has L-2 branches
+
+    Args:
+        mol (Chem.Mol): an acyclic rdkit molecule
+
+    return:
+        min_nb_branches (int): the minimal number of branches
+    """
+    # declare local variables
+    min_nb_branches = 0
+
+    # every fragment is written independently
+    for fragment_atoms in Chem.GetMolFrags(mol):
+        nb_leaves = sum(1 for atom_idx in fragment_atoms
+                        if mol.GetAtomWithIdx(atom_idx).GetDegree() == 1)
+        min_nb_branches += max(0, nb_leaves - 2)
+
+    return min_nb_branches
+
+
+def compute_lower_bounds(mol: Chem.Mol) -> dict:
+    """
+    This function compute graph derived lower bounds for the ClearSMILES search.
+
+    Every ring closure keeps a digit open over at least the size of the smallest ring tokens,
+    every branch keeps a parenthesis open over at least 2 tokens and adds 2 tokens.
+    The semantic memory score (mean of the memory map) is therefore above
+    (N + 2B) / (T + 2B), with N the memory contributed by ring closures,
+    B the minimal number of branches and T an upper bound of the number of tokens
+    without branches. Adding branches moves the ratio toward 1,
+    hence the bound is capped at 1
+
+    Args:
+        mol (Chem.Mol): an rdkit molecule
+
+    return:
+        bounds_dict (dict): dict with string as keys and various type of values
+            max_digit (int): lower bound of the max digit
+            mem_score (float): lower bound of the semantic memory score
+            is_linear (bool): True for acyclic and unbranched molecules made of one fragment,
+            every SMILES written from one of its end is then optimal
+            bracket_digit (int): the biggest digit written inside bracket atoms
+            max_nb_tokens (int): upper bound of the number of tokens without branches
+    """
+    # declare local variables
+    kekule_mol = Chem.Mol(mol)
+    Chem.Kekulize(kekule_mol, clearAromaticFlags=True)
+    nb_atoms = mol.GetNumAtoms()
+    nb_fragments = len(Chem.GetMolFrags(mol))
+    nb_ring_closures = mol.GetNumBonds() - nb_atoms + nb_fragments
+    bracket_digit = get_bracket_digit(Chem.MolToSmiles(kekule_mol))
+    bounds_dict = {
+        "max_digit": bracket_digit,
+        "mem_score": 0.0,
+        "is_linear": False,
+        "bracket_digit": bracket_digit,
+        "max_nb_tokens": int,
+    }
+
+    # acyclic molecules need no digit, unbranched ones have an empty memory map
+    if nb_ring_closures == 0:
+        min_nb_branches = get_min_nb_branches(mol)
+        bounds_dict["is_linear"] = nb_fragments == 1 and min_nb_branches == 0 and \
+            all(atom.GetDegree() <= 2 for atom in mol.GetAtoms())
+        ring_memory = 0
+    else:
+        min_nb_branches = 0
+        smallest_ring_size = min(len(ring) for ring in mol.GetRingInfo().AtomRings())
+        ring_memory = nb_ring_closures * smallest_ring_size
+        bounds_dict["max_digit"] = max(bounds_dict["max_digit"], 1)
+
+    # kekule bond symbols are written once, a dative bond is written with two tokens
+    nb_bond_tokens = sum(2 if bond.GetBondType() == Chem.BondType.DATIVE else 1
+                         for bond in kekule_mol.GetBonds()
+                         if bond.GetBondType() != Chem.BondType.SINGLE)
+
+    # directional bonds around stereo double bonds may be written on both sides of a closure
+    stereo_bonds_set = {neighbor_bond.GetIdx()
+                        for bond in kekule_mol.GetBonds()
+                        if bond.GetStereo() != Chem.BondStereo.STEREONONE
+                        for atom in (bond.GetBeginAtom(), bond.GetEndAtom())
+                        for neighbor_bond in atom.GetBonds()
+                        if neighbor_bond.GetBondType() == Chem.BondType.SINGLE}
+    nb_bond_tokens += 2 * len(stereo_bonds_set)
+    max_nb_tokens = nb_atoms + nb_bond_tokens + 2 * nb_ring_closures + nb_fragments - 1
+    bounds_dict["max_nb_tokens"] = max_nb_tokens
+
+    # mediant of the ring closures and branches contributions
+    if max_nb_tokens > 0:
+        bounds_dict["mem_score"] = min((ring_memory + 2 * min_nb_branches) /
+                                       (max_nb_tokens + 2 * min_nb_branches), 1.0)
+
+    return bounds_dict
@@ -0,0 +1,133 @@
+"""
+This module run several chunks of the database in a single process with a persistent pool,
+so that the interpreter, the imports and the workers are started once: the tasks
+of a job array given with --task_ids, or the ranges pulled from a shared work queue
+"""
+from __future__ import annotations
+import sys
+import time
+from pathlib import Path
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.plan_chunks import format_job_array_range
+from features.work_queue import claim_range, complete_range, release_range, hold_lease, \
+    get_chunk_idx, get_worker_id, get_queue_status
+from features.generate_clearsmiles import main
+
+
+def get_remaining_config(config_dict: dict, start_time: float) -> dict:
+    """ the configuration of the next task, whose time limit is what remains of the time
+    limit of the process, the metrics are written next to the output of every task """
+    task_time_limit = config_dict.get("task_time_limit")
+    return dict(config_dict, metrics_path=None,
+                task_time_limit=None if task_time_limit is None else
+                task_time_limit - (time.perf_counter() - start_time))
+
+
+def run_tasks(task_chunks_list: list, output_pattern: str, config_dict: dict) -> list:
+    """
+    This function run several tasks of the job array one after another in the same process,
+    with a single persistent pool, so that the startup of the interpreter and of the workers
+    is paid once. Every task writes its own output, as if it was run alone
+
+    Args:
+        task_chunks_list (list of tuple): the task id and the chunk indices of every task
+        output_pattern (str): the output path of the tasks, * is replaced by the task id
+        config_dict (dict): the configuration shared by the tasks, see main, its
+        task_time_limit is the duration in seconds after which the running task
+        is checkpointed and the remaining tasks are skipped
+
+    return:
+        finished_task_id_list (list of int): the tasks whose output was written
+    """
+    # declare local variables
+    pool_dict = {}
+    start_time = time.perf_counter()
+    finished_task_id_list = []
+
+    try:
+        for task_id, chunk_dict in task_chunks_list:
+            print(f"task {task_id}: rows {chunk_dict['first_idx']}-{chunk_dict['last_idx']}")
+            main(output_filepath=output_pattern.replace("*", str(task_id)),
+                 chunk_indices=chunk_dict,
+                 config_dict=get_remaining_config(config_dict, start_time),
+                 pool_dict=pool_dict)
+            if pool_dict["deadline_reached"]:
+                break
+            finished_task_id_list.append(task_id)
+    finally:
+        if pool_dict.get("pool") is not None:
+            pool_dict["pool"].close()
+            pool_dict["pool"].join()
+
+    # the tasks to relaunch, the interrupted one keeps its checkpoint
+    unfinished_task_id_list = [task_id for task_id, _ in task_chunks_list
+                               if task_id not in finished_task_id_list]
+    if unfinished_task_id_list:
+        print(f"relaunch with --task_ids {format_job_array_range(unfinished_task_id_list)}")
+
+    return finished_task_id_list
+
+
+def run_queue_worker(queue_dir: str, output_pattern: str, config_dict: dict,
+                     lease_time: float = 600.0) -> list:
+    """
+    This function pull ranges of rows from a shared work queue and compute them
+    with a single persistent pool until the queue is empty.
+    While other workers hold ranges, the worker waits for their leases to expire
+    so that the ranges of dead workers are computed again, resuming from their checkpoint
+
+    Args:
+        queue_dir (str): the queue directory created by work_queue.create_queue
+        output_pattern (str): the output path of the ranges, * is replaced by the range name
+        config_dict (dict): the configuration shared by the ranges, see main, its
+        task_time_limit is the duration in seconds after which the running range
+        is checkpointed and given back to the queue
+        lease_time (float): duration in seconds after which a range whose lease was not
+        renewed is claimed again
+
+    return:
+        done_range_list (list of str): the names of the ranges computed by the worker
+    """
+    # declare local variables
+    pool_dict = {"deadline_reached": False}
+    worker_id = get_worker_id()
+    start_time = time.perf_counter()
+    task_time_limit = config_dict.get("task_time_limit")
+    done_range_list = []
+
+    try:
+        while task_time_limit is None or time.perf_counter() - start_time < task_time_limit:
+            range_name, claim_path = claim_range(queue_dir, worker_id, lease_time)
+
+            # nothing to claim, the ranges held by other workers may still be abandoned
+            if range_name is None:
+                if not get_queue_status(queue_dir, lease_time)["claimed"]:
+                    break
+                time.sleep(min(lease_time / 4, 30.0))
+                continue
+
+            print(f"worker {worker_id}: range {range_name}")
+            with hold_lease(claim_path, lease_time) as lease_dict:
+                main(output_filepath=output_pattern.replace("*", range_name),
+                     chunk_indices=get_chunk_idx(range_name),
+                     config_dict=get_remaining_config(config_dict, start_time),
+                     pool_dict=pool_dict,
+                     lease_dict=lease_dict)
+
+            # another worker claimed the range, it writes the output
+            if lease_dict["lost"]:
+                print(f"worker {worker_id}: lease of range {range_name} lost")
+                continue
+            if pool_dict["deadline_reached"]:
+                release_range(queue_dir, range_name, claim_path)
+                break
+            if complete_range(queue_dir, range_name, claim_path):
+                done_range_list.append(range_name)
+    finally:
+        if pool_dict.get("pool") is not None:
+            pool_dict["pool"].close()
+            pool_dict["pool"].join()
+
+    return done_range_list
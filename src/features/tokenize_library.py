@@ -0,0 +1,311 @@
+"""
+This script tokenize the aggregated ClearSMILES library once, so that training jobs
+do not have to run the tokenizer regex over millions of SMILES.
+The vocabulary is built as a map-reduce over the row groups of the library,
+then every ClearSMILES is written as an array of uint8 token ids, or uint16 if the
+vocabulary has more than 256 tokens, with the vocabulary and its statistics in a json file.
+A SMILES with characters the tokenizer regex does not match cannot be encoded without loss,
+such SMILES are reported in the statistics and the token ids are not written
+"""
+import os
+import sys
+import re
+import json
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+sys.path.insert(0, f"{Path(__file__).resolve().parents[1]}/")
+from features.clearsmiles_search import SMILES_TOKENS_REGEX
+
+# the id 0 is reserved for padding the token ids arrays
+PAD_TOKEN = "<pad>"
+TOKEN_IDS_SUFFIX = "_token_ids"
+# number of unencodable SMILES kept as examples in the statistics
+NB_UNENCODABLE_EXAMPLES = 10
+
+
+def get_smiles_lists(array: pa.Array) -> list:
+    """
+    This function read a column of SMILES as lists, a string column has one SMILES per row
+
+    Args:
+        array (pa.Array): a list<string> or string column
+
+    return:
+        smiles_lists (list): a list of SMILES, or None, for every row
+    """
+    if pa.types.is_list(array.type) or pa.types.is_large_list(array.type):
+        return array.to_pylist()
+
+    return [None if smiles is None else [smiles] for smiles in array.to_pylist()]
+
+
+def count_row_group_tokens(library_path: str, column: str, row_group_idx: int) -> tuple:
+    """
+    This function is the map step of the vocabulary, it count the tokens of a row group
+
+    Args:
+        library_path (str): the aggregated library parquet file
+        column (str): the column of SMILES to tokenize
+        row_group_idx (int): index of the row group
+
+    return:
+        (token_counter, nb_smiles, max_length, unencodable_list) (tuple): the token
+        frequencies, the number of SMILES, the number of tokens of the longest SMILES,
+        and the SMILES whose tokens do not join back to the SMILES, left out of the counts
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    token_counter = Counter()
+    nb_smiles = 0
+    max_length = 0
+    unencodable_list = []
+
+    array = pq.ParquetFile(library_path).read_row_group(row_group_idx, columns=[column]) \
+        .column(column).combine_chunks()
+    for smiles_list in get_smiles_lists(array):
+        for smiles in smiles_list or []:
+            tokens_list = smiles_regex.findall(smiles)
+            # findall skips the characters the regex does not match
+            if "".join(tokens_list) != smiles:
+                unencodable_list.append(smiles)
+                continue
+            token_counter.update(tokens_list)
+            nb_smiles += 1
+            max_length = max(max_length, len(tokens_list))
+
+    return token_counter, nb_smiles, max_length, unencodable_list
+
+
+def build_vocabulary(library_path: str, column: str, nb_core: int = None) -> dict:
+    """
+    This function build the vocabulary of the library, the row groups are counted
+    in parallel then the counts are summed
+
+    Args:
+        library_path (str): the aggregated library parquet file
+        column (str): the column of SMILES to tokenize
+        nb_core (int): number of worker processes, all the available cores if None
+
+    return:
+        vocab_dict (dict): the tokens ordered by id, their frequencies, and the statistics
+        of the library, with the number of unencodable SMILES and a few of them
+    """
+    # declare local variables
+    token_counter = Counter()
+    nb_smiles = 0
+    max_length = 0
+    unencodable_list = []
+    nb_unencodable = 0
+    nb_row_groups = pq.ParquetFile(library_path).num_row_groups
+
+    # map over the row groups, reduce in the main process
+    with Pool(nb_core) as pool:
+        for row_group_counter, row_group_nb_smiles, row_group_max_length, \
+                row_group_unencodable_list in pool.imap_unordered(
+                    partial(count_row_group_tokens, library_path, column), range(nb_row_groups)):
+            token_counter.update(row_group_counter)
+            nb_smiles += row_group_nb_smiles
+            max_length = max(max_length, row_group_max_length)
+            nb_unencodable += len(row_group_unencodable_list)
+            unencodable_list += row_group_unencodable_list[:NB_UNENCODABLE_EXAMPLES -
+                                                           len(unencodable_list)]
+
+    # the most frequent tokens get the smallest ids, ties are broken by token
+    tokens_list = [PAD_TOKEN] + sorted(token_counter, key=lambda token: (-token_counter[token],
+                                                                         token))
+
+    return {
+        "column": column,
+        "size": len(tokens_list),
+        "dtype": "uint8" if len(tokens_list) <= 256 else "uint16",
+        "tokens": tokens_list,
+        "frequencies": [0] + [token_counter[token] for token in tokens_list[1:]],
+        "nb_smiles": nb_smiles,
+        "nb_tokens": sum(token_counter.values()),
+        "max_length": max_length,
+        "nb_unencodable_smiles": nb_unencodable,
+        "unencodable_smiles": unencodable_list,
+    }
+
+
+def encode_row_group(library_path: str, column: str, vocab_dict: dict,
+                     keep_columns_list: list, row_group_idx: int) -> pa.Table:
+    """
+    This function write the token ids of the SMILES of a row group
+
+    Args:
+        library_path (str): the aggregated library parquet file
+        column (str): the column of SMILES to tokenize
+        vocab_dict (dict): the vocabulary built by build_vocabulary
+        keep_columns_list (list of str): columns of the library copied to the output
+        row_group_idx (int): index of the row group
+
+    return:
+        table (pa.Table): the kept columns and the token ids column, a list of token ids
+        arrays for a list<string> column, a token ids array for a string column
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    token_idx_dict = {token: token_idx for token_idx, token in enumerate(vocab_dict["tokens"])}
+    table = pq.ParquetFile(library_path).read_row_group(row_group_idx,
+                                                        columns=keep_columns_list + [column])
+    array = table.column(column).combine_chunks()
+    is_nested = pa.types.is_list(array.type) or pa.types.is_large_list(array.type)
+    token_idx_list = []
+    smiles_offsets_list = [0]
+    row_offsets_list = [0]
+    null_list = []
+
+    # the token ids are flattened then wrapped in list arrays with their offsets
+    for smiles_list in get_smiles_lists(array):
+        null_list.append(smiles_list is None)
+        # a null row of a string column still needs its own offset
+        if smiles_list is None and not is_nested:
+            smiles_offsets_list.append(len(token_idx_list))
+        for smiles in smiles_list or []:
+            token_idx_list += [token_idx_dict[token] for token in smiles_regex.findall(smiles)]
+            smiles_offsets_list.append(len(token_idx_list))
+        row_offsets_list.append(len(smiles_offsets_list) - 1)
+    token_ids_array = pa.array(np.array(token_idx_list, dtype=vocab_dict["dtype"]))
+    null_array = pa.array(null_list, type=pa.bool_())
+    if is_nested:
+        token_ids_array = pa.ListArray.from_arrays(
+            pa.array(row_offsets_list, type=pa.int32()),
+            pa.ListArray.from_arrays(pa.array(smiles_offsets_list, type=pa.int32()),
+                                     token_ids_array),
+            mask=null_array)
+    else:
+        token_ids_array = pa.ListArray.from_arrays(pa.array(smiles_offsets_list, type=pa.int32()),
+                                                   token_ids_array, mask=null_array)
+
+    return table.select(keep_columns_list).append_column(column + TOKEN_IDS_SUFFIX,
+                                                         token_ids_array)
+
+
+def load_vocabulary(vocab_filepath: str) -> dict:
+    """ read the vocabulary written by this script """
+    with open(vocab_filepath, encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def decode_token_ids(token_ids: list, vocab_dict: dict) -> str:
+    """
+    This function convert token ids back to a SMILES, padding is ignored
+
+    Args:
+        token_ids (list of int or numpy array): the token ids of a SMILES
+        vocab_dict (dict): the vocabulary built by build_vocabulary
+
+    return:
+        smiles (str): the SMILES
+    """
+    return "".join(vocab_dict["tokens"][token_idx] for token_idx in token_ids if token_idx)
+
+
+def main(library_path: str,
+         output_filepath: str,
+         vocab_filepath: str,
+         column: str = "ClearSMILES_set",
+         keep_columns_list: list = None,
+         nb_core: int = None) -> dict:
+    """ This function build the vocabulary then write the token ids of the library,
+    the output has the same row groups and row order as the library.
+    A ValueError is raised after writing the vocabulary if some SMILES cannot be encoded
+
+    Args:
+        library_path (str): the aggregated library parquet file
+        output_filepath (str): the output parquet file of token ids
+        vocab_filepath (str): the output json file of the vocabulary
+        column (str): the column of SMILES to tokenize
+        keep_columns_list (list of str): columns of the library copied to the output,
+        SMILES if None
+        nb_core (int): number of worker processes, all the available cores if None
+
+    return:
+        vocab_dict (dict): the vocabulary and its statistics
+    """
+    # declare local variables
+    if keep_columns_list is None:
+        keep_columns_list = [name for name in ["SMILES"]
+                             if name in pq.read_schema(library_path).names]
+    nb_row_groups = pq.ParquetFile(library_path).num_row_groups
+
+    # first pass, the vocabulary
+    vocab_dict = build_vocabulary(library_path, column, nb_core)
+    with open(vocab_filepath, "w", encoding="utf-8") as json_file:
+        json.dump(vocab_dict, json_file, indent=1)
+    print(f"{vocab_dict['size']} tokens ({vocab_dict['dtype']}) "
+          f"for {vocab_dict['nb_smiles']} SMILES, longest SMILES: {vocab_dict['max_length']}")
+    if vocab_dict["nb_unencodable_smiles"]:
+        raise ValueError(f"{vocab_dict['nb_unencodable_smiles']} SMILES have characters "
+                         f"unknown to the tokenizer, e.g. {vocab_dict['unencodable_smiles']}, "
+                         f"see {vocab_filepath}")
+
+    # second pass, the token ids, written in the order of the library
+    writer = None
+    with Pool(nb_core) as pool:
+        for table in pool.imap(partial(encode_row_group, library_path, column, vocab_dict,
+                                       keep_columns_list), range(nb_row_groups)):
+            if writer is None:
+                writer = pq.ParquetWriter(output_filepath, table.schema)
+            writer.write_table(table, row_group_size=max(table.num_rows, 1))
+    if writer is not None:
+        writer.close()
+
+    return vocab_dict
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--library_path', help="the aggregated library parquet file",
+                        default="data/processed/whole_MOSES_ClearSMILES_results.parquet",
+                        type=str)
+    parser.add_argument('--output_filepath', help="the output file should be a parquet file",
+                        default="data/processed/whole_MOSES_ClearSMILES_token_ids.parquet",
+                        type=str)
+    parser.add_argument('--vocab_filepath', help="the output file should be a json file",
+                        default="data/processed/whole_MOSES_ClearSMILES_vocab.json",
+                        type=str)
+
+    # tokenization arguments
+    parser.add_argument('--column', help="the column of SMILES to tokenize, \
+                        either a list of SMILES or a SMILES per row",
+                        default="ClearSMILES_set",
+                        type=str)
+    parser.add_argument('--keep_columns', help="columns of the library copied to the output",
+                        default=None,
+                        nargs="+",
+                        type=str)
+
+    # computation argument
+    parser.add_argument('--nb_core', help="number of worker processes, \
+                        all the available cores by default",
+                        default=None,
+                        type=int)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    os.chdir(project_dir)
+
+    # execute main
+    main(library_path=args_dict["library_path"],
+         output_filepath=args_dict["output_filepath"],
+         vocab_filepath=args_dict["vocab_filepath"],
+         column=args_dict["column"],
+         keep_columns_list=args_dict["keep_columns"],
+         nb_core=args_dict["nb_core"])
@@ -0,0 +1,257 @@
+"""
+This module is a pull-based work queue on a shared filesystem, an alternative to the static
+split of the job array: any number of workers, on one machine or on many nodes,
+claim small row ranges of the database until none is left.
+Every state change is an atomic rename of the file of a range between the todo,
+claimed and done directories, so that only one worker wins a range, without any lock server.
+A claimed range holds a lease, its modification time, renewed by the worker while it runs;
+the ranges of dead workers are claimed again once their lease expired,
+and the clocks of the nodes are assumed to be synchronized
+"""
+import os
+import json
+import time
+import socket
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import argparse
+
+STATES_LIST = ["todo", "claimed", "done"]
+QUEUE_FILENAME = "queue.json"
+
+
+def get_range_name(first_idx: int, last_idx: int) -> str:
+    """ name of a range, zero padded so that names sort as the rows """
+    return f"{first_idx:010d}-{last_idx:010d}"
+
+
+def get_chunk_idx(range_name: str) -> dict:
+    """ chunk indices of a range, with the same keys than compute_chunk_idx """
+    first_idx, last_idx = range_name.split("-")
+
+    return {"first_idx": int(first_idx), "last_idx": int(last_idx), "extra_idx": None}
+
+
+def get_worker_id() -> str:
+    """ unique name of the calling process among the nodes sharing the queue """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def create_queue(queue_dir: str, nb_smiles: int, range_size: int) -> bool:
+    """
+    This function create the queue of the ranges of a database. The queue is built
+    in a temporary directory renamed at once, thus workers starting together
+    can all call it and only one of them creates the queue
+
+    Args:
+        queue_dir (str): the queue directory, on a filesystem shared by the workers
+        nb_smiles (int): number of rows of the database
+        range_size (int): number of rows per range
+
+    return:
+        is_created (bool): False if the queue already existed
+    """
+    # declare local variables
+    tmp_dir = f"{queue_dir}.tmp-{get_worker_id()}"
+    if os.path.isdir(queue_dir):
+        return False
+
+    for state in STATES_LIST:
+        os.makedirs(os.path.join(tmp_dir, state), exist_ok=True)
+    for first_idx in range(0, nb_smiles, range_size):
+        Path(tmp_dir, "todo", get_range_name(first_idx, min(first_idx + range_size,
+                                                            nb_smiles))).touch()
+    with open(os.path.join(tmp_dir, QUEUE_FILENAME), "w", encoding="utf-8") as json_file:
+        json.dump({"nb_smiles": nb_smiles, "range_size": range_size}, json_file)
+
+    # renaming onto an existing directory fails, another worker created the queue first
+    try:
+        os.rename(tmp_dir, queue_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(queue_dir):
+            raise
+        return False
+
+    return True
+
+
+def take_range(source_path: str, claim_path: str) -> bool:
+    """
+    This function move a range to the claimed directory and start its lease,
+    the rename fails if another worker took the range first
+
+    Args:
+        source_path (str): the file of the range, todo or claimed by another worker
+        claim_path (str): the file of the range claimed by the worker
+
+    return:
+        is_taken (bool): True if the worker holds the range
+    """
+    try:
+        os.rename(source_path, claim_path)
+        # the renamed file keeps its old time, it may be taken again before the renewal
+        renew_lease(claim_path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def renew_lease(claim_path: str) -> None:
+    """ extend the lease of a claimed range, raise FileNotFoundError if it was lost """
+    now = time.time()
+    os.utime(claim_path, (now, now))
+
+
+def get_expired_claims(queue_dir: str, lease_time: float) -> list:
+    """ file names of the claimed ranges whose lease expired """
+    # declare local variables
+    claimed_dir = os.path.join(queue_dir, "claimed")
+    expired_list = []
+
+    for claim_name in sorted(os.listdir(claimed_dir)):
+        try:
+            if time.time() - os.path.getmtime(os.path.join(claimed_dir, claim_name)) > lease_time:
+                expired_list.append(claim_name)
+        except FileNotFoundError:
+            continue
+
+    return expired_list
+
+
+def claim_range(queue_dir: str, worker_id: str, lease_time: float) -> tuple:
+    """
+    This function claim the first range left in the queue,
+    or the first range whose lease expired
+
+    Args:
+        queue_dir (str): the queue directory
+        worker_id (str): unique name of the worker
+        lease_time (float): duration in seconds after which a claimed range can be taken
+
+    return:
+        (range_name, claim_path) (tuple): the claimed range, (None, None) if there is none
+    """
+    # declare local variables
+    todo_dir = os.path.join(queue_dir, "todo")
+    claimed_dir = os.path.join(queue_dir, "claimed")
+
+    for range_name in sorted(os.listdir(todo_dir)):
+        claim_path = os.path.join(claimed_dir, f"{range_name}.{worker_id}")
+        if take_range(os.path.join(todo_dir, range_name), claim_path):
+            return range_name, claim_path
+
+    # ranges abandoned by dead workers
+    for claim_name in get_expired_claims(queue_dir, lease_time):
+        range_name = claim_name.split(".")[0]
+        claim_path = os.path.join(claimed_dir, f"{range_name}.{worker_id}")
+        if take_range(os.path.join(claimed_dir, claim_name), claim_path):
+            return range_name, claim_path
+
+    return None, None
+
+
+def complete_range(queue_dir: str, range_name: str, claim_path: str) -> bool:
+    """ move a claimed range to the done directory, False if the lease was lost meanwhile """
+    try:
+        os.rename(claim_path, os.path.join(queue_dir, "done", range_name))
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def release_range(queue_dir: str, range_name: str, claim_path: str) -> bool:
+    """ give back a claimed range to the queue, False if the lease was lost meanwhile """
+    try:
+        os.rename(claim_path, os.path.join(queue_dir, "todo", range_name))
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+@contextmanager
+def hold_lease(claim_path: str, lease_time: float):
+    """
+    This context manager renew the lease of a claimed range in a background thread
+    while the range is computed
+
+    Args:
+        claim_path (str): the file of the claimed range
+        lease_time (float): duration of the lease in seconds, renewed every third of it
+
+    yield:
+        lease_dict (dict): lost is set to True if another worker took the range,
+        claim_path is the file of the range
+    """
+    # declare local variables
+    lease_dict = {"lost": False, "claim_path": claim_path}
+    stop_event = threading.Event()
+
+    def renew_until_stopped():
+        while not stop_event.wait(lease_time / 3):
+            try:
+                renew_lease(claim_path)
+            except FileNotFoundError:
+                lease_dict["lost"] = True
+                return
+
+    thread = threading.Thread(target=renew_until_stopped, daemon=True)
+    thread.start()
+    try:
+        yield lease_dict
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def get_queue_status(queue_dir: str, lease_time: float) -> dict:
+    """
+    This function count the ranges of the queue in every state
+
+    Args:
+        queue_dir (str): the queue directory
+        lease_time (float): duration in seconds after which a claimed range can be taken
+
+    return:
+        status_dict (dict): number of todo, claimed, expired and done ranges
+    """
+    # declare local variables
+    status_dict = {state: len(os.listdir(os.path.join(queue_dir, state)))
+                   for state in STATES_LIST}
+    status_dict["expired"] = len(get_expired_claims(queue_dir, lease_time))
+
+    return status_dict
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser()
+
+    # files & directory arguments
+    parser.add_argument('--queue_dir', help="the queue directory, on a filesystem shared \
+                        by the workers",
+                        default="data/interim/ClearSMILES_MOSES_queue",
+                        type=str)
+
+    # queue arguments
+    parser.add_argument('--lease_time', help="duration in seconds after which the range \
+                        of a worker which stopped renewing its lease is claimed again",
+                        default=600.0,
+                        type=float)
+
+    # parse and converto dict
+    args, _ = parser.parse_known_args()
+    args_dict = vars(args)
+
+    # change the working directory to main folder
+    project_dir = Path(__file__).resolve().parents[2]
+    os.chdir(project_dir)
+
+    # execute
+    queue_status_dict = get_queue_status(args_dict["queue_dir"], args_dict["lease_time"])
+    print(", ".join(f"{nb_ranges} {state}" for state, nb_ranges in queue_status_dict.items()))
@@ -0,0 +1,76 @@
+""" Test the batched scoring engine against the per SMILES functions
+"""
+from pathlib import Path
+import sys
+import re
+import pytest
+import numpy as np
+from rdkit import Chem
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.clearsmiles_search import find_biggest_digits, get_semantic_mem_map
+from features.batch_scoring import pack_smiles, batch_find_biggest_digits, \
+    batch_semantic_mem_score
+
+
+# declare global variables
+SMILES_TOKENS_REGEX = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|" + \
+    r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+SMILES_LIST = [
+    # imatinib
+    "CC1=C(C=C(C=C1)NC(=O)C2=CC=C(C=C2)CN3CCN(CC3)C)NC4=NC=CC(=N4)C5=CN=CC=C5",
+    # acetic acid
+    "CC(=O)O",
+    # aspirin
+    "CC(=O)OC1=CC=CC=C1C(=O)O",
+    # bracket atoms with digits, stereo bonds and ring closures above 9
+    "[13CH3][NH3+].[Na+]",
+    "C/C=C/C(Cl)Br",
+    "C1CC2CCC3CCC4CCC5CCC6CCC7CCC8CCC9CCC%10CCC1C%10C9C8C7C6C5C4C3C2",
+]
+
+
+def test_pack_smiles():
+    """test that the offsets point to the start of every SMILES
+    """
+    buffer, offsets = pack_smiles(SMILES_LIST)
+    assert buffer.dtype == np.uint8
+    assert len(offsets) == len(SMILES_LIST) + 1
+    for i, smiles in enumerate(SMILES_LIST):
+        packed = buffer[offsets[i]:offsets[i+1]-1].tobytes().decode("ascii")
+        assert packed == smiles
+
+
+def test_batch_find_biggest_digits():
+    """test that the batched max digit match find_biggest_digits
+    """
+    buffer, offsets = pack_smiles(SMILES_LIST)
+    expected_array = np.array([find_biggest_digits(smiles) for smiles in SMILES_LIST])
+    assert np.array_equal(batch_find_biggest_digits(buffer, offsets), expected_array)
+
+
+def test_batch_semantic_mem_score():
+    """test that the batched memory score match the mean of the semantic memory map,
+    on hand picked SMILES and on randomized kekule SMILES
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    smiles_list = list(SMILES_LIST)
+    for smiles in SMILES_LIST:
+        mol = Chem.MolFromSmiles(smiles)
+        smiles_list.extend(Chem.MolToRandomSmilesVect(mol, 200, randomSeed=42,
+                                                      kekuleSmiles=True))
+
+    # scores must be strictly equal, the ClearSMILES selection rely on equality
+    buffer, offsets = pack_smiles(smiles_list)
+    test_array = batch_semantic_mem_score(buffer, offsets)
+    expected_array = np.array([np.mean(get_semantic_mem_map(smiles, smiles_regex))
+                               for smiles in smiles_list])
+    assert np.array_equal(test_array, expected_array), \
+        "batched semantic memory score differ from get_semantic_mem_map"
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,118 @@
+""" Test the library interface of the generation of ClearSMILES
+"""
+from pathlib import Path
+import sys
+import pickle
+import subprocess
+import time
+import multiprocessing
+from itertools import count, islice
+import pytest
+import pyarrow as pa
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.clearsmiles_generator import ClearSmilesGenerator, ClearSmilesResult, \
+    results_to_table
+
+SMILES_LIST = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC"]
+
+
+def test_generate():
+    """
+    test that a molecule gets a record with its ClearSMILES
+    """
+    generator = ClearSmilesGenerator(nb_random=500, store_mem_maps=True)
+    result = generator.generate("CCO")
+    assert isinstance(result, ClearSmilesResult)
+    assert result.smiles == "CCO"
+    assert set(result.clearsmiles) == {"CCO", "OCC"}
+    assert result.search_path == "linear"
+    assert result.mem_maps == ((0, 0, 0), (0, 0, 0))
+    assert not hasattr(generator, "__dict__")
+    with pytest.raises(ValueError):
+        generator.generate("C1CC")
+
+    # the workers receive the parameters and compile the tokenizer again
+    copied_generator = pickle.loads(pickle.dumps(generator))
+    assert copied_generator.clearsmiles_kwargs == generator.clearsmiles_kwargs
+    assert copied_generator.generate("CCO").clearsmiles == result.clearsmiles
+
+
+def test_generate_batch_and_stream():
+    """
+    test that the stream computes the same molecules than the batch, in any order
+    """
+    generator = ClearSmilesGenerator(nb_random=300)
+    batch_list = generator.generate_batch(SMILES_LIST)
+    assert [result.smiles for result in batch_list] == SMILES_LIST
+
+    # in completion order, in input order, and in this process
+    stream_list = list(generator.stream(SMILES_LIST, workers=2))
+    assert sorted(result.smiles for result in stream_list) == sorted(SMILES_LIST)
+    assert [result.smiles for result in generator.stream(iter(SMILES_LIST), workers=2,
+                                                          chunksize=2, ordered=True)] == \
+        SMILES_LIST
+    assert [result.max_digit for result in generator.stream(SMILES_LIST, workers=0)] == \
+        [result.max_digit for result in batch_list]
+
+
+def test_stream_back_pressure():
+    """
+    test that the stream only reads the input it needs to keep the workers busy
+    """
+    # declare local variables
+    generator = ClearSmilesGenerator(nb_random=100)
+    counter = count()
+    smiles_iter = ("C" * (next(counter) % 5 + 1) for _ in count())
+
+    # an infinite input, the consumer stops after a few results
+    stream = generator.stream(smiles_iter, workers=2, max_pending=3)
+    assert len(list(islice(stream, 4))) == 4
+    stream.close()
+    assert next(counter) <= 4 + 3 + 1
+
+
+def test_stream_close_terminates_workers():
+    """
+    test that the workers still computing are stopped when the consumer stops iterating
+    """
+    # declare local variables
+    generator = ClearSmilesGenerator(nb_random=10_000_000, patience=1_000_000)
+    imatinib = "CC1=C(C=C(C=C1)NC(=O)C2=CC=C(C=C2)CN3CCN(CC3)C)NC4=NC=CC(=N4)C5=CN=CC=C5"
+
+    # the first molecule is computed at once, the search of the second one takes minutes
+    stream = generator.stream(["CCO", imatinib], workers=2)
+    assert next(stream).smiles == "CCO"
+    stream.close()
+    deadline = time.monotonic() + 10
+    while multiprocessing.active_children() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not multiprocessing.active_children()
+
+
+def test_results_to_table():
+    """
+    test that records are converted to an arrow table
+    """
+    generator = ClearSmilesGenerator(nb_random=300)
+    table = results_to_table(generator.generate_batch(SMILES_LIST))
+    assert table.num_rows == len(SMILES_LIST)
+    assert table.column("clearsmiles").type == pa.list_(pa.string())
+    assert table.column("smiles").to_pylist() == SMILES_LIST
+
+
+def test_import_cost():
+    """
+    test that importing the library interface loads neither pyarrow nor rdkit
+    """
+    code = "import sys\nimport features.clearsmiles_generator\n" \
+        "print(sorted(name for name in ('pyarrow', 'rdkit') if name in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=parent_path, check=True,
+                            capture_output=True, text=True).stdout
+    assert output.strip() == "[]"
+
+
+if __name__ == "__main__":
+    pytest.main()
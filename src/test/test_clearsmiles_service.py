@@ -0,0 +1,199 @@
+""" Test the local generation service
+"""
+from pathlib import Path
+import os
+import sys
+import json
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.clearsmiles_generator import ClearSmilesGenerator, init_stream_worker
+from features.clearsmiles_service import ClearSmilesService, serve
+
+
+async def send_request(connect, method: str, path: str, payload: dict = None) -> tuple:
+    """ send a single HTTP request, return the status and the json answer """
+    reader, writer = await connect()
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+                 f"Connection: close\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, answer = response.partition(b"\r\n\r\n")
+
+    return int(head.split(b" ")[1]), json.loads(answer)
+
+
+async def run_with_service(client, unix_socket: str = None) -> None:
+    """ start a service on a free port or a Unix socket, run the client against it,
+    the client gets a connection function and the service """
+    # declare local variables
+    service = ClearSmilesService(ClearSmilesGenerator(nb_random=200), workers=2,
+                                 max_batch_size=16, max_wait=0.05, cache_size=3)
+    ready_future = asyncio.get_running_loop().create_future()
+    server_task = asyncio.create_task(serve(service, port=0, unix_socket=unix_socket,
+                                            ready_callback=ready_future.set_result))
+    server = await ready_future
+    if unix_socket:
+        async def connect():
+            return await asyncio.open_unix_connection(unix_socket)
+    else:
+        async def connect():
+            return await asyncio.open_connection("127.0.0.1",
+                                                 server.sockets[0].getsockname()[1])
+    try:
+        await client(connect, service)
+    finally:
+        server_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await server_task
+
+
+def test_coalescing_and_cache():
+    """
+    test that identical molecules in flight are computed once, then served from the cache
+    """
+    async def client(connect, service):
+        # the same molecule written three ways, requested concurrently
+        answers_list = await asyncio.gather(*[
+            send_request(connect, "POST", "/clearsmiles", {"smiles": [smiles]})
+            for smiles in ["CCO", "OCC", "C(C)O"] * 3])
+        assert all(status == 200 for status, _ in answers_list)
+        results_list = [answer_dict["results"][0] for _, answer_dict in answers_list]
+        assert {result["canonical_smiles"] for result in results_list} == {"CCO"}
+        assert [result["source"] for result in results_list].count("computed") == 1
+        assert set(results_list[0]["clearsmiles"]) == {"CCO", "OCC"}
+
+        # a repeat is a cache hit, an invalid SMILES gets an error
+        _, answer_dict = await send_request(connect, "POST", "/clearsmiles",
+                                            {"smiles": ["OCC", "C1CC"]})
+        assert answer_dict["results"][0]["source"] == "cache"
+        assert answer_dict["results"][1]["error"] == "invalid SMILES"
+
+        status, metrics_dict = await send_request(connect, "GET", "/metrics")
+        assert status == 200
+        assert metrics_dict["nb_computed"] == 1
+        assert metrics_dict["nb_coalesced"] + metrics_dict["nb_cache_hits"] == 9
+        assert metrics_dict["nb_invalid"] == 1
+        assert metrics_dict["latency"]["count"] == 10
+        assert metrics_dict["queue_depth"] == 0
+
+    asyncio.run(run_with_service(client))
+
+
+def test_micro_batches(tmp_path):
+    """
+    test that concurrent molecules are computed in batches, and that the cache is bounded
+    """
+    async def client(connect, service):
+        smiles_list = ["CC(=O)O", "c1ccccc1O", "C1CCCCC1", "CCN(CC)CC", "CCCl", "OCCO"]
+        status, answer_dict = await send_request(connect, "POST", "/clearsmiles",
+                                                 {"smiles": smiles_list})
+        assert status == 200
+        assert [result["smiles"] for result in answer_dict["results"]] == smiles_list
+        _, metrics_dict = await send_request(connect, "GET", "/metrics")
+        assert metrics_dict["nb_batches"] < len(smiles_list)
+        assert metrics_dict["batch_size"]["sum"] == len(smiles_list)
+        assert metrics_dict["nb_cached"] == 3
+
+        # wrong requests
+        assert (await send_request(connect, "GET", "/clearsmiles"))[0] == 405
+        assert (await send_request(connect, "POST", "/other", {}))[0] == 404
+        assert (await send_request(connect, "POST", "/clearsmiles", {"mol": []}))[0] == 400
+        for smiles_list in [5, None, {"CCO": 1}, ["CCO", 5]]:
+            status, answer_dict = await send_request(connect, "POST", "/clearsmiles",
+                                                     {"smiles": smiles_list})
+            assert status == 400
+            assert "list of strings" in answer_dict["error"]
+
+    asyncio.run(run_with_service(client, unix_socket=str(tmp_path / "service.sock")))
+
+
+def test_worker_crash():
+    """
+    test that a crash of the pool is answered with an error, and that the pool is replaced
+    """
+    async def client(connect, service):
+        assert (await send_request(connect, "POST", "/clearsmiles", {"smiles": ["CCO"]}))[0] \
+            == 200
+        for process in list(service.executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+        await asyncio.sleep(0.5)
+
+        status, answer_dict = await send_request(connect, "POST", "/clearsmiles",
+                                                 {"smiles": ["CCCl"]})
+        assert status == 500
+        assert "BrokenProcessPool" in answer_dict["error"]
+
+        # the next requests are computed by the new pool, the cache survived
+        status, answer_dict = await send_request(connect, "POST", "/clearsmiles",
+                                                 {"smiles": ["CCCl", "CCO"]})
+        assert status == 200
+        assert [result["source"] for result in answer_dict["results"]] == ["computed", "cache"]
+        _, metrics_dict = await send_request(connect, "GET", "/metrics")
+        assert metrics_dict["nb_pool_restarts"] == 1
+        assert metrics_dict["nb_failed_batches"] == 1
+        assert metrics_dict["nb_in_flight"] == 0
+
+    asyncio.run(run_with_service(client))
+
+
+class FailingGenerator(ClearSmilesGenerator):
+    """ a generator whose search fails on the chlorinated molecules """
+    __slots__ = ()
+
+    def generate(self, smiles: str):
+        if "Cl" in smiles:
+            raise RuntimeError("search failed")
+        return super().generate(smiles)
+
+
+def test_failed_molecule():
+    """
+    test that a molecule whose search fails only fails itself, and that its error is cached
+    """
+    async def run():
+        service = ClearSmilesService(FailingGenerator(nb_random=200), workers=2,
+                                     max_batch_size=16, max_wait=0.05)
+        await service.start()
+        # the workers share the test process, where the failing generator is defined
+        service.executor.shutdown()
+        service.executor = ThreadPoolExecutor(2, initializer=init_stream_worker,
+                                              initargs=(service.generator,))
+        try:
+            answers_list = await service.answer(["CCO", "CCCl", "OCCO"])
+            assert [answer_dict["source"] for answer_dict in answers_list] == ["computed"] * 3
+            assert answers_list[1]["error"] == "RuntimeError: search failed"
+            assert "clearsmiles" in answers_list[0] and "clearsmiles" in answers_list[2]
+
+            # the error is served from the cache instead of computed again
+            assert (await service.answer(["ClCC"]))[0] == \
+                {"smiles": "ClCC", "canonical_smiles": "CCCl",
+                 "error": "RuntimeError: search failed", "source": "cache"}
+            metrics_dict = service.get_metrics()
+            assert metrics_dict["nb_failed_molecules"] == 1
+            assert metrics_dict["nb_failed_batches"] == 0
+            assert metrics_dict["nb_computed"] == 3
+        finally:
+            await service.close()
+
+    asyncio.run(run())
+
+
+def test_local_only():
+    """
+    test that the service refuses to listen on a public address
+    """
+    service = ClearSmilesService(ClearSmilesGenerator(nb_random=10), workers=1)
+    with pytest.raises(ValueError):
+        asyncio.run(serve(service, host="8.8.8.8", port=0))
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,132 @@
+""" Test the streaming aggregation of the subsets into a single database
+"""
+from pathlib import Path
+import sys
+import subprocess
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.concatenate2lib import unify_subset_schemas, main
+
+
+@pytest.fixture(name="subsets_pattern")
+def fixture_subsets_pattern(tmp_path):
+    """ subsets whose inferred types drift """
+    pq.write_table(pa.table({"SMILES": ["CCO", "CCN"],
+                             "max_digit": pa.array([0, 1], type=pa.int64()),
+                             "lowest_mem_score": pa.array([0, 1], type=pa.int64()),
+                             "SPLIT": pa.array([None, None], type=pa.null())}),
+                   tmp_path / "subset_0.parquet")
+    pq.write_table(pa.table({"SMILES": ["CCC", "C1CC1", "CCCl"],
+                             "max_digit": pa.array([0, 1, 0], type=pa.int64()),
+                             "lowest_mem_score": [0.5, 1.5, 0.0],
+                             "SPLIT": ["train", "test", "train"]}),
+                   tmp_path / "subset_1.parquet")
+    pq.write_table(pa.table({"SMILES": ["CBr"],
+                             "max_digit": pa.array([0], type=pa.int32()),
+                             "lowest_mem_score": [0.0],
+                             "SPLIT": pa.array([1], type=pa.int64())}),
+                   tmp_path / "subset_2.parquet")
+
+    return str(tmp_path / "subset_*.parquet")
+
+
+def test_unify_subset_schemas(subsets_pattern):
+    """ test the resolution of type conflicts """
+    schema = unify_subset_schemas(sorted(Path(subsets_pattern).parent.glob("subset_*")))
+    assert schema == pa.schema([("SMILES", pa.string()), ("max_digit", pa.int64()),
+                                ("lowest_mem_score", pa.float64()), ("SPLIT", pa.string())])
+
+
+def test_single_file(subsets_pattern, tmp_path):
+    """ test that every row is written in row groups of the requested size """
+    output_filepath = tmp_path / "library.parquet"
+    main(subsets_pattern, str(output_filepath), use_multiprocessing=False, row_group_size=2)
+
+    parquet_file = pq.ParquetFile(output_filepath)
+    assert parquet_file.metadata.num_rows == 6
+    assert parquet_file.metadata.num_row_groups == 3
+    table = parquet_file.read()
+    assert sorted(table.column("SMILES").to_pylist()) == \
+        sorted(["CCO", "CCN", "CCC", "C1CC1", "CCCl", "CBr"])
+    assert sorted(table.column("SPLIT").drop_null().to_pylist()) == ["1", "test", "train", "train"]
+
+
+def test_partitioned_index(subsets_pattern, tmp_path):
+    """ test that the index of a partitioned database is refused """
+    with pytest.raises(ValueError, match="--nb_partitions"):
+        main(subsets_pattern, str(tmp_path / "library"), use_multiprocessing=False,
+             nb_partitions=2, build_index=True)
+    assert not (tmp_path / "library").exists()
+
+
+def test_import_cost():
+    """ test that the concatenation does not import rdkit without index """
+    code = "import sys\nimport features.concatenate2lib\nprint('rdkit' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=parent_path, check=True,
+                            capture_output=True, text=True).stdout
+    assert output.strip() == "False"
+
+
+def test_partitioned_dataset(subsets_pattern, tmp_path):
+    """ test that the rows are partitioned by hash of the SMILES """
+    output_dir = tmp_path / "library"
+    main(subsets_pattern, str(output_dir), use_multiprocessing=True, nb_partitions=3)
+
+    table = ds.dataset(output_dir, format="parquet", partitioning="hive").to_table()
+    assert table.num_rows == 6
+    assert {path.name for path in output_dir.iterdir()} <= \
+        {"partition=0", "partition=1", "partition=2"}
+
+    # a rerun gives every SMILES the same partition
+    main(subsets_pattern, str(output_dir), use_multiprocessing=False, nb_partitions=3)
+    rerun_table = ds.dataset(output_dir, format="parquet", partitioning="hive").to_table()
+    assert sorted(zip(rerun_table.column("SMILES").to_pylist(),
+                      rerun_table.column("partition").to_pylist())) == \
+        sorted(zip(table.column("SMILES").to_pylist(), table.column("partition").to_pylist()))
+
+
+def test_legacy_clearsmiles_set(tmp_path):
+    """ test that "_" joined ClearSMILES of older subsets are read as lists """
+    pq.write_table(pa.table({"SMILES": ["CCO", "C"],
+                             "ClearSMILES_set": ["CCO_OCC", ""]}),
+                   tmp_path / "subset_0.parquet")
+    pq.write_table(pa.table({"SMILES": ["CCN"],
+                             "ClearSMILES_set": pa.array([["CCN", "NCC"]],
+                                                         type=pa.list_(pa.string())),
+                             "ClearSMILES_mem_maps": pa.array(
+                                 [[[0, 0, 0], [0, 0, 0]]],
+                                 type=pa.list_(pa.list_(pa.int8())))}),
+                   tmp_path / "subset_1.parquet")
+    output_filepath = tmp_path / "library.parquet"
+    main(str(tmp_path / "subset_*.parquet"), str(output_filepath), use_multiprocessing=False)
+
+    table = pq.read_table(output_filepath)
+    assert table.schema.field("ClearSMILES_set").type == pa.list_(pa.string())
+    assert table.column("ClearSMILES_set").to_pylist() == [["CCO", "OCC"], [], ["CCN", "NCC"]]
+    assert table.column("ClearSMILES_mem_maps").to_pylist() == \
+        [None, None, [[0, 0, 0], [0, 0, 0]]]
+
+
+def test_unresolved_type_conflict(tmp_path):
+    """ test that a nested column whose type drifts is reported instead of failing the cast """
+    pq.write_table(pa.table({"SMILES": ["CCO"],
+                             "ClearSMILES_mem_maps": pa.array(
+                                 [[[0, 0, 0], [0, 0, 0]]],
+                                 type=pa.list_(pa.list_(pa.int8())))}),
+                   tmp_path / "subset_0.parquet")
+    pq.write_table(pa.table({"SMILES": ["CCN"], "ClearSMILES_mem_maps": ["000"]}),
+                   tmp_path / "subset_1.parquet")
+    with pytest.raises(ValueError, match="ClearSMILES_mem_maps"):
+        main(str(tmp_path / "subset_*.parquet"), str(tmp_path / "library.parquet"),
+             use_multiprocessing=False)
+    assert not (tmp_path / "library.parquet").exists()
+
+
+if __name__ == "__main__":
+    pytest.main()
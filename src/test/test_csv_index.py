@@ -0,0 +1,76 @@
+""" Test the byte offset index of csv databases against the full scan of wrapper_csv_reader
+"""
+from pathlib import Path
+import sys
+import os
+import pytest
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.csv_index import build_csv_index, load_csv_index, get_index_path
+from features.generate_clearsmiles import wrapper_csv_reader, compute_chunk_idx
+
+
+# declare global variables
+NB_SMILES = 103
+
+
+@pytest.fixture(name="csv_path")
+def fixture_csv_path(tmp_path):
+    """ small csv database, with a quoted field spanning two lines """
+    csv_path = tmp_path / "database.csv"
+    rows_list = ["SMILES,SPLIT"]
+    rows_list += [f"{'C' * (i + 1)}O,train" for i in range(NB_SMILES)]
+    rows_list[42] = 'CCO,"multi\nline"'
+    csv_path.write_text("\n".join(rows_list) + "\n", encoding="utf-8")
+
+    return str(csv_path)
+
+
+def test_build_csv_index(csv_path):
+    """ test that the recorded offsets point to the start of the rows """
+    index_dict = build_csv_index(csv_path, step=10)
+    assert index_dict["nb_rows"] == NB_SMILES
+    assert len(index_dict["offsets"]) == 11
+    assert load_csv_index(csv_path) == index_dict
+    with open(csv_path, "rb") as csv_file:
+        csv_file.seek(index_dict["offsets"][5])
+        assert csv_file.readline() == b"C" * 51 + b"O,train\n"
+
+
+def test_wrapper_csv_reader_with_index(csv_path):
+    """ test that the indexed reader read the same rows than the full scan """
+    # declare local variables
+    job_array_size = 7
+    scanned_list = [wrapper_csv_reader(csv_path, **compute_chunk_idx(NB_SMILES, task_id,
+                                                                     job_array_size))
+                    for task_id in range(job_array_size)]
+    build_csv_index(csv_path, step=4)
+
+    for task_id in range(job_array_size):
+        chunk_dict = compute_chunk_idx(NB_SMILES, task_id, job_array_size)
+        assert wrapper_csv_reader(csv_path, **chunk_dict) == scanned_list[task_id]
+    assert sum(len(data_list) for data_list in scanned_list) == NB_SMILES
+
+
+def test_stale_csv_index(csv_path):
+    """ test that an index is ignored once the csv file changed """
+    build_csv_index(csv_path, step=4)
+    with open(csv_path, "a", encoding="utf-8") as csv_file:
+        csv_file.write("CCN,test\n")
+    assert load_csv_index(csv_path) is None
+
+    # a corrupted index is ignored by the reader
+    with open(get_index_path(csv_path), "w", encoding="utf-8") as index_file:
+        index_file.write("not json")
+    assert load_csv_index(csv_path) is None
+    data_list = wrapper_csv_reader(csv_path, first_idx=NB_SMILES, last_idx=NB_SMILES + 1,
+                                   extra_idx=None)
+    assert data_list == [{"SMILES": "CCN", "SPLIT": "test"}]
+    os.remove(get_index_path(csv_path))
+    assert load_csv_index(csv_path) is None
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,166 @@
+""" Test the streaming download against a local http server
+"""
+from pathlib import Path
+import sys
+import gzip
+import base64
+import hashlib
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from data.download_moses import main, retry_stream_range
+
+# declare global variables
+CSV_DATA = b"SMILES,SPLIT\n" + b"".join(f"C{'C' * (idx % 50)}O,train\n".encode("ascii")
+                                      for idx in range(20_000))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """ serve CSV_DATA with Range requests, the first GET can be cut after some bytes """
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """ answer the size of the file """
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CSV_DATA)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ send the whole file or a range of it """
+        # declare local variables
+        first_byte, last_byte = 0, len(CSV_DATA) - 1
+        range_header = self.headers.get("Range")
+        self.server.range_headers_list.append(range_header)
+
+        if range_header:
+            first_string, last_string = range_header.removeprefix("bytes=").split("-")
+            first_byte = int(first_string)
+            last_byte = int(last_string) if last_string else last_byte
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first_byte}-{last_byte}/{len(CSV_DATA)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(last_byte - first_byte + 1))
+        self.end_headers()
+
+        # simulate a dropped connection
+        body = CSV_DATA[first_byte:last_byte + 1]
+        if self.server.nb_cut_bytes:
+            body = body[:self.server.nb_cut_bytes]
+            self.server.nb_cut_bytes = 0
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """ keep the test output quiet """
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """ a local http server in a thread """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.range_headers_list = []
+    server.nb_cut_bytes = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_url(server) -> str:
+    """ url of the file served by the local server """
+    return f"http://127.0.0.1:{server.server_address[1]}/dataset_v1.csv"
+
+
+def test_single_connection(server, tmp_path):
+    """ test the download and the hexadecimal checksum """
+    output_filepath = tmp_path / "moses.csv"
+    md5_digest = main(get_url(server), str(output_filepath), None,
+                      expected_md5=hashlib.md5(CSV_DATA).hexdigest())
+    assert md5_digest == hashlib.md5(CSV_DATA).hexdigest()
+    assert output_filepath.read_bytes() == CSV_DATA
+    assert [path.name for path in tmp_path.iterdir()] == ["moses.csv"]
+
+
+def test_resume(server, tmp_path):
+    """ test that a partial file and a dropped connection are resumed with Range requests """
+    output_filepath = tmp_path / "moses.csv"
+    (tmp_path / "moses.csv.part").write_bytes(CSV_DATA[:1000])
+    server.nb_cut_bytes = 5000
+    main(get_url(server), str(output_filepath), None, max_retries=2,
+         expected_md5=hashlib.md5(CSV_DATA).hexdigest())
+
+    assert output_filepath.read_bytes() == CSV_DATA
+    assert server.range_headers_list == ["bytes=1000-", "bytes=6000-"]
+
+
+def test_streaming_checksum(server, tmp_path):
+    """ test that the checksum of a single connection is computed while streaming,
+    the bytes of a previous run are hashed once """
+    # declare local variables
+    part_filepath = tmp_path / "moses.csv.part"
+    part_filepath.write_bytes(CSV_DATA[:1000])
+    hash_dict = {"md5_hash": hashlib.md5(), "nb_hashed": 0}
+    server.nb_cut_bytes = 5000
+
+    retry_stream_range(get_url(server), str(part_filepath), 0, None, 60.0, 2,
+                       logging.getLogger(__name__), hash_dict)
+    assert hash_dict["nb_hashed"] == len(CSV_DATA)
+    assert hash_dict["md5_hash"].hexdigest() == hashlib.md5(CSV_DATA).hexdigest()
+
+    # the part file is not read again once complete
+    part_filepath.write_bytes(bytes(len(CSV_DATA)))
+    retry_stream_range(get_url(server), str(part_filepath), 0, None, 60.0, 2,
+                       logging.getLogger(__name__), hash_dict)
+    assert hash_dict["md5_hash"].hexdigest() == hashlib.md5(CSV_DATA).hexdigest()
+
+
+def test_parallel_ranges_compressed(server, tmp_path):
+    """ test parallel ranges with a dropped connection, gzip output and base 64 checksum """
+    output_filepath = tmp_path / "moses.csv.gz"
+    server.nb_cut_bytes = 100
+    main(get_url(server), str(output_filepath), None,
+         expected_md5=base64.b64encode(hashlib.md5(CSV_DATA).digest()).decode("ascii"),
+         nb_connections=4, compress=True)
+
+    with gzip.open(output_filepath, "rb") as gzip_file:
+        assert gzip_file.read() == CSV_DATA
+    assert len(server.range_headers_list) == 5
+    assert [path.name for path in tmp_path.iterdir()] == ["moses.csv.gz"]
+
+
+def test_parallel_resume_changed_ranges(server, tmp_path):
+    """ test that the parts of a run with another number of connections are not resumed """
+    # declare local variables
+    output_filepath = tmp_path / "moses.csv"
+    half_size = len(CSV_DATA) // 2
+
+    # a previous run with 2 connections left the start of its second range
+    (tmp_path / "moses.csv.part0").write_bytes(CSV_DATA[:100])
+    (tmp_path / "moses.csv.part1").write_bytes(CSV_DATA[half_size:half_size + 100])
+    (tmp_path / "moses.csv.parts.json").write_text(
+        f'{{"moses.csv.part0": [0, {half_size - 1}], '
+        f'"moses.csv.part1": [{half_size}, {len(CSV_DATA) - 1}]}}', encoding="utf-8")
+
+    # the checksum is not verified, the output must still be the file
+    main(get_url(server), str(output_filepath), None, expected_md5="", nb_connections=4)
+    assert output_filepath.read_bytes() == CSV_DATA
+    assert f"bytes=100-{len(CSV_DATA) // 4 - 1}" not in server.range_headers_list
+    assert [path.name for path in tmp_path.iterdir()] == ["moses.csv"]
+
+
+def test_checksum_mismatch(server, tmp_path):
+    """ test that a wrong file is not kept """
+    with pytest.raises(ValueError):
+        main(get_url(server), str(tmp_path / "moses.csv"), None, expected_md5="0" * 32)
+    assert not list(tmp_path.iterdir())
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,144 @@
+""" Test the exhaustive enumeration of ClearSMILES against the random search
+"""
+from pathlib import Path
+import sys
+import re
+import numpy as np
+import pytest
+from rdkit import Chem
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.clearsmiles_search import get_clearsmiles
+from features.exhaustive_search import is_exhaustive_search_possible, exhaustive_search
+from features.search_bounds import compute_lower_bounds
+
+
+# declare global variables
+SMILES_TOKENS_REGEX = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|" + \
+    r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+SMILES_LIST = [
+    # aspirin
+    "CC(=O)OC1=CC=CC=C1C(=O)O",
+    # cubane
+    "C12C3C4C1C5C2C3C45",
+    # naphthalene derivative
+    "OC1=CC=C2C=CC=CC2=C1",
+    # aromatic rings whose symmetry is broken by the kekule structure
+    "Cc1ccc(O)cc1N",
+    "c1ccc2[nH]ccc2c1",
+    # zwitterion with bracket atoms
+    "C[N+](C)(C)CC(=O)[O-]",
+]
+
+
+def test_is_exhaustive_search_possible():
+    """test that stereochemistry, several fragments and big molecules are rejected
+    """
+    assert is_exhaustive_search_possible(Chem.MolFromSmiles("CC(=O)O"), 30)
+    assert not is_exhaustive_search_possible(Chem.MolFromSmiles("C/C=C/C"), 30)
+    assert not is_exhaustive_search_possible(Chem.MolFromSmiles("C[C@H](N)O"), 30)
+    assert not is_exhaustive_search_possible(Chem.MolFromSmiles("[Na+].[Cl-]"), 30)
+    assert not is_exhaustive_search_possible(Chem.MolFromSmiles("CCCCCCCCCC(C)C"), 10)
+
+
+def test_exhaustive_search():
+    """test that the exhaustive ClearSMILES are valid and the same
+    as the one found by random search, with the kekule structure of the rdkit writer
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+
+    for smiles in SMILES_LIST:
+        canonical_smiles = Chem.MolToSmiles(Chem.MolFromSmiles(smiles))
+        exhaustive_dict = get_clearsmiles({"SMILES": smiles}, 20_000, smiles_regex,
+                                          search="exhaustive")
+        random_dict = get_clearsmiles({"SMILES": smiles}, 50_000, smiles_regex,
+                                      patience=50_000)
+
+        assert exhaustive_dict["search_path"] == "exhaustive"
+        assert exhaustive_dict["nb_drawn"] == 0
+        assert (exhaustive_dict["max_digit"], exhaustive_dict["lowest_mem_score"]) <= \
+            (random_dict["max_digit"], random_dict["lowest_mem_score"])
+        for clearsmiles in exhaustive_dict["ClearSMILES_set"]:
+            assert Chem.MolToSmiles(Chem.MolFromSmiles(clearsmiles)) == canonical_smiles
+
+        # the enumeration find the solutions of the random search, and only them
+        assert (exhaustive_dict["max_digit"], exhaustive_dict["lowest_mem_score"]) == \
+            (random_dict["max_digit"], random_dict["lowest_mem_score"])
+        assert exhaustive_dict["ClearSMILES_set"] == random_dict["ClearSMILES_set"]
+        assert exhaustive_dict["nb_equivalent_solution"] == \
+            random_dict["nb_equivalent_solution"]
+
+
+def test_exhaustive_search_truncated():
+    """test that capping the ring closure orders is reported
+    """
+    # declare local variables
+    mol = Chem.MolFromSmiles("C12C3C4C1C5C2C3C45")
+    results_dict = {"max_digit": 9, "lowest_mem_score": np.inf}
+
+    for max_closure_orders, is_truncated in [(1, True), (1_000, False)]:
+        smiles_list = []
+        assert exhaustive_search(mol, compute_lower_bounds(mol), results_dict,
+                                 smiles_list.extend, time_limit=60.0,
+                                 max_closure_orders=max_closure_orders)[2] == is_truncated
+        assert smiles_list
+
+
+def test_exhaustive_search_beats_random():
+    """test that the enumeration writes every distinct SMILES once, while the random search
+    drawing as many SMILES misses some of them and never finds better ClearSMILES
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    params_dict = {"SMILES": "CC(=O)OC1=CC=CC=C1C(=O)O"}
+
+    # aspirin, the random search gets the number of SMILES written by the enumeration
+    exhaustive_dict = get_clearsmiles(params_dict, 20_000, smiles_regex, search="exhaustive")
+    random_dict = get_clearsmiles(params_dict, exhaustive_dict["nb_enumerated_smiles"],
+                                  smiles_regex)
+    assert random_dict["nb_drawn"] == exhaustive_dict["nb_enumerated_smiles"]
+    assert random_dict["nb_unique_random_smiles"] < exhaustive_dict["nb_enumerated_smiles"]
+    assert (exhaustive_dict["max_digit"], exhaustive_dict["lowest_mem_score"]) <= \
+        (random_dict["max_digit"], random_dict["lowest_mem_score"])
+
+
+def test_exhaustive_search_options():
+    """test that the cap of the ring closure orders is passed to the enumeration,
+    and that the random search falling back after the time limit skips the enumerated SMILES
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    params_dict = {"SMILES": "CN1C(=O)CN=C(c2ccccc2)c2cc(Cl)ccc21"}
+
+    # cubane, a single ring closure order per traversal
+    assert get_clearsmiles({"SMILES": "C12C3C4C1C5C2C3C45"}, 1_000, smiles_regex,
+                           search="exhaustive",
+                           max_closure_orders=1)["search_path"] == "exhaustive_truncated"
+
+    # diazepam, every SMILES is counted once by both searches
+    nb_smiles = get_clearsmiles(params_dict, 1_000, smiles_regex,
+                                search="exhaustive")["nb_enumerated_smiles"]
+    fallback_dict = get_clearsmiles(params_dict, 50_000, smiles_regex, patience=50_000,
+                                    search="exhaustive", exhaustive_time_limit=0.0)
+    assert fallback_dict["search_path"] == "random"
+    assert fallback_dict["nb_enumerated_smiles"] > 0
+    assert fallback_dict["nb_unique_random_smiles"] + fallback_dict["nb_enumerated_smiles"] \
+        <= nb_smiles
+
+
+def test_exhaustive_search_fallback():
+    """test that the random search is used when the enumeration is not possible
+    """
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    results_dict = get_clearsmiles({"SMILES": "C/C=C/1CCCC/1=C/C"}, 1_000, smiles_regex,
+                                   search="exhaustive")
+    assert results_dict["search_path"] == "random"
+    assert results_dict["nb_enumerated_smiles"] == 0
+    assert results_dict["nb_drawn"] > 0
+
+
+if __name__ == "__main__":
+    pytest.main()
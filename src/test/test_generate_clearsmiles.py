@@ -3,14 +3,24 @@
 from pathlib import Path
 import sys
 import re
+import json
 import pytest
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # make the relative import properly
 parent_path = Path(__file__).resolve().parents[1]
 print(parent_path)
 sys.path.insert(0, f"{parent_path}/")
-from features.generate_clearsmiles import find_biggest_digits, get_semantic_mem_map
+from features.generate_clearsmiles import get_results_schema, main, sort_by_predicted_cost, \
+    write_results, compute_chunk_idx
+from features.clearsmiles_search import find_biggest_digits, get_semantic_mem_map, \
+    get_clearsmiles, SMILES_TOKENS_REGEX
+from features.generation_worker import serialize_batch, deserialize_batch
+from features.task_runners import run_tasks
+from features.checkpoint import get_checkpoint_dir, write_checkpoint_part
+from features.run_metrics import get_metrics_path
 
 
 def test_a_find_biggest_digits():
@@ -77,5 +87,309 @@ def test_semantic_mem_map():
         test_array, excepted_array), "failed to generate semantic memmap for aspirin smiles"
 
 
+def test_get_clearsmiles_early_stopping():
+    """
+    test that the batched random search stops before the hard cap 
+    and finds the same scores than a single batch search
+    """
+    # declare local variables
+    smiles_tokens_regex = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|"
+    smiles_tokens_regex += r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+    smiles_regex = re.compile(smiles_tokens_regex)
+    params_dict = {"SMILES": "CC(=O)OC1=CC=CC=C1C(=O)O"}
+
+    # aspirin
+    single_batch_dict = get_clearsmiles(params_dict, 20_000, smiles_regex)
+    batched_dict = get_clearsmiles(params_dict, 20_000, smiles_regex,
+                                   batch_size=1_000, patience=3)
+    assert single_batch_dict["nb_drawn"] == 20_000
+    assert batched_dict["nb_drawn"] < 20_000
+    assert batched_dict["nb_drawn"] % 1_000 == 0
+    assert batched_dict["max_digit"] == single_batch_dict["max_digit"]
+    assert batched_dict["lowest_mem_score"] == single_batch_dict["lowest_mem_score"]
+    assert batched_dict["nb_equivalent_solution"] == \
+        len(batched_dict["ClearSMILES_set"])
+
+
+def test_get_clearsmiles_linear_molecule():
+    """
+    test that acyclic unbranched molecules are written from both ends without random search
+    """
+    # declare local variables
+    smiles_tokens_regex = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|"
+    smiles_tokens_regex += r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+    smiles_regex = re.compile(smiles_tokens_regex)
+
+    # ethanol
+    results_dict = get_clearsmiles({"SMILES": "CCO"}, 1_000, smiles_regex)
+    assert results_dict["nb_drawn"] == 0
+    assert results_dict["lower_bound_reached"]
+    assert results_dict["max_digit"] == 0
+    assert results_dict["lowest_mem_score"] == 0
+    assert set(results_dict["ClearSMILES_set"]) == {"CCO", "OCC"}
+
+
+def test_get_clearsmiles_stratified_sampling():
+    """
+    test that the stratified sampling finds the same ClearSMILES than the uniform sampling
+    with fewer draws
+    """
+    # declare local variables
+    smiles_tokens_regex = r"(\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|"
+    smiles_tokens_regex += r"-|\+|\\\\|\/|_|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9])"
+    smiles_regex = re.compile(smiles_tokens_regex)
+    params_dict = {"SMILES": "Cc1ccc(-c2ccccc2)cc1"}
+
+    # 4-methylbiphenyl, every root atom is exhausted well before the hard cap
+    uniform_dict = get_clearsmiles(params_dict, 20_000, smiles_regex)
+    stratified_dict = get_clearsmiles(params_dict, 20_000, smiles_regex,
+                                      batch_size=1_000, patience=20, sampling="stratified")
+    assert stratified_dict["nb_drawn"] < 20_000
+    assert stratified_dict["nb_unique_random_smiles"] == uniform_dict["nb_unique_random_smiles"]
+    assert stratified_dict["sampling_efficiency"] > uniform_dict["sampling_efficiency"]
+    assert set(stratified_dict["ClearSMILES_set"]) == \
+        set(uniform_dict["ClearSMILES_set"])
+
+
+def test_get_clearsmiles_stratified_drug():
+    """
+    test that on a drug-sized molecule the stratified sampling retires its exhausted
+    symmetry classes within a single batch, and reaches the same scores with fewer draws
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    params_dict = {"SMILES": "CN1C(=O)CN=C(c2ccccc2)c2cc(Cl)ccc21"}
+
+    # diazepam, a single batch of the whole hard cap
+    uniform_dict = get_clearsmiles(params_dict, 50_000, smiles_regex)
+    stratified_dict = get_clearsmiles(params_dict, 50_000, smiles_regex, sampling="stratified")
+    assert stratified_dict["nb_drawn"] < uniform_dict["nb_drawn"] / 2
+    assert stratified_dict["max_digit"] == uniform_dict["max_digit"]
+    assert stratified_dict["lowest_mem_score"] == uniform_dict["lowest_mem_score"]
+
+
+def test_get_clearsmiles_mem_maps():
+    """
+    test that the ClearSMILES are stored as a list with their semantic memory maps
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+
+    # aspirin
+    results_dict = get_clearsmiles({"SMILES": "CC(=O)OC1=CC=CC=C1C(=O)O"}, 2_000, smiles_regex,
+                                   store_mem_maps=True)
+    assert results_dict["ClearSMILES_set"] == sorted(set(results_dict["ClearSMILES_set"]))
+    assert len(results_dict["ClearSMILES_mem_maps"]) == results_dict["nb_equivalent_solution"]
+    for clearsmiles, mem_map in zip(results_dict["ClearSMILES_set"],
+                                    results_dict["ClearSMILES_mem_maps"]):
+        assert mem_map == get_semantic_mem_map(clearsmiles, smiles_regex).tolist()
+        assert np.mean(mem_map) == results_dict["lowest_mem_score"]
+
+    # memory maps are stored as int8 lists
+    table = pa.Table.from_pylist([results_dict], schema=get_results_schema(["SMILES"]))
+    assert table.column("ClearSMILES_mem_maps").type == pa.list_(pa.list_(pa.int8()))
+    assert table.column("ClearSMILES_set").to_pylist()[0] == results_dict["ClearSMILES_set"]
+    assert get_clearsmiles({"SMILES": "CCO"}, 10, smiles_regex)["ClearSMILES_mem_maps"] is None
+
+
+def test_main_streaming_output(tmp_path):
+    """
+    test that the results are written by row groups with the explicit schema
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    output_filepath = tmp_path / "results.parquet"
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC"]
+    input_csv.write_text("SMILES,SPLIT\n" + "".join(f"{smiles},train\n"
+                                                     for smiles in smiles_list),
+                         encoding="utf-8")
+
+    # write every molecule by row group of 2
+    main(output_filepath=str(output_filepath),
+         chunk_indices={"first_idx": 0, "last_idx": len(smiles_list), "extra_idx": None},
+         config_dict={"input_csv": str(input_csv), "nb_random": 200, "row_group_size": 2})
+    parquet_file = pq.ParquetFile(output_filepath)
+    assert parquet_file.schema_arrow == get_results_schema(["SMILES", "SPLIT"])
+    assert parquet_file.metadata.num_row_groups == 3
+    table = parquet_file.read()
+    assert sorted(table.column("SMILES").to_pylist()) == sorted(smiles_list)
+    assert table.column("row_idx").to_pylist() == list(range(len(smiles_list)))
+    assert set(table.column("SPLIT").to_pylist()) == {"train"}
+
+
+def test_main_resume_from_checkpoint(tmp_path):
+    """
+    test that a relaunched task skips the rows found in the checkpoint
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    output_filepath = tmp_path / "results.parquet"
+    checkpoint_dir = get_checkpoint_dir(str(output_filepath))
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC"]
+    input_csv.write_text("SMILES,SPLIT\n" + "".join(f"{smiles},train\n"
+                                                     for smiles in smiles_list),
+                         encoding="utf-8")
+    schema = get_results_schema(["SMILES", "SPLIT"])
+
+    # a killed task left one complete part, with a recognizable nb_random, and one partial part
+    finished_list = [get_clearsmiles({"SMILES": smiles_list[i], "SPLIT": "train", "row_idx": i},
+                                     1, re.compile("."))
+                     for i in (1, 3)]
+    write_checkpoint_part(pa.Table.from_pylist(finished_list, schema=schema), checkpoint_dir)
+    with open(f"{checkpoint_dir}/part_00001.parquet.tmp", "wb") as part_file:
+        part_file.write(b"PAR1")
+
+    # relaunch the task
+    main(output_filepath=str(output_filepath),
+         chunk_indices={"first_idx": 0, "last_idx": len(smiles_list), "extra_idx": None},
+         config_dict={"input_csv": str(input_csv), "nb_random": 200})
+    table = pq.read_table(output_filepath)
+    assert table.schema == schema
+    assert sorted(table.column("row_idx").to_pylist()) == list(range(len(smiles_list)))
+    nb_random_dict = dict(zip(table.column("row_idx").to_pylist(),
+                              table.column("nb_random").to_pylist()))
+    assert nb_random_dict == {0: 200, 1: 1, 2: 200, 3: 1, 4: 200}
+    assert not Path(checkpoint_dir).exists()
+
+
+def test_sort_by_predicted_cost():
+    """
+    test that the largest molecules are dispatched first
+    """
+    data_list = [{"SMILES": smiles} for smiles in ["CCO", "C1CCCCC1", "CC(=O)OC1=CC=CC=C1C(=O)O"]]
+    assert [params_dict["SMILES"] for params_dict in sort_by_predicted_cost(data_list)] == \
+        ["CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCO"]
+
+    # a cost model where branches are expensive
+    assert sort_by_predicted_cost(data_list, [0.0, 0.0, 0.0, 1.0])[0]["SMILES"] == \
+        "CC(=O)OC1=CC=CC=C1C(=O)O"
+    assert sort_by_predicted_cost(data_list, [0.0, -1.0, 0.0, 0.0])[0]["SMILES"] == "CCO"
+
+
+def test_main_worker_engine(tmp_path, capsys):
+    """
+    test that the core count is honored, workers are recycled and utilization is reported
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    output_filepath = tmp_path / "results.parquet"
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+
+    # every worker computes a single molecule
+    main(output_filepath=str(output_filepath),
+         chunk_indices={"first_idx": 0, "last_idx": len(smiles_list), "extra_idx": None},
+         config_dict={"input_csv": str(input_csv), "nb_random": 200, "nb_core": 2,
+                      "max_tasks_per_child": 1, "chunksize": 1})
+    report_lines_list = [line for line in capsys.readouterr().out.splitlines()
+                         if line.startswith("worker")]
+    assert len(report_lines_list) == len(smiles_list)
+    assert pq.read_table(output_filepath).num_rows == len(smiles_list)
+
+
+def test_write_results_from_batches(tmp_path):
+    """
+    test that the batches of the workers are written as parts of exactly row_group_size rows
+    """
+    # declare local variables
+    schema = get_results_schema(["SMILES"])
+    checkpoint_dir = tmp_path / "results.parquet.checkpoint"
+    checkpoint_dir.mkdir()
+    batches_list = [deserialize_batch(serialize_batch(pa.RecordBatch.from_pylist(
+        [{"SMILES": "C" * (row_idx + 1), "row_idx": row_idx}
+         for row_idx in range(first_idx, first_idx + 3)], schema=schema)))
+        for first_idx in (0, 3, 6)]
+
+    assert write_results(batches_list, str(checkpoint_dir), schema, row_group_size=4) == 9
+    parts_list = sorted(checkpoint_dir.glob("part_*.parquet"))
+    assert [pq.read_metadata(part_path).num_rows for part_path in parts_list] == [4, 4, 1]
+    assert pq.read_table(parts_list[0]).schema == schema
+    assert pq.read_table(parts_list[1]).column("row_idx").to_pylist() == [4, 5, 6, 7]
+
+
+def test_get_clearsmiles_time_budget():
+    """
+    test that a molecule running out of time returns its best ClearSMILES so far
+    """
+    # declare local variables
+    smiles_regex = re.compile(SMILES_TOKENS_REGEX)
+    params_dict = {"SMILES": "CC(=O)OC1=CC=CC=C1C(=O)O"}
+
+    # aspirin, far too many draws for the budget
+    results_dict = get_clearsmiles(params_dict, 10_000_000, smiles_regex, time_budget=0.2)
+    assert results_dict["timed_out"]
+    assert 0 < results_dict["nb_drawn"] < 10_000_000
+    assert results_dict["nb_drawn"] % 1_000 == 0
+    assert results_dict["nb_equivalent_solution"] == len(results_dict["ClearSMILES_set"]) > 0
+    assert not get_clearsmiles(params_dict, 2_000, smiles_regex, time_budget=60.0)["timed_out"]
+
+
+def test_main_task_time_limit(tmp_path):
+    """
+    test that a task reaching its deadline keeps its checkpoint for the relaunch
+    with the same search parameters
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    output_filepath = tmp_path / "results.parquet"
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+    config_dict = {"input_csv": str(input_csv), "nb_random": 200, "nb_core": 2}
+    chunk_dict = {"first_idx": 0, "last_idx": len(smiles_list), "extra_idx": None}
+
+    # the deadline is already reached when the pool starts
+    main(str(output_filepath), chunk_dict, dict(config_dict, task_time_limit=0.0))
+    assert not output_filepath.exists()
+    with open(get_metrics_path(str(output_filepath)), encoding="utf-8") as json_file:
+        assert json.load(json_file)["task"]["deadline_reached"]
+
+    # the checkpoint of another search is refused
+    with pytest.raises(ValueError, match="parameters"):
+        main(str(output_filepath), chunk_dict, dict(config_dict, nb_random=100))
+
+    # the relaunch completes the task
+    main(str(output_filepath), chunk_dict, dict(config_dict, task_time_limit=600.0))
+    table = pq.read_table(output_filepath)
+    assert sorted(table.column("row_idx").to_pylist()) == list(range(len(smiles_list)))
+    assert table.column("timed_out").to_pylist() == [False] * len(smiles_list)
+
+
+def test_run_tasks_persistent_pool(tmp_path, capsys):
+    """
+    test that several tasks run in one process write the same outputs as separate tasks
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    output_pattern = str(tmp_path / "subset_*.parquet")
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC",
+                   "CCCl", "c1ccccc1O"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+
+    # every task gets its output and its metrics
+    finished_task_id_list = run_tasks(
+        task_chunks_list=[(task_id, compute_chunk_idx(len(smiles_list), task_id, 3))
+                          for task_id in range(3)],
+        output_pattern=output_pattern,
+        config_dict={"input_csv": str(input_csv), "nb_random": 100, "nb_core": 2})
+    assert finished_task_id_list == [0, 1, 2]
+    row_idx_list = []
+    for task_id in range(3):
+        chunk_dict = compute_chunk_idx(len(smiles_list), task_id, 3)
+        table = pq.read_table(output_pattern.replace("*", str(task_id)))
+        assert table.num_rows == chunk_dict["last_idx"] - chunk_dict["first_idx"] + \
+            (chunk_dict["extra_idx"] is not None)
+        assert Path(get_metrics_path(output_pattern.replace("*", str(task_id)))).exists()
+        row_idx_list += table.column("row_idx").to_pylist()
+    assert sorted(row_idx_list) == list(range(len(smiles_list)))
+
+    # the same workers computed every task
+    worker_pids_set = {line.split(":")[0] for line in capsys.readouterr().out.splitlines()
+                       if line.startswith("worker")}
+    assert len(worker_pids_set) == 2
+
+
 if __name__ == "__main__":
     pytest.main()
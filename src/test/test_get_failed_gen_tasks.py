@@ -0,0 +1,77 @@
+""" Test the footer based validation of the job array outputs
+"""
+from pathlib import Path
+import json
+import sys
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.get_failed_gen_tasks import parse_job_array_range, format_job_array_range, \
+    get_expected_nb_rows, main
+
+
+def test_job_array_range():
+    """ test the parsing and formatting of SLURM --array syntax """
+    assert parse_job_array_range("1-3") == [1, 2, 3]
+    assert parse_job_array_range("1,14,30") == [1, 14, 30]
+    assert parse_job_array_range("0-2,5,7-8%4") == [0, 1, 2, 5, 7, 8]
+    with pytest.raises(ValueError):
+        parse_job_array_range("a-")
+    assert format_job_array_range([8, 1, 2, 3, 5, 10, 11]) == "1-3,5,8,10-11"
+
+
+def test_validate_outputs(tmp_path):
+    """ test that missing, truncated and short outputs are reported as failed """
+    # declare local variables
+    nb_smiles = 23
+    job_array_size = 5
+    search_pattern = str(tmp_path / "subset_*.parquet")
+    output_filepath = tmp_path / "failed_task_id.txt"
+
+    # every task is complete, the first ones with the load balancing extra row
+    for task_id in range(job_array_size):
+        nb_rows = get_expected_nb_rows(task_id, nb_smiles, job_array_size)
+        pq.write_table(pa.table({"SMILES": ["C"] * nb_rows}),
+                       search_pattern.replace("*", str(task_id)))
+    assert [get_expected_nb_rows(task_id, nb_smiles, job_array_size)
+            for task_id in range(job_array_size)] == [5, 5, 5, 4, 4]
+    assert main(search_pattern, str(output_filepath), "0-4", nb_smiles, job_array_size) == []
+    assert not output_filepath.exists()
+
+    # task 1 is short, task 2 is truncated, task 4 is missing
+    pq.write_table(pa.table({"SMILES": ["C"] * 4}), search_pattern.replace("*", "1"))
+    task_path = Path(search_pattern.replace("*", "2"))
+    task_path.write_bytes(task_path.read_bytes()[:-20])
+    Path(search_pattern.replace("*", "4")).unlink()
+
+    assert main(search_pattern, str(output_filepath), "0-4", nb_smiles, job_array_size) == \
+        [1, 2, 4]
+    assert output_filepath.read_text(encoding="utf-8") == "1-2,4\n"
+
+
+def test_validate_outputs_plan(tmp_path):
+    """ test that the expected number of rows is read from the plan file """
+    # declare local variables
+    search_pattern = str(tmp_path / "subset_*.parquet")
+    output_filepath = tmp_path / "failed_task_id.txt"
+    plan_file = tmp_path / "plan.json"
+    plan_dict = {"nb_smiles": 10,
+                 "tasks": [{"first_idx": 0, "last_idx": 7},
+                           {"first_idx": 7, "last_idx": 9},
+                           {"first_idx": 9, "last_idx": 10}]}
+    plan_file.write_text(json.dumps(plan_dict), encoding="utf-8")
+
+    # the chunks of the plan are not the load balanced ones
+    for task_id, nb_rows in enumerate([7, 2, 0]):
+        pq.write_table(pa.table({"SMILES": ["C"] * nb_rows}),
+                       search_pattern.replace("*", str(task_id)))
+    assert main(search_pattern, str(output_filepath), "0-2", 10, 3, str(plan_file)) == [2]
+    assert output_filepath.read_text(encoding="utf-8") == "2\n"
+
+
+if __name__ == "__main__":
+    pytest.main()
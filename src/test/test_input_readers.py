@@ -0,0 +1,96 @@
+""" Test the parquet, compressed csv and .smi readers against the csv reader
+"""
+from pathlib import Path
+import sys
+import gzip
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.input_readers import get_input_format, convert_to_parquet, read_parquet_rows, \
+    iter_csv_batches
+from features.generate_clearsmiles import wrapper_input_reader, wrapper_csv_reader, \
+    compute_chunk_idx
+
+
+# declare global variables
+NB_SMILES = 103
+JOB_ARRAY_SIZE = 7
+
+
+@pytest.fixture(name="csv_path")
+def fixture_csv_path(tmp_path):
+    """ small csv database, with a quoted field spanning two lines """
+    csv_path = tmp_path / "database.csv"
+    rows_list = ["SMILES,SPLIT"]
+    rows_list += [f"{'C' * (i + 1)}O,train" for i in range(NB_SMILES)]
+    rows_list[42] = 'CCO,"multi\nline"'
+    csv_path.write_text("\n".join(rows_list) + "\n", encoding="utf-8")
+
+    return csv_path
+
+
+def test_get_input_format():
+    """ test the suffixes """
+    assert get_input_format("data/raw/MOSES.csv") == ("csv", None)
+    assert get_input_format("data/raw/MOSES.csv.gz") == ("csv", "gzip")
+    assert get_input_format("data/raw/MOSES.smi.zst") == ("smi", "zstd")
+    assert get_input_format("data/raw/MOSES.parquet") == ("parquet", None)
+
+
+def test_readers_match_csv_reader(csv_path, tmp_path):
+    """ test that every format gives the same chunks than the csv reader """
+    # declare local variables
+    gzip_path = tmp_path / "database.csv.gz"
+    zstd_path = tmp_path / "database.csv.zst"
+    parquet_path = tmp_path / "database.parquet"
+    gzip_path.write_bytes(gzip.compress(csv_path.read_bytes()))
+    with pa.output_stream(zstd_path, compression="zstd") as zstd_file:
+        zstd_file.write(csv_path.read_bytes())
+    assert convert_to_parquet(str(zstd_path), str(parquet_path), row_group_size=10) == NB_SMILES
+    assert pq.ParquetFile(parquet_path).num_row_groups == 11
+
+    for task_id in range(JOB_ARRAY_SIZE):
+        chunk_dict = compute_chunk_idx(NB_SMILES, task_id, JOB_ARRAY_SIZE)
+        expected_list = wrapper_csv_reader(str(csv_path), **chunk_dict, row_idx_key="row_idx")
+        for input_path in (csv_path, gzip_path, zstd_path, parquet_path):
+            assert wrapper_input_reader(str(input_path), **chunk_dict,
+                                        row_idx_key="row_idx") == expected_list
+
+        # only the requested columns are passed to the workers
+        for input_path in (csv_path, gzip_path, parquet_path):
+            assert wrapper_input_reader(str(input_path), **chunk_dict,
+                                        columns_list=["SMILES"]) == \
+                [{"SMILES": row_dict["SMILES"]} for row_dict in expected_list]
+
+
+def test_read_parquet_rows_types(tmp_path):
+    """ test that non string columns are read as strings, and the end of file """
+    parquet_path = tmp_path / "database.parquet"
+    pq.write_table(pa.table({"SMILES": ["C", "CC", "CCC"], "weight": [16.0, 30.1, 44.1]}),
+                   parquet_path, row_group_size=2)
+    assert read_parquet_rows(str(parquet_path), 1, 10, None, row_idx_key="row_idx") == \
+        [{"SMILES": "CC", "weight": "30.1", "row_idx": 1},
+         {"SMILES": "CCC", "weight": "44.1", "row_idx": 2}]
+
+
+def test_smi_reader(tmp_path):
+    """ test a gzip .smi file, with and without names """
+    smi_path = tmp_path / "database.smi.gz"
+    smi_path.write_bytes(gzip.compress(b"CCO ethanol\nc1ccccc1\tbenzene ring\n\nC\n"))
+    assert wrapper_input_reader(str(smi_path), 1, 2, 2) == \
+        [{"SMILES": "c1ccccc1", "name": "benzene ring"}, {"SMILES": "C", "name": ""}]
+
+
+def test_empty_csv(tmp_path):
+    """ test that an empty csv file has no batch instead of raising """
+    csv_path = tmp_path / "empty.csv.gz"
+    csv_path.write_bytes(gzip.compress(b""))
+    assert not list(iter_csv_batches(str(csv_path), "gzip"))
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,41 @@
+""" Test the deferred import of the heavy dependencies
+"""
+from pathlib import Path
+import sys
+import subprocess
+import pytest
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.lazy_import import LazyModule
+
+
+def test_lazy_module():
+    """
+    test that the proxy imports its module on first use and then behaves like it
+    """
+    json_module = LazyModule("json")
+    assert "lazy module 'json'" in repr(json_module)
+    assert json_module.dumps([1]) == "[1]"
+    assert json_module.loads is __import__("json").loads
+    with pytest.raises(AttributeError):
+        json_module.not_an_attribute
+
+
+def test_command_line_imports():
+    """
+    test that importing the generation and planning scripts loads no heavy dependency
+    """
+    # a fresh interpreter, the test session already imported them
+    code = "import sys\n" \
+        "import features.generate_clearsmiles, features.get_failed_gen_tasks, " \
+        "features.plan_chunks\n" \
+        "print(sorted(name for name in ('numpy', 'pyarrow', 'rdkit') if name in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=parent_path, check=True,
+                            capture_output=True, text=True).stdout
+    assert output.strip() == "[]"
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,65 @@
+""" Test the md5 lookup index of the aggregated library
+"""
+from pathlib import Path
+import sys
+import numpy as np
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.library_index import build_library_index, load_library_index, lookup_rows, \
+    lookup_clearsmiles, get_index_path
+from features.concatenate2lib import main as concatenate_main
+
+
+# declare global variables
+SMILES_LIST = ["CCO", "c1ccccc1", "CC(=O)O", "C1CCCCC1", "CCN", "CBr", "CCCl", "CC", "CCO"]
+
+
+@pytest.fixture(name="library_path")
+def fixture_library_path(tmp_path):
+    """ a library of four row groups, with a duplicated molecule """
+    library_path = tmp_path / "library.parquet"
+    pq.write_table(pa.table({"SMILES": SMILES_LIST,
+                             "ClearSMILES_set": [[smiles, str(row_idx)] for row_idx, smiles
+                                                 in enumerate(SMILES_LIST)]}),
+                   library_path, row_group_size=3)
+
+    return str(library_path)
+
+
+def test_lookup_rows(library_path):
+    """ test that any SMILES of a molecule finds its first row """
+    assert build_library_index(library_path, nb_core=2) == len(SMILES_LIST)
+    index_array = load_library_index(library_path)
+    assert isinstance(index_array, np.memmap)
+    assert index_array["digest"].tolist() == sorted(index_array["digest"].tolist())
+
+    row_array = lookup_rows(index_array, ["OCC", "C1=CC=CC=C1", "ClCC", "CCCC", "not a smiles"])
+    assert row_array.tolist() == [0, 1, 6, -1, -1]
+
+
+def test_lookup_clearsmiles(library_path):
+    """ test that the rows are read in the order of the query, with null rows """
+    build_library_index(library_path, nb_core=1)
+    table = lookup_clearsmiles(library_path, ["BrC", "CCCC", "OC(C)=O", "C(C)O"])
+    assert table.column("SMILES").to_pylist() == ["CBr", None, "CC(=O)O", "CCO"]
+    assert table.column("ClearSMILES_set").to_pylist() == \
+        [["CBr", "5"], None, ["CC(=O)O", "2"], ["CCO", "0"]]
+
+
+def test_concatenate_build_index(library_path, tmp_path):
+    """ test that the index is built with the database """
+    output_filepath = tmp_path / "whole_library.parquet"
+    concatenate_main(library_path, str(output_filepath), use_multiprocessing=False,
+                     row_group_size=4, build_index=True)
+    assert Path(get_index_path(str(output_filepath))).exists()
+    assert lookup_clearsmiles(str(output_filepath), ["C1CCCCC1"]) \
+        .column("SMILES").to_pylist() == ["C1CCCCC1"]
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,94 @@
+""" Test the cost model based planning of the job array chunks
+"""
+from pathlib import Path
+import sys
+import gzip
+import pytest
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.plan_chunks import get_descriptors, fit_cost_model, split_costs, \
+    load_chunk_idx, load_plan_chunks, predict_costs, main
+from features.generate_clearsmiles import compute_chunk_idx
+
+
+def test_get_descriptors():
+    """ test the descriptors of aspirin and of a bracket atom with digits """
+    assert get_descriptors("CC(=O)OC1=CC=CC=C1C(=O)O") == [1, 13, 1, 2]
+    assert get_descriptors("[13CH3]Cl") == [1, 2, 0, 0]
+
+
+def test_split_costs():
+    """ test that the ranges cover every row and balance the predicted cost """
+    # declare local variables
+    cost_array = np.array([1.0] * 90 + [10.0] * 10)
+    tasks_list = split_costs(cost_array, 4)
+
+    assert tasks_list[0]["first_idx"] == 0
+    assert tasks_list[-1]["last_idx"] == len(cost_array)
+    assert all(previous_dict["last_idx"] == task_dict["first_idx"]
+               for previous_dict, task_dict in zip(tasks_list[:-1], tasks_list[1:]))
+    equal_split_max = max(cost_array[i * 25:(i + 1) * 25].sum() for i in range(4))
+    assert max(task_dict["predicted_cost"] for task_dict in tasks_list) < equal_split_max
+
+
+def test_plan_chunks(tmp_path):
+    """ test the calibration on previous results and the plan file """
+    # declare local variables
+    smiles_list = ["C" * nb_atoms for nb_atoms in range(1, 41)] * 5
+    input_csv = tmp_path / "database.csv"
+    plan_file = tmp_path / "plan.json"
+    input_csv.write_text("SMILES,SPLIT\n" + "".join(f"{smiles},train\n"
+                                                     for smiles in smiles_list),
+                         encoding="utf-8")
+
+    # previous run where the cost grows exponentially with the number of atoms
+    table = pa.Table.from_pylist([{"SMILES": smiles, "total_time": 0.01 * np.exp(0.2 * len(smiles))}
+                                  for smiles in smiles_list])
+    pq.write_table(table, tmp_path / "results_0.parquet")
+    coefficients_list = fit_cost_model(str(tmp_path / "results_*.parquet"))
+    assert coefficients_list[1] == pytest.approx(0.2)
+    assert fit_cost_model(str(tmp_path / "missing_*.parquet")) is None
+
+    # every row is planned once
+    plan_dict = main(str(input_csv), str(tmp_path / "results_*.parquet"), str(plan_file), 7)
+    assert plan_dict["nb_smiles"] == len(smiles_list)
+    planned_rows_list = []
+    for task_id in range(7):
+        chunk_dict = load_chunk_idx(str(plan_file), task_id)
+        assert chunk_dict.keys() == compute_chunk_idx(len(smiles_list), task_id, 7).keys()
+        planned_rows_list += list(range(chunk_dict["first_idx"], chunk_dict["last_idx"]))
+    assert planned_rows_list == list(range(len(smiles_list)))
+    assert load_plan_chunks(str(plan_file)) == [load_chunk_idx(str(plan_file), task_id)
+                                                for task_id in range(7)]
+
+
+def test_predict_costs_input_formats(tmp_path):
+    """ test that the costs are predicted the same from every input format """
+    # declare local variables
+    smiles_list = ["CCO", "CC(=O)OC1=CC=CC=C1C(=O)O", "c1ccccc1", "C[N+](C)(C)CC(=O)[O-]"]
+    coefficients_list = [0.1, 0.2, 0.3, 0.4]
+    csv_text = "SMILES,SPLIT\n" + "".join(f"{smiles},train\n" for smiles in smiles_list)
+    (tmp_path / "database.csv").write_text(csv_text, encoding="utf-8")
+    with gzip.open(tmp_path / "database.csv.gz", "wt", encoding="utf-8") as csv_file:
+        csv_file.write(csv_text)
+    (tmp_path / "database.smi").write_text("".join(f"{smiles} mol{i}\n" for i, smiles
+                                                   in enumerate(smiles_list)),
+                                           encoding="utf-8")
+    pq.write_table(pa.table({"SPLIT": ["train"] * 4, "SMILES": smiles_list}),
+                   tmp_path / "database.parquet", row_group_size=3)
+
+    expected_array = np.exp(np.array([get_descriptors(smiles) for smiles in smiles_list])
+                            @ np.array(coefficients_list))
+    for filename in ["database.csv", "database.csv.gz", "database.smi", "database.parquet"]:
+        assert predict_costs(str(tmp_path / filename), coefficients_list) == \
+            pytest.approx(expected_array)
+        assert predict_costs(str(tmp_path / filename), None).tolist() == [1.0] * 4
+
+
+if __name__ == "__main__":
+    pytest.main()
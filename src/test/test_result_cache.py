@@ -0,0 +1,139 @@
+""" Test the persistent result cache of get_clearsmiles
+"""
+from pathlib import Path
+import sys
+import sqlite3
+from multiprocessing import Pool
+import pytest
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.result_cache import open_cache, get_cache_key, cache_get, cache_put, \
+    flush_accesses, add_cache_counters, get_cache_stats, close_cache
+from features.generate_clearsmiles import main
+
+
+def write_entries(cache_dir: str, worker_idx: int) -> None:
+    """ write entries from another process """
+    cache_dict = open_cache(cache_dir, nb_shards=2)
+    for i in range(50):
+        key = get_cache_key(f"C{worker_idx}_{i}", {})
+        cache_put(cache_dict, key, f"C{worker_idx}_{i}", {"worker": worker_idx})
+    add_cache_counters(cache_dict, 1, 2)
+    close_cache(cache_dict)
+
+
+def test_cache_get_put(tmp_path):
+    """ test that the key depends on the parameters and that results are read back """
+    cache_dict = open_cache(str(tmp_path), nb_shards=4)
+    key = get_cache_key("CCO", {"nb_random": 10})
+    assert key != get_cache_key("CCO", {"nb_random": 20})
+    assert key == get_cache_key("CCO", {"nb_random": 10})
+    assert cache_get(cache_dict, key) is None
+
+    cache_put(cache_dict, key, "CCO", {"max_digit": 0, "lowest_mem_score": float("inf")})
+    assert cache_get(cache_dict, key) == {"max_digit": 0, "lowest_mem_score": float("inf")}
+
+    # an existing cache keeps its number of shards
+    assert open_cache(str(tmp_path), nb_shards=8)["nb_shards"] == 4
+    close_cache(cache_dict)
+
+
+def test_cache_eviction(tmp_path):
+    """ test that the least recently used entries are evicted above the size limit """
+    # a single shard of 1000 bytes
+    cache_dict = open_cache(str(tmp_path), nb_shards=1, max_size_mb=1e-3)
+    keys_list = [get_cache_key(f"C{i}", {}) for i in range(20)]
+    for i, key in enumerate(keys_list):
+        cache_put(cache_dict, key, f"C{i}", {"ClearSMILES_set": "C" * 90})
+        if i:
+            cache_get(cache_dict, keys_list[0])
+
+    stats_dict = get_cache_stats(cache_dict)
+    assert stats_dict["size"] <= 1000
+    assert cache_get(cache_dict, keys_list[0]) is not None
+    assert cache_get(cache_dict, keys_list[1]) is None
+    assert cache_get(cache_dict, keys_list[-1]) is not None
+    close_cache(cache_dict)
+
+
+def test_cache_batched_accesses(tmp_path):
+    """ test that a hit does not write to its shard, the access times are written in batches """
+    # declare local variables
+    cache_dict = open_cache(str(tmp_path), nb_shards=1)
+    keys_list = [get_cache_key(f"C{i}", {}) for i in range(3)]
+    shard_connection = sqlite3.connect(tmp_path / "shard_000.sqlite")
+
+    def get_last_access(key):
+        return shard_connection.execute("SELECT last_access FROM results WHERE key = ?",
+                                        (key,)).fetchone()[0]
+
+    cache_put(cache_dict, keys_list[0], "C0", {})
+    put_time = get_last_access(keys_list[0])
+    assert cache_get(cache_dict, keys_list[0]) == {}
+    assert get_last_access(keys_list[0]) == put_time
+
+    # written with the next write to the shard
+    cache_put(cache_dict, keys_list[1], "C1", {})
+    first_access_time = get_last_access(keys_list[0])
+    assert first_access_time > put_time
+
+    # written on flush, and when the cache is closed
+    cache_get(cache_dict, keys_list[0])
+    flush_accesses(cache_dict)
+    assert get_last_access(keys_list[0]) > first_access_time
+    cache_get(cache_dict, keys_list[1])
+    second_access_time = get_last_access(keys_list[1])
+    close_cache(cache_dict)
+    assert get_last_access(keys_list[1]) > second_access_time
+    assert not cache_dict["pending_accesses"]
+    shard_connection.close()
+
+
+def test_cache_concurrent_writes(tmp_path):
+    """ test that several processes can write to the same shards """
+    with Pool(4) as pool:
+        pool.starmap(write_entries, [(str(tmp_path), worker_idx) for worker_idx in range(4)])
+
+    cache_dict = open_cache(str(tmp_path))
+    stats_dict = get_cache_stats(cache_dict)
+    assert stats_dict["nb_entries"] == 200
+    assert (stats_dict["hits"], stats_dict["misses"]) == (4, 8)
+    close_cache(cache_dict)
+
+
+def test_main_with_cache(tmp_path):
+    """ test that a rerun reads every molecule from the cache, whatever its input SMILES """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    cache_dir = tmp_path / "cache"
+    smiles_list = ["CCO", "OCC", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+    chunk_indices = {"first_idx": 0, "last_idx": len(smiles_list), "extra_idx": None}
+
+    # the second run only hits the cache
+    for run_idx in range(2):
+        main(output_filepath=str(tmp_path / f"results_{run_idx}.parquet"),
+             chunk_indices=chunk_indices,
+             config_dict={"input_csv": str(input_csv), "nb_random": 200, "nb_core": 1,
+                          "cache_dir": str(cache_dir)})
+    first_table = pq.read_table(tmp_path / "results_0.parquet").sort_by("row_idx")
+    second_table = pq.read_table(tmp_path / "results_1.parquet").sort_by("row_idx")
+    assert first_table.column("cache_hit").to_pylist() == [False, True, False, False]
+    assert all(second_table.column("cache_hit").to_pylist())
+    assert second_table.column("ClearSMILES_set") == first_table.column("ClearSMILES_set")
+    assert second_table.column("SMILES") == first_table.column("SMILES")
+
+    # hits and misses of both runs
+    cache_dict = open_cache(str(cache_dir))
+    stats_dict = get_cache_stats(cache_dict)
+    assert (stats_dict["hits"], stats_dict["misses"]) == (5, 3)
+    assert stats_dict["nb_entries"] == 3
+    close_cache(cache_dict)
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,71 @@
+""" Test the metrics written by the generation tasks and their summary
+"""
+from pathlib import Path
+import sys
+import json
+import pytest
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.run_metrics import summarize_values, keep_slowest, summarize_metrics, \
+    get_metrics_path, STAGE_COLUMNS_LIST
+from features.generate_clearsmiles import main
+
+
+def test_summarize_values():
+    """ test the percentiles, None values are ignored """
+    summary_dict = summarize_values(list(range(1, 101)) + [None])
+    assert summary_dict["count"] == 100
+    assert summary_dict["sum"] == 5050
+    assert summary_dict["p50"] == pytest.approx(50.5)
+    assert summary_dict["max"] == 100
+    assert summarize_values([]) == {"count": 0, "sum": 0.0}
+
+
+def test_keep_slowest():
+    """ test that the slowest profiles are kept, slowest first """
+    profiles_list = keep_slowest([{"total_time": 3.0}], [{"total_time": 1.0},
+                                                         {"total_time": 5.0}], 2)
+    assert profiles_list == [{"total_time": 5.0}, {"total_time": 3.0}]
+
+
+def test_task_metrics_and_summary(tmp_path, capsys):
+    """ test the metrics of two tasks and the summary of the job array """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+
+    for task_id, (first_idx, last_idx) in enumerate([(0, 3), (3, 5)]):
+        main(output_filepath=str(tmp_path / f"subset_{task_id}.parquet"),
+             chunk_indices={"first_idx": first_idx, "last_idx": last_idx, "extra_idx": None},
+             config_dict={"input_csv": str(input_csv), "nb_random": 200, "nb_core": 2,
+                          "chunksize": 1, "nb_profiled": 2})
+
+    with open(get_metrics_path(str(tmp_path / "subset_0.parquet")), encoding="utf-8") as file:
+        metrics_dict = json.load(file)
+    assert metrics_dict["task"]["nb_molecules"] == 3
+    assert len(metrics_dict["queue_wait_time"]) == metrics_dict["task"]["nb_batches"] == 3
+    assert sum(worker_dict["nb_molecules"] for worker_dict in metrics_dict["workers"].values()) \
+        == 3
+    assert all(worker_dict["peak_rss_mb"] > 0 for worker_dict in metrics_dict["workers"].values())
+    assert metrics_dict["stages"]["total_time"]["count"] == 3
+    assert len(metrics_dict["slowest_molecules"]) == 2
+    assert "CC(=O)OC1=CC=CC=C1C(=O)O" in [profile_dict["SMILES"] for profile_dict
+                                         in metrics_dict["slowest_molecules"]]
+    assert "get_clearsmiles" in metrics_dict["slowest_molecules"][0]["profile"]
+
+    # the stages are summarized over every molecule of the job array
+    summary_dict = summarize_metrics(str(tmp_path / "subset_*.parquet.metrics.json"))
+    assert summary_dict["nb_tasks"] == 2
+    assert summary_dict["nb_molecules"]["sum"] == len(smiles_list)
+    assert summary_dict["queue_wait_time"]["count"] == len(smiles_list)
+    for column in STAGE_COLUMNS_LIST:
+        assert summary_dict[column]["count"] == len(smiles_list)
+    capsys.readouterr()
+
+
+if __name__ == "__main__":
+    pytest.main()
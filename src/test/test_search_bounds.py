@@ -0,0 +1,67 @@
+""" Test the graph derived lower bounds of the ClearSMILES search
+"""
+from pathlib import Path
+import sys
+import pytest
+from rdkit import Chem
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.search_bounds import compute_lower_bounds
+from features.batch_scoring import pack_smiles, batch_find_biggest_digits, \
+    batch_semantic_mem_score
+
+
+def test_lower_bounds_are_valid():
+    """test that no randomized kekule SMILES is below the lower bounds 
+    """
+    # declare local variables
+    smiles_list = [
+        # acetic acid
+        "CC(=O)O",
+        # aspirin
+        "CC(=O)OC1=CC=CC=C1C(=O)O",
+        # imatinib
+        "CC1=C(C=C(C=C1)NC(=O)C2=CC=C(C=C2)CN3CCN(CC3)C)NC4=NC=CC(=N4)C5=CN=CC=C5",
+        # cubane, stereo bonds and bracket atoms
+        "C12C3C4C1C5C2C3C45",
+        "C/C=C/1CCCC/1=C/C",
+        "C[N+](C)(C)CC(=O)[O-]",
+    ]
+
+    for smiles in smiles_list:
+        mol = Chem.MolFromSmiles(smiles)
+        bounds_dict = compute_lower_bounds(mol)
+        random_smiles_list = list(set(Chem.MolToRandomSmilesVect(mol, 5_000, randomSeed=42,
+                                                                 kekuleSmiles=True)))
+        buffer, offsets = pack_smiles(random_smiles_list)
+        assert batch_find_biggest_digits(buffer, offsets).min() >= bounds_dict["max_digit"]
+        assert batch_semantic_mem_score(buffer, offsets).min() >= bounds_dict["mem_score"]
+
+
+def test_lower_bounds_values():
+    """test the bounds of molecules for which the optimum is known
+    """
+    # ethanol is linear, no digit and an empty memory map
+    bounds_dict = compute_lower_bounds(Chem.MolFromSmiles("CCO"))
+    assert bounds_dict["is_linear"]
+    assert bounds_dict["max_digit"] == 0
+    assert bounds_dict["mem_score"] == 0.0
+
+    # isobutane is best written CC(C)C
+    bounds_dict = compute_lower_bounds(Chem.MolFromSmiles("CC(C)C"))
+    assert not bounds_dict["is_linear"]
+    assert bounds_dict["mem_score"] == 2 / 6
+
+    # a single ring needs one digit
+    bounds_dict = compute_lower_bounds(Chem.MolFromSmiles("C1CCCCC1"))
+    assert bounds_dict["max_digit"] == 1
+
+    # digits of bracket atoms do not depend on the traversal
+    bounds_dict = compute_lower_bounds(Chem.MolFromSmiles("[13CH3]C"))
+    assert bounds_dict["max_digit"] == 3
+
+
+if __name__ == "__main__":
+    pytest.main()
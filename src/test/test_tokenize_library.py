@@ -0,0 +1,102 @@
+""" Test the vocabulary builder and the token ids of the library
+"""
+from pathlib import Path
+import sys
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.tokenize_library import PAD_TOKEN, build_vocabulary, decode_token_ids, \
+    load_vocabulary, main
+
+
+@pytest.fixture(name="library_path")
+def fixture_library_path(tmp_path):
+    """ a library of three row groups, with a null and an empty set """
+    library_path = tmp_path / "library.parquet"
+    pq.write_table(pa.table({"SMILES": ["CCO", "c1ccccc1Cl", "C", "CBr"],
+                             "ClearSMILES_set": pa.array(
+                                 [["CCO", "OCC"], ["C1=CC=CC=C1Cl"], None, []],
+                                 type=pa.list_(pa.string()))}),
+                   library_path, row_group_size=2)
+
+    return library_path
+
+
+def test_build_vocabulary(library_path):
+    """ test the frequencies and the statistics reduced over the row groups """
+    vocab_dict = build_vocabulary(str(library_path), "ClearSMILES_set", nb_core=2)
+    assert vocab_dict["tokens"][:2] == [PAD_TOKEN, "C"]
+    assert dict(zip(vocab_dict["tokens"], vocab_dict["frequencies"])) == \
+        {PAD_TOKEN: 0, "C": 10, "O": 2, "=": 3, "1": 2, "Cl": 1}
+    assert vocab_dict["dtype"] == "uint8"
+    assert vocab_dict["nb_smiles"] == 3
+    assert vocab_dict["nb_tokens"] == 18
+    assert vocab_dict["max_length"] == 12
+
+
+def test_main(library_path, tmp_path):
+    """ test that the token ids decode back to the library, in the same order """
+    output_filepath = tmp_path / "token_ids.parquet"
+    vocab_filepath = tmp_path / "vocab.json"
+    main(str(library_path), str(output_filepath), str(vocab_filepath), nb_core=2)
+
+    vocab_dict = load_vocabulary(vocab_filepath)
+    table = pq.read_table(output_filepath)
+    assert table.column_names == ["SMILES", "ClearSMILES_set_token_ids"]
+    assert table.schema.field("ClearSMILES_set_token_ids").type.value_type.value_type == \
+        pa.uint8()
+    assert pq.ParquetFile(output_filepath).num_row_groups == 2
+    decoded_list = [None if token_ids_list is None else
+                    [decode_token_ids(token_ids, vocab_dict) for token_ids in token_ids_list]
+                    for token_ids_list in table.column("ClearSMILES_set_token_ids").to_pylist()]
+    assert decoded_list == pq.read_table(library_path).column("ClearSMILES_set").to_pylist()
+
+    # one SMILES per row
+    main(str(library_path), str(output_filepath), str(vocab_filepath), column="SMILES",
+         keep_columns_list=[], nb_core=1)
+    table = pq.read_table(output_filepath)
+    vocab_dict = load_vocabulary(vocab_filepath)
+    assert [decode_token_ids(token_ids, vocab_dict)
+            for token_ids in table.column("SMILES_token_ids").to_pylist()] == \
+        ["CCO", "c1ccccc1Cl", "C", "CBr"]
+
+
+def test_unencodable_smiles(tmp_path):
+    """ test that every SMILES decodes back from its token ids, and that the SMILES
+    with characters unknown to the tokenizer are reported instead of being truncated """
+    # declare local variables
+    library_path = tmp_path / "library.parquet"
+    output_filepath = tmp_path / "token_ids.parquet"
+    vocab_filepath = tmp_path / "vocab.json"
+    smiles_list = ["C1CC2CCC1CC2", "C%10CCCCC%10", "c1cc[nH]c1", "C/C=C/C", "N#N", "[O-]C=O"]
+
+    # round trip
+    pq.write_table(pa.table({"SMILES": smiles_list}), library_path)
+    main(str(library_path), str(output_filepath), str(vocab_filepath), column="SMILES",
+         keep_columns_list=[], nb_core=1)
+    vocab_dict = load_vocabulary(vocab_filepath)
+    assert vocab_dict["nb_unencodable_smiles"] == 0
+    assert [decode_token_ids(token_ids, vocab_dict) for token_ids
+            in pq.read_table(output_filepath).column("SMILES_token_ids").to_pylist()] == \
+        smiles_list
+
+    # a lone backslash is not matched by the regex
+    pq.write_table(pa.table({"SMILES": smiles_list + ["C\\C=C\\C"]}), library_path)
+    vocab_dict = build_vocabulary(str(library_path), "SMILES", nb_core=1)
+    assert vocab_dict["nb_unencodable_smiles"] == 1
+    assert vocab_dict["unencodable_smiles"] == ["C\\C=C\\C"]
+    assert vocab_dict["nb_smiles"] == len(smiles_list)
+    output_filepath.unlink()
+    with pytest.raises(ValueError):
+        main(str(library_path), str(output_filepath), str(vocab_filepath), column="SMILES",
+             keep_columns_list=[], nb_core=1)
+    assert not output_filepath.exists()
+    assert load_vocabulary(vocab_filepath)["nb_unencodable_smiles"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main()
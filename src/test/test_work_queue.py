@@ -0,0 +1,211 @@
+""" Test the shared filesystem work queue
+"""
+from pathlib import Path
+import os
+import sys
+import time
+import subprocess
+import threading
+import re
+from multiprocessing import Pool
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# make the relative import properly
+parent_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, f"{parent_path}/")
+from features.work_queue import create_queue, claim_range, complete_range, release_range, \
+    get_chunk_idx, get_queue_status, take_range, get_range_name
+from features.task_runners import run_queue_worker
+from features.generate_clearsmiles import get_results_schema
+from features.clearsmiles_search import get_clearsmiles
+from features.checkpoint import get_checkpoint_dir, get_part_paths, write_checkpoint_part, \
+    merge_checkpoint
+
+
+def claim_all(queue_dir: str, worker_id: str) -> list:
+    """ claim ranges until none is left, run in a separate process """
+    # declare local variables
+    range_list = []
+
+    while True:
+        range_name, claim_path = claim_range(queue_dir, worker_id, lease_time=600.0)
+        if range_name is None:
+            return range_list
+        complete_range(queue_dir, range_name, claim_path)
+        range_list.append(range_name)
+
+
+def test_create_queue_once(tmp_path):
+    """
+    test that workers creating the queue together create it once
+    """
+    queue_dir = str(tmp_path / "queue")
+    with Pool(4) as pool:
+        is_created_list = pool.starmap(create_queue, [(queue_dir, 95, 10)] * 8)
+    assert sum(is_created_list) == 1
+    assert get_queue_status(queue_dir, 600.0) == {"todo": 10, "claimed": 0, "done": 0,
+                                                  "expired": 0}
+    assert sorted(os.listdir(tmp_path)) == ["queue"]
+    assert get_chunk_idx(sorted(os.listdir(f"{queue_dir}/todo"))[-1]) == \
+        {"first_idx": 90, "last_idx": 95, "extra_idx": None}
+
+
+def test_claim_ranges_once(tmp_path):
+    """
+    test that concurrent workers never claim the same range
+    """
+    queue_dir = str(tmp_path / "queue")
+    create_queue(queue_dir, 200, 1)
+    with Pool(4) as pool:
+        range_lists = pool.starmap(claim_all, [(queue_dir, f"worker{i}") for i in range(4)])
+    range_list = [range_name for worker_range_list in range_lists
+                  for range_name in worker_range_list]
+    assert len(range_list) == len(set(range_list)) == 200
+    assert get_queue_status(queue_dir, 600.0)["done"] == 200
+
+
+def test_reclaim_expired_lease(tmp_path):
+    """
+    test that the range of a dead worker is claimed again once its lease expired
+    """
+    queue_dir = str(tmp_path / "queue")
+    create_queue(queue_dir, 2, 1)
+    dead_range_name, dead_claim_path = claim_range(queue_dir, "dead", lease_time=600.0)
+    os.utime(dead_claim_path, (0, 0))
+
+    # the todo range is claimed first, then the abandoned one
+    assert claim_range(queue_dir, "alive", lease_time=600.0)[0] != dead_range_name
+    range_name, claim_path = claim_range(queue_dir, "alive", lease_time=600.0)
+    assert range_name == dead_range_name
+    assert claim_range(queue_dir, "other", lease_time=600.0) == (None, None)
+
+    # the dead worker lost its range
+    assert not complete_range(queue_dir, dead_range_name, dead_claim_path)
+    assert release_range(queue_dir, range_name, claim_path)
+    assert get_queue_status(queue_dir, 600.0)["todo"] == 1
+
+
+def test_queue_workers(tmp_path):
+    """
+    test that several generation workers compute every row of the database once
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    queue_dir = tmp_path / "queue"
+    smiles_list = ["CCO", "CC(=O)O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C1CCCCC1", "CCN(CC)CC",
+                   "CCCl", "c1ccccc1O", "OCCO", "CC(C)O"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+
+    # a dead worker left a range behind
+    create_queue(str(queue_dir), len(smiles_list), 2)
+    _, dead_claim_path = claim_range(str(queue_dir), "dead", lease_time=1.0)
+    os.utime(dead_claim_path, (0, 0))
+
+    # three workers started together
+    command_list = [sys.executable, f"{parent_path}/features/generate_clearsmiles.py",
+                    "--input_csv", str(input_csv), "--queue_dir", str(queue_dir),
+                    "--nb_smiles", str(len(smiles_list)), "--range_size", "2",
+                    "--lease_time", "1", "--output_pattern", str(tmp_path / "range_*.parquet"),
+                    "--nb_random", "50", "--nb_core", "1"]
+    process_list = [subprocess.Popen(command_list, stdout=subprocess.DEVNULL) for _ in range(3)]
+    assert [process.wait(timeout=300) for process in process_list] == [0, 0, 0]
+
+    assert get_queue_status(str(queue_dir), 1.0) == {"todo": 0, "claimed": 0, "done": 5,
+                                                     "expired": 0}
+    table = pq.read_table(sorted(tmp_path.glob("range_*.parquet")))
+    assert sorted(table.column("row_idx").to_pylist()) == list(range(len(smiles_list)))
+
+
+def test_queue_worker_lost_lease(tmp_path):
+    """
+    test that a worker whose range is claimed by another worker while it computes it
+    stops the range without writing its output nor reporting it as done
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    queue_dir = str(tmp_path / "queue")
+    output_pattern = str(tmp_path / "range_*.parquet")
+    input_csv.write_text("SMILES\nCC(=O)OC1=CC=CC=C1C(=O)OC1=CC=CC=C1C(=O)O\n",
+                         encoding="utf-8")
+    create_queue(queue_dir, 1, 1)
+
+    def steal_range():
+        # the lease is taken over as soon as the worker claimed the range, as if it expired
+        while not os.listdir(f"{queue_dir}/claimed"):
+            time.sleep(0.01)
+        claim_name = os.listdir(f"{queue_dir}/claimed")[0]
+        range_name = claim_name.split(".")[0]
+        claim_path = f"{queue_dir}/claimed/{range_name}.thief"
+        assert take_range(f"{queue_dir}/claimed/{claim_name}", claim_path)
+        assert complete_range(queue_dir, range_name, claim_path)
+
+    thread = threading.Thread(target=steal_range)
+    thread.start()
+    start_time = time.perf_counter()
+    done_range_list = run_queue_worker(queue_dir, output_pattern,
+                                       {"input_csv": str(input_csv), "nb_random": 1_000_000,
+                                        "nb_core": 1},
+                                       lease_time=0.3)
+    thread.join()
+
+    # the worker stopped long before the end of the search
+    assert done_range_list == []
+    assert time.perf_counter() - start_time < 20
+    assert not list(tmp_path.glob("range_*.parquet"))
+    assert get_queue_status(queue_dir, 0.3) == {"todo": 0, "claimed": 0, "done": 1,
+                                                "expired": 0}
+
+
+def test_two_workers_same_range(tmp_path):
+    """
+    test that a worker notices at once that its range was claimed again, long before its
+    lease expires, and that the rows written by both workers are merged once
+    """
+    # declare local variables
+    input_csv = tmp_path / "database.csv"
+    queue_dir = str(tmp_path / "queue")
+    output_filepath = str(tmp_path / f"range_{get_range_name(0, 2)}.parquet")
+    checkpoint_dir = get_checkpoint_dir(output_filepath)
+    smiles_list = ["CCO", "CC(=O)OC1=CC=CC=C1C(=O)OC1=CC=CC=C1C(=O)O"]
+    input_csv.write_text("SMILES\n" + "".join(f"{smiles}\n" for smiles in smiles_list),
+                         encoding="utf-8")
+    create_queue(queue_dir, len(smiles_list), len(smiles_list))
+    schema = get_results_schema(["SMILES"])
+
+    def steal_range():
+        # the range is claimed again once the worker wrote the part of the small molecule
+        while not get_part_paths(checkpoint_dir):
+            time.sleep(0.01)
+        claim_name = os.listdir(f"{queue_dir}/claimed")[0]
+        claim_path = f"{queue_dir}/claimed/{get_range_name(0, 2)}.thief"
+        assert take_range(f"{queue_dir}/claimed/{claim_name}", claim_path)
+
+        # the thief computes every row of the range and merges the checkpoint
+        write_checkpoint_part(pa.Table.from_pylist(
+            [get_clearsmiles({"SMILES": smiles, "row_idx": row_idx}, 1, re.compile("."))
+             for row_idx, smiles in enumerate(smiles_list)], schema=schema),
+            checkpoint_dir, "thief")
+        merge_checkpoint(checkpoint_dir, output_filepath, schema)
+        assert complete_range(queue_dir, get_range_name(0, 2), claim_path)
+
+    thread = threading.Thread(target=steal_range)
+    thread.start()
+    start_time = time.perf_counter()
+    done_range_list = run_queue_worker(str(queue_dir), str(tmp_path / "range_*.parquet"),
+                                       {"input_csv": str(input_csv), "nb_random": 1_000_000,
+                                        "nb_core": 2, "chunksize": 1, "row_group_size": 1},
+                                       lease_time=600.0)
+    thread.join()
+
+    # the lease was not renewed in the meantime, the worker checked the claim of the range
+    assert done_range_list == []
+    assert time.perf_counter() - start_time < 20
+    table = pq.read_table(output_filepath)
+    assert sorted(table.column("row_idx").to_pylist()) == [0, 1]
+
+
+if __name__ == "__main__":
+    pytest.main()